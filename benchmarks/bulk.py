@@ -0,0 +1,140 @@
+"""Write throughput: one create per request against the batch endpoints.
+
+    python -m benchmarks.bulk --items 2000 --batch-size 500 --output bulk.json
+
+Every mode starts from a fresh SQLite file (in ``--directory``, a temporary
+one by default) holding one user, and creates ``--items`` posts and as many
+comments through the test client: ``single`` with one ``POST /api/v1/posts``
+(or ``/comments``) per item, ``batch`` with ``--batch-size`` items per call
+to the ``/batch`` endpoints. Background jobs (feed delivery, search
+indexing) run inline, so both modes pay for all of their writes.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from base64 import b64encode
+from datetime import datetime
+
+HEADERS = {"Authorization": "Basic " + b64encode(b"bench:bench").decode()}
+
+
+def _items(count, post_ids=None):
+    for i in range(count):
+        item = {"title": f"Item {i}", "content": f"Body of item {i} " * 10}
+        if post_ids is not None:
+            item["post_id"] = post_ids[i % len(post_ids)]
+        yield item
+
+
+def _single(client, kind, items):
+    url = "/api/v1/posts" if kind == "posts" else None
+    for item in items:
+        if kind == "comments":
+            url = f"/api/v1/posts/{item.pop('post_id')}/comments"
+        response = client.post(url, json=item, headers=HEADERS)
+        if response.status_code != 201:
+            raise RuntimeError(f"POST {url} answered {response.status_code}")
+
+
+def _batch(client, kind, items, size):
+    items = list(items)
+    for start in range(0, len(items), size):
+        response = client.post(
+            f"/api/v1/{kind}/batch",
+            json={"items": items[start : start + size]},
+            headers=HEADERS,
+        )
+        if response.status_code != 201:
+            raise RuntimeError(f"POST /{kind}/batch answered {response.status_code}")
+
+
+def run_mode(mode, args, directory):
+    from blog import create_app, db
+    from blog.models import Posts, Users
+    from config import Config
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = "sqlite:///" + os.path.join(directory, f"{mode}.db")
+        TASK_EAGER = True
+        API_MAX_BATCH_SIZE = args.batch_size
+
+    app = create_app(BenchConfig)
+    results = {}
+    with app.app_context():
+        db.create_all()
+        user = Users(username="bench", email="bench@bench.ru")
+        user.set_password("bench")
+        db.session.add(user)
+        db.session.commit()
+        client = app.test_client()
+        for kind in ("posts", "comments"):
+            post_ids = None
+            if kind == "comments":
+                post_ids = [ident for ident, in db.session.query(Posts.id)]
+            items = _items(args.items, post_ids)
+            started = time.perf_counter()
+            if mode == "single":
+                _single(client, kind, items)
+            else:
+                _batch(client, kind, items, args.batch_size)
+            elapsed = time.perf_counter() - started
+            results[kind] = {
+                "items": args.items,
+                "elapsed_s": elapsed,
+                "items_per_second": args.items / elapsed,
+            }
+        db.session.remove()
+        db.get_engine(app).dispose()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--items", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument(
+        "--mode", action="append", choices=("single", "batch"), dest="modes"
+    )
+    parser.add_argument("--directory", help="where the databases are created")
+    parser.add_argument("--output", help="write the results as JSON")
+    args = parser.parse_args(argv)
+
+    os.environ["RATELIMIT_ENABLED"] = "0"
+    directory = args.directory or tempfile.mkdtemp(prefix="blog-bulk-")
+    results = {}
+    try:
+        for mode in args.modes or ("single", "batch"):
+            results[mode] = run_mode(mode, args, directory)
+            for kind, result in results[mode].items():
+                print(
+                    "{:<7} {:<9} {:>8.1f} items/s  {:>8.2f} s".format(
+                        mode, kind, result["items_per_second"], result["elapsed_s"]
+                    )
+                )
+    finally:
+        if args.directory is None:
+            shutil.rmtree(directory)
+
+    if args.output:
+        report = {
+            "meta": {
+                "date": datetime.utcnow().isoformat(),
+                "items": args.items,
+                "batch_size": args.batch_size,
+                "python": platform.python_version(),
+            },
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,227 @@
+"""High-concurrency load test of the read endpoints: sync against gevent workers.
+
+    python -m benchmarks.seed --database sqlite:////tmp/bench.db
+    python -m benchmarks.load --database sqlite:////tmp/bench.db \
+        --connections 1000 --duration 20 --workers 4 --output load.json
+
+For every ``--mode`` gunicorn is started with ``gunicorn.conf.py`` and that
+worker class, then ``--connections`` clients spread over ``--processes``
+asyncio load generators request anonymous pages and API lists (index, post,
+a user's posts) for ``--duration`` seconds, one connection per request.
+Index pages past the first one are
+requested with cursors of real posts. Throughput, p50/p95/p99/max latency and
+errors (refused, timed out, 4xx or 5xx) are reported per mode. The generators share the machine with the server, so
+compare modes with each other rather than with other machines.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime
+from urllib.parse import quote
+
+from benchmarks.run import percentile
+
+
+def read_paths(dataset, rng):
+    choice = rng.random()
+    if choice < 0.1:
+        return "/?after=" + quote(rng.choice(dataset["cursors"]))
+    if choice < 0.4:
+        return "/"
+    if choice < 0.8:
+        return f"/post/{rng.randint(1, dataset['posts'])}"
+    if choice < 0.9:
+        return "/api/v1/posts"
+    return f"/api/v1/users/{rng.randint(1, dataset['users'])}/posts"
+
+
+async def fetch(host, port, path, timeout):
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(host, port), timeout
+    )
+    try:
+        writer.write(
+            f"GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode()
+        )
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(), timeout)
+    finally:
+        writer.close()
+    return int(response[9:12]) if response[:5] == b"HTTP/" else 0
+
+
+async def generate(host, port, connections, duration, timeout, dataset, seed):
+    latencies, errors = [], 0
+    deadline = time.perf_counter() + duration
+
+    async def client(index):
+        nonlocal errors
+        rng = random.Random(seed * 100003 + index)
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                status = await fetch(host, port, read_paths(dataset, rng), timeout)
+            except (OSError, asyncio.TimeoutError):
+                status = 0
+            if status == 0 or status >= 400:
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(client(i) for i in range(connections)))
+    return latencies, errors
+
+
+def _generator(args):
+    host, port, connections, duration, timeout, dataset, seed = args
+    return asyncio.run(
+        generate(host, port, connections, duration, timeout, dataset, seed)
+    )
+
+
+def start_server(mode, args, port):
+    env = dict(
+        os.environ,
+        DATABASE_URL=args.database,
+        RATELIMIT_ENABLED="0",
+        WEB_WORKER_CLASS=mode,
+        WEB_CONCURRENCY=str(args.workers),
+        WEB_BIND=f"127.0.0.1:{port}",
+    )
+    process = subprocess.Popen(
+        ["gunicorn", "--config", "gunicorn.conf.py", "blogapp:app"],
+        env=env,
+        stderr=subprocess.DEVNULL,
+    )
+    for _ in range(200):
+        try:
+            asyncio.run(fetch("127.0.0.1", port, "/", 1))
+            return process
+        except (OSError, asyncio.TimeoutError):
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f"gunicorn ({mode}) didn't start")
+
+
+def run_mode(mode, args, dataset, port):
+    process = start_server(mode, args, port)
+    try:
+        # warm up every worker's connections, templates and page cache
+        _generator(("127.0.0.1", port, 50, 2, args.timeout, dataset, 0))
+        shares = [args.connections // args.processes] * args.processes
+        for i in range(args.connections % args.processes):
+            shares[i] += 1
+        jobs = [
+            ("127.0.0.1", port, share, args.duration, args.timeout, dataset, seed)
+            for seed, share in enumerate(shares, 1)
+        ]
+        with multiprocessing.Pool(args.processes) as pool:
+            parts = pool.map(_generator, jobs)
+    finally:
+        process.terminate()
+        process.wait()
+    latencies = sorted(t for part, _ in parts for t in part)
+    return {
+        "requests": len(latencies),
+        "errors": sum(errors for _, errors in parts),
+        "throughput_rps": len(latencies) / args.duration,
+        "p50_ms": percentile(latencies, 0.50) * 1000 if latencies else None,
+        "p95_ms": percentile(latencies, 0.95) * 1000 if latencies else None,
+        "p99_ms": percentile(latencies, 0.99) * 1000 if latencies else None,
+        "max_ms": latencies[-1] * 1000 if latencies else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database", required=True, help="SQLAlchemy database URL")
+    parser.add_argument(
+        "--mode", action="append", choices=("sync", "gevent"), dest="modes"
+    )
+    parser.add_argument("--connections", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument(
+        "--processes", type=int, default=max(multiprocessing.cpu_count() // 2, 1)
+    )
+    parser.add_argument("--port", type=int, default=8091)
+    parser.add_argument("--output", help="write the results as JSON")
+    args = parser.parse_args(argv)
+
+    # every connection is a file descriptor on both ends
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    os.environ["DATABASE_URL"] = args.database
+    from sqlalchemy import func
+
+    from blog import create_app, db
+    from blog.models import Posts, Users
+    from blog.pagination import encode_cursor
+
+    columns = (Posts.publication_datetime, Posts.id)
+    with create_app().app_context():
+        dataset = {
+            "users": db.session.query(func.max(Users.id)).scalar(),
+            "posts": db.session.query(func.max(Posts.id)).scalar(),
+        }
+        # "older" links of the index point at a post's timestamp and id
+        cursors = [
+            encode_cursor(row, columns)
+            for row in db.session.query(*columns)
+            .filter(Posts.deleted_at.is_(None))
+            .order_by(func.random())
+            .limit(1000)
+        ]
+    if not dataset["users"] or not cursors:
+        parser.error("the database is empty, run benchmarks.seed first")
+
+    results = {}
+    for mode in args.modes or ("sync", "gevent"):
+        results[mode] = result = run_mode(
+            mode, args, dict(dataset, cursors=cursors), args.port
+        )
+        print(
+            "{:<7} {:>8.1f} rps  p50 {:>8.1f} ms  p95 {:>8.1f} ms  p99 {:>8.1f} ms  "
+            "max {:>8.1f} ms  errors {}".format(
+                mode,
+                result["throughput_rps"],
+                result["p50_ms"] or 0,
+                result["p95_ms"] or 0,
+                result["p99_ms"] or 0,
+                result["max_ms"] or 0,
+                result["errors"],
+            )
+        )
+
+    if args.output:
+        report = {
+            "meta": {
+                "date": datetime.utcnow().isoformat(),
+                "connections": args.connections,
+                "duration": args.duration,
+                "workers": args.workers,
+                "processes": args.processes,
+                "dataset": dataset,
+                "database": args.database.split(":", 1)[0],
+                "python": platform.python_version(),
+            },
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+"""Per-request overhead of the rate limiter.
+
+    python -m benchmarks.ratelimit --calls 20000 --threads 4 \
+        --redis-url redis://localhost:6379/0
+
+Times ``RateLimiter.check()`` for POST /login, spread over ``--clients``
+addresses, with the limiter disabled (the cost every request pays), with the
+in-process store and, when ``--redis-url`` is given, with the shared one.
+Limits are raised so that no call is refused.
+"""
+
+import argparse
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.run import percentile
+
+
+def measure(app, limiter, calls, clients, threads):
+    per_thread = calls // threads
+
+    def worker(index):
+        timings = []
+        for n in range(per_thread):
+            address = (index * per_thread + n) % clients
+            with app.test_request_context(
+                "/login",
+                method="POST",
+                environ_base={"REMOTE_ADDR": f"10.0.{address // 256}.{address % 256}"},
+            ):
+                started = time.perf_counter()
+                limiter.check()
+                timings.append(time.perf_counter() - started)
+        return timings
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        timings = sorted(t for chunk in pool.map(worker, range(threads)) for t in chunk)
+    elapsed = time.perf_counter() - started
+    return {
+        "calls": len(timings),
+        "p50_us": percentile(timings, 0.50) * 1e6,
+        "p99_us": percentile(timings, 0.99) * 1e6,
+        "checks_per_second": len(timings) / sum(timings) if sum(timings) else None,
+        "elapsed_s": elapsed,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=20000)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--redis-url", help="also measure the shared store")
+    args = parser.parse_args(argv)
+
+    from blog import create_app, limiter
+    from blog.ratelimit import MemoryBucketStore, RedisBucketStore
+
+    app = create_app()
+    app.config["RATELIMIT_ENABLED"] = True
+    state = app.extensions["ratelimit"]
+    state.limits = {"main.login": (args.calls, float(args.calls))}
+    stores = {"memory": MemoryBucketStore()}
+    if args.redis_url:
+        stores["redis"] = RedisBucketStore.from_url(args.redis_url)
+
+    runs = {"disabled": None, **stores}
+    for name, store in runs.items():
+        app.config["RATELIMIT_ENABLED"] = store is not None
+        state.store = store or stores["memory"]
+        result = measure(app, limiter, args.calls, args.clients, args.threads)
+        print(
+            "{:<10} p50 {:>8.2f} us  p99 {:>8.2f} us  {:>10.0f} checks/s".format(
+                name, result["p50_us"], result["p99_us"], result["checks_per_second"]
+            )
+        )
+        if store is not None:
+            store.clear()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,399 @@
+"""Latency/throughput benchmarks for the main routes.
+
+    python -m benchmarks.seed --database sqlite:////tmp/bench.db
+    python -m benchmarks.run --database sqlite:////tmp/bench.db \
+        --driver wsgi --concurrency 8 --output result.json \
+        --baseline benchmarks/baselines/sqlite-small.json
+
+Drivers: ``client`` calls the app through Flask's test client, ``wsgi``
+serves it with werkzeug's threaded server in this process and ``gunicorn``
+spawns ``gunicorn blogapp:app``. SQL-per-request figures come from the
+app's own /metrics endpoint. The exit status is 1 when a scenario regressed
+against the baseline by more than ``--threshold``.
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlencode
+
+# ``reset`` is requested (unmeasured) before every request of the scenario
+Scenario = namedtuple(
+    "Scenario", "endpoint authenticated request reset", defaults=(None,)
+)
+
+SCENARIOS = {
+    "index": Scenario("main.index", False, lambda rng, n: ("GET", "/", None)),
+    "post": Scenario(
+        "main.post",
+        False,
+        lambda rng, n: ("GET", f"/post/{rng.randint(1, n['posts'])}", None),
+    ),
+    "user": Scenario(
+        "main.user",
+        True,
+        lambda rng, n: ("GET", f"/user/user{rng.randint(1, n['users'])}", None),
+    ),
+    "login": Scenario(
+        "main.login",
+        False,
+        lambda rng, n: (
+            "POST",
+            "/login",
+            {"username": "user1", "password": "password"},
+        ),
+        reset="/logout",
+    ),
+    "create_post": Scenario(
+        "main.user",
+        True,
+        lambda rng, n: (
+            "POST",
+            "/user/user1",
+            {"title": "Benchmark post", "content": "Posted by the benchmark"},
+        ),
+    ),
+    "edit_post": Scenario(
+        "main.edit_post",
+        True,
+        lambda rng, n: (
+            "POST",
+            "/edit_post/1",
+            {"title": "Benchmark edit", "content": f"Edited {rng.random()}"},
+        ),
+    ),
+    "create_comment": Scenario(
+        "main.post",
+        True,
+        lambda rng, n: (
+            "POST",
+            f"/post/{rng.randint(1, n['posts'])}",
+            {"title": "Benchmark comment", "content": "Commented by the benchmark"},
+        ),
+    ),
+}
+
+CSRF_TOKEN = re.compile(rb'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+class Session(object):
+    """A browser-like visitor: keeps cookies and the session's CSRF token."""
+
+    csrf_token = None
+
+    def request(self, method, path, data=None):
+        raise NotImplementedError
+
+    def start(self, authenticated):
+        _, body = self.request("GET", "/login")
+        match = CSRF_TOKEN.search(body)
+        self.csrf_token = match.group(1).decode() if match else None
+        if authenticated:
+            status, _ = self.request(
+                "POST", "/login", {"username": "user1", "password": "password"}
+            )
+            if status != 302:
+                raise RuntimeError(f"Login failed with status {status}")
+
+    def form(self, data):
+        if data is not None and self.csrf_token:
+            data = dict(data, csrf_token=self.csrf_token)
+        return data
+
+
+class ClientSession(Session):
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        response = self.client.open(path, method=method, data=self.form(data))
+        return response.status_code, response.get_data()
+
+
+class HTTPSession(Session):
+    def __init__(self, host, port):
+        self.host, self.port = host, port
+        self.cookies = {}
+
+    def request(self, method, path, data=None):
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        headers = {}
+        if self.cookies:
+            headers["Cookie"] = "; ".join(f"{k}={v}" for k, v in self.cookies.items())
+        body = None
+        if data is not None:
+            body = urlencode(self.form(data))
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            payload = response.read()
+        finally:
+            connection.close()
+        for cookie in response.headers.get_all("Set-Cookie") or ():
+            name, _, value = cookie.split(";", 1)[0].partition("=")
+            self.cookies[name] = value
+        return response.status, payload
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return None
+    index = max(int(round(fraction * len(values) + 0.5)) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def read_metrics(session):
+    """Return ``{endpoint: (requests, sql statements)}`` from /metrics."""
+    _, body = session.request("GET", "/metrics")
+    requests, statements = {}, {}
+    for line in body.decode().splitlines():
+        match = re.match(r'(\w+)\{endpoint="([^"]+)"[^}]*\} ([\d.e+-]+)$', line)
+        if match is None:
+            continue
+        name, endpoint, value = match.group(1), match.group(2), float(match.group(3))
+        if name == "blog_requests_total":
+            requests[endpoint] = requests.get(endpoint, 0) + value
+        elif name == "blog_sql_statements_total":
+            statements[endpoint] = value
+    return {e: (n, statements.get(e, 0)) for e, n in requests.items()}
+
+
+def run_scenario(name, new_session, dataset, requests, concurrency, warmup, seed):
+    scenario = SCENARIOS[name]
+    latencies, errors = [], []
+    lock = threading.Lock()
+    per_worker = [requests // concurrency] * concurrency
+    for i in range(requests % concurrency):
+        per_worker[i] += 1
+
+    sessions = []
+    for _ in range(concurrency):
+        session = new_session()
+        session.start(scenario.authenticated)
+        sessions.append(session)
+    rng = random.Random(seed)
+    for _ in range(warmup):
+        sessions[0].request(*scenario.request(rng, dataset))
+
+    monitor = new_session()
+    before = read_metrics(monitor).get(scenario.endpoint, (0, 0))
+
+    def worker(index):
+        rng = random.Random(seed + index)
+        session, mine = sessions[index], []
+        for _ in range(per_worker[index]):
+            method, path, data = scenario.request(rng, dataset)
+            if scenario.reset:
+                session.request("GET", scenario.reset)
+            started = time.perf_counter()
+            status, _ = session.request(method, path, data)
+            mine.append(time.perf_counter() - started)
+            if status >= 400:
+                with lock:
+                    errors.append(status)
+        with lock:
+            latencies.extend(mine)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    after = read_metrics(monitor).get(scenario.endpoint, (0, 0))
+    served = after[0] - before[0]
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "throughput_rps": len(latencies) / elapsed if elapsed else None,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "sql_per_request": (after[1] - before[1]) / served if served else None,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Return human readable regressions of ``results`` against ``baseline``."""
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get("results", {}).get(name)
+        if previous is None:
+            continue
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            if current[key] > previous[key] * (1 + threshold):
+                regressions.append(
+                    f"{name}: {key} {previous[key]:.2f} -> {current[key]:.2f}"
+                )
+        if current["throughput_rps"] < previous["throughput_rps"] * (1 - threshold):
+            regressions.append(
+                f"{name}: throughput {previous['throughput_rps']:.1f} -> "
+                f"{current['throughput_rps']:.1f} rps"
+            )
+        if (
+            current["sql_per_request"] is not None
+            and previous.get("sql_per_request") is not None
+            and current["sql_per_request"] > previous["sql_per_request"] + 0.01
+        ):
+            regressions.append(
+                f"{name}: SQL per request {previous['sql_per_request']:.2f} -> "
+                f"{current['sql_per_request']:.2f}"
+            )
+    return regressions
+
+
+def start_server(args, app):
+    if args.driver == "wsgi":
+        from werkzeug.serving import make_server
+
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server.server_port, server.shutdown
+    env = dict(
+        os.environ,
+        DATABASE_URL=args.database,
+        METRICS_ENABLED="1",
+        RATELIMIT_ENABLED="1" if args.ratelimit else "0",
+    )
+    process = subprocess.Popen(
+        [
+            "gunicorn",
+            "--bind",
+            f"127.0.0.1:{args.port}",
+            "--workers",
+            "1",
+            "--threads",
+            str(args.concurrency),
+            "blogapp:app",
+        ],
+        env=env,
+    )
+    for _ in range(100):
+        try:
+            http.client.HTTPConnection("127.0.0.1", args.port, timeout=1).connect()
+            break
+        except OSError:
+            time.sleep(0.1)
+    return args.port, process.terminate
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database", required=True, help="SQLAlchemy database URL")
+    parser.add_argument(
+        "--driver", choices=("client", "wsgi", "gunicorn"), default="client"
+    )
+    parser.add_argument("--port", type=int, default=8089, help="gunicorn port")
+    parser.add_argument(
+        "--scenario", action="append", choices=sorted(SCENARIOS), dest="scenarios"
+    )
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    parser.add_argument(
+        "--ratelimit",
+        action="store_true",
+        help="keep the rate limits on (the write scenarios will then see 429s)",
+    )
+    args = parser.parse_args(argv)
+
+    # the config reads the environment at import time
+    os.environ["DATABASE_URL"] = args.database
+    os.environ["METRICS_ENABLED"] = "1"
+    os.environ["RATELIMIT_ENABLED"] = "1" if args.ratelimit else "0"
+    from sqlalchemy import func
+
+    from blog import create_app, db, tasks
+    from blog.models import Posts, Users
+
+    app = create_app()
+    with app.app_context():
+        dataset = {
+            "users": db.session.query(func.max(Users.id)).scalar(),
+            "posts": db.session.query(func.max(Posts.id)).scalar(),
+        }
+    if not dataset["users"] or not dataset["posts"]:
+        parser.error("the database is empty, run benchmarks.seed first")
+
+    stop = None
+    if args.driver == "client":
+        new_session = lambda: ClientSession(app)  # noqa: E731
+    else:
+        port, stop = start_server(args, app)
+        new_session = lambda: HTTPSession("127.0.0.1", port)  # noqa: E731
+    try:
+        results = {}
+        for name in args.scenarios or list(SCENARIOS):
+            results[name] = run_scenario(
+                name,
+                new_session,
+                dataset,
+                args.requests,
+                args.concurrency,
+                args.warmup,
+                args.seed,
+            )
+            print(
+                "{:<15} {:>7.1f} rps  p50 {:>7.2f} ms  p95 {:>7.2f} ms  "
+                "p99 {:>7.2f} ms  sql/req {}  errors {}".format(
+                    name,
+                    results[name]["throughput_rps"],
+                    results[name]["p50_ms"],
+                    results[name]["p95_ms"],
+                    results[name]["p99_ms"],
+                    results[name]["sql_per_request"],
+                    results[name]["errors"],
+                )
+            )
+    finally:
+        if stop is not None:
+            stop()
+        # let background jobs queued by the run finish before exiting
+        with app.app_context():
+            tasks.join(timeout=60)
+
+    report = {
+        "meta": {
+            "date": datetime.utcnow().isoformat(),
+            "driver": args.driver,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "dataset": dataset,
+            "database": args.database.split(":", 1)[0],
+            "python": platform.python_version(),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+"""Bulk seeder for benchmark datasets.
+
+    python -m benchmarks.seed --database sqlite:////tmp/bench.db \
+        --users 10000 --posts 1000000 --comments 10000000
+
+Rows go in through chunked executemany INSERTs; counters and the search
+index are rebuilt once at the end instead of per row. Every user's password
+is ``password``; post 1 always belongs to user 1.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+WORDS = (
+    "flask python garden sunshine coffee morning travel music river mountain "
+    "winter summer code database cache query index window paper story city"
+).split()
+START = datetime(2020, 1, 1)
+POST_INTERVAL = timedelta(seconds=30)
+
+
+def _text(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def _insert(table, rows, chunk_size, label):
+    from blog import db
+
+    started, total, chunk = time.perf_counter(), 0, []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            db.session.execute(table.insert(), chunk)
+            db.session.commit()
+            total += len(chunk)
+            chunk = []
+            print(
+                f"\r{label}: {total} rows, "
+                f"{total / (time.perf_counter() - started):.0f} rows/s",
+                end="",
+                file=sys.stderr,
+            )
+    if chunk:
+        db.session.execute(table.insert(), chunk)
+        db.session.commit()
+        total += len(chunk)
+    print(
+        f"\r{label}: {total} rows in {time.perf_counter() - started:.1f}s",
+        file=sys.stderr,
+    )
+
+
+def seed(users, posts, comments, chunk_size=10000, random_seed=0):
+    from blog import db, search
+    from blog.models import Comments, Posts, Users, make_excerpt
+
+    rng = random.Random(random_seed)
+    db.create_all()
+    prototype = Users()
+    prototype.set_password("password")
+    _insert(
+        Users.__table__,
+        (
+            {
+                "id": i,
+                "username": f"user{i}",
+                "email": f"user{i}@example.com",
+                "password_hash": prototype.password_hash,
+            }
+            for i in range(1, users + 1)
+        ),
+        chunk_size,
+        "users",
+    )
+
+    def post_rows():
+        for i in range(1, posts + 1):
+            content = _text(rng, 60)
+            yield {
+                "id": i,
+                "author_id": 1 if i == 1 else rng.randint(1, users),
+                "title": _text(rng, 4).capitalize(),
+                "content": content,
+                "excerpt": make_excerpt(content),
+                "publication_datetime": START + POST_INTERVAL * i,
+            }
+
+    _insert(
+        Posts.__table__,
+        post_rows(),
+        chunk_size,
+        "posts",
+    )
+
+    def comment_rows():
+        for i in range(1, comments + 1):
+            post_id = rng.randint(1, posts)
+            yield {
+                "id": i,
+                "post_id": post_id,
+                "author_id": rng.randint(1, users),
+                "title": _text(rng, 3).capitalize(),
+                "content": _text(rng, 20),
+                "publication_datetime": START
+                + POST_INTERVAL * post_id
+                + timedelta(seconds=rng.randint(1, 86400)),
+            }
+
+    _insert(Comments.__table__, comment_rows(), chunk_size, "comments")
+    started = time.perf_counter()
+    Posts.reconcile_comment_stats()
+    search.rebuild()
+    db.session.commit()
+    print(
+        f"counters and search index: {time.perf_counter() - started:.1f}s",
+        file=sys.stderr,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database", required=True, help="SQLAlchemy database URL")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--posts", type=int, default=1000)
+    parser.add_argument("--comments", type=int, default=10000)
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    # the config reads the environment at import time
+    os.environ["DATABASE_URL"] = args.database
+    from blog import create_app
+
+    with create_app().app_context():
+        seed(args.users, args.posts, args.comments, args.chunk_size, args.seed)
+
+
+if __name__ == "__main__":
+    main()
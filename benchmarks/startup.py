@@ -0,0 +1,150 @@
+"""Startup benchmark: a fresh process importing the app and serving its first request.
+
+    python -m benchmarks.startup --database sqlite:////tmp/bench.db --runs 10 \
+        --output startup.json --baseline benchmarks/baselines/startup.json
+
+Every run is a new interpreter that imports ``blogapp`` (and so builds the
+app with ``create_app()``), then sends one GET through the test client: the
+import figure is what a worker pays before it can serve, the first request
+adds the first database connection and template compilation. ``total`` is
+measured from outside and includes the interpreter's own startup. The exit
+status is 1 when a median regressed against the baseline by more than
+``--threshold``.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from benchmarks.run import percentile
+
+CHILD = """
+import json, sys, time
+started = time.perf_counter()
+from blogapp import app
+imported = time.perf_counter()
+status = app.test_client().get(sys.argv[1]).status_code
+done = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "first_request_ms": (done - imported) * 1000,
+    "status": status,
+}))
+"""
+FIGURES = ("import_ms", "first_request_ms", "total_ms")
+
+
+def run_once(path, env):
+    started = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD, path],
+        env=env,
+        check=True,
+        stdout=subprocess.PIPE,
+    ).stdout
+    result = json.loads(output.decode().strip().splitlines()[-1])
+    result["total_ms"] = (time.perf_counter() - started) * 1000
+    if result["status"] >= 400:
+        raise RuntimeError(f"GET {path} answered {result['status']}")
+    return result
+
+
+def summarize(runs):
+    summary = {}
+    for figure in FIGURES:
+        values = sorted(run[figure] for run in runs)
+        summary[figure] = {
+            "median": statistics.median(values),
+            "p90": percentile(values, 0.90),
+            "min": values[0],
+        }
+    return summary
+
+
+def compare(summary, baseline, threshold):
+    """Return human readable regressions of ``summary`` against ``baseline``."""
+    regressions = []
+    for figure in FIGURES:
+        previous = baseline.get("results", {}).get(figure)
+        if previous is None:
+            continue
+        if summary[figure]["median"] > previous["median"] * (1 + threshold):
+            regressions.append(
+                f"{figure}: median {previous['median']:.1f} -> "
+                f"{summary[figure]['median']:.1f}"
+            )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database", required=True, help="SQLAlchemy database URL")
+    parser.add_argument("--path", default="/", help="first request")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument(
+        "--cold-templates",
+        action="store_true",
+        help="give every run an empty Jinja bytecode cache",
+    )
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    env = dict(os.environ, DATABASE_URL=args.database, RATELIMIT_ENABLED="0")
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, (os.getcwd(), os.environ.get("PYTHONPATH")))
+    )
+    cache_dir = tempfile.mkdtemp(prefix="blog-startup-")
+    runs = []
+    for n in range(args.warmup + args.runs):
+        if args.cold_templates:
+            cache_dir = tempfile.mkdtemp(prefix="blog-startup-")
+        env["JINJA_BYTECODE_CACHE_DIR"] = cache_dir
+        result = run_once(args.path, env)
+        if n >= args.warmup:
+            runs.append(result)
+    summary = summarize(runs)
+    for figure in FIGURES:
+        print(
+            "{:<17} median {:>8.1f} ms  p90 {:>8.1f} ms  min {:>8.1f} ms".format(
+                figure,
+                summary[figure]["median"],
+                summary[figure]["p90"],
+                summary[figure]["min"],
+            )
+        )
+
+    report = {
+        "meta": {
+            "date": datetime.utcnow().isoformat(),
+            "runs": args.runs,
+            "path": args.path,
+            "cold_templates": args.cold_templates,
+            "database": args.database.split(":", 1)[0],
+            "python": platform.python_version(),
+        },
+        "results": summary,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(summary, json.load(f), args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,17 +1,115 @@
 from flask import Flask
 from flask_bootstrap import Bootstrap
 from flask_login import LoginManager
-from flask_migrate import Migrate
-from flask_sqlalchemy import SQLAlchemy
 
+from blog.cache import Cache
+from blog.database import Database
+from blog.metrics import Metrics
+from blog.ratelimit import RateLimiter
+from blog.tasks import TaskQueue
+from blog.templating import Templates
 from config import Config
 
-app = Flask(__name__)
-app.config.from_object(Config)
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
-login = LoginManager(app)
-login.login_view = "login"
-bootstrap = Bootstrap(app)
+db = Database()
+login = LoginManager()
+login.login_view = "main.login"
+bootstrap = Bootstrap()
+cache = Cache()
+metrics = Metrics()
+limiter = RateLimiter()
+tasks = TaskQueue()
+templates = Templates()
 
-from blog import models, routes
+
+def create_app(config_class=Config):
+    """Build an application. Nothing here connects to the database, so a
+    preloading server can call it once and fork its workers afterwards."""
+    app = Flask(__name__)
+    app.config.from_object(config_class)
+    db.init_app(app)
+    app.extensions["migrate"] = _LazyMigrate(app)
+    login.init_app(app)
+    bootstrap.init_app(app)
+    cache.init_app(app)
+    metrics.init_app(app)
+    limiter.init_app(app)
+    tasks.init_app(app)
+    templates.init_app(app)
+
+    from blog import models, search  # noqa: F401 (registers the search hooks)
+    from blog.api import bp as api_bp
+    from blog.cli import bp as cli_bp
+    from blog.routes import bp as main_bp
+
+    models.init_app(app)
+    app.register_blueprint(main_bp)
+    app.register_blueprint(api_bp, url_prefix="/api/v1")
+    app.register_blueprint(cli_bp)
+    _register_metrics(app, models)
+    return app
+
+
+class _LazyMigrate(object):
+    """Placeholder for Flask-Migrate's state that sets it up on first use.
+
+    Importing Flask-Migrate pulls in alembic, a good part of the app's import
+    time, while only the ``flask db`` commands (the release step) need it.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def __getattr__(self, name):
+        from flask_migrate import Migrate
+
+        Migrate(self.app, db)
+        return getattr(self.app.extensions["migrate"], name)
+
+
+def _register_metrics(app, models):
+    metrics.register(
+        app,
+        "blog_page_cache_lookups_total",
+        "counter",
+        "Anonymous page cache lookups by result.",
+        lambda: [({"result": key}, value) for key, value in cache.stats().items()],
+    )
+    metrics.register(
+        app,
+        "blog_user_cache_lookups_total",
+        "counter",
+        "load_user identity cache lookups by result.",
+        lambda: [
+            ({"result": key}, value)
+            for key, value in models.identity_cache_stats().items()
+            if key in ("hits", "misses")
+        ],
+    )
+    metrics.register(
+        app,
+        "blog_tasks_total",
+        "counter",
+        "Background jobs run, by result.",
+        lambda: [({"result": key}, value) for key, value in tasks.stats().items()],
+    )
+    metrics.register(
+        app,
+        "blog_task_queue_depth",
+        "gauge",
+        "Background jobs waiting or running.",
+        lambda: [({}, len(tasks.backend))],
+    )
+    metrics.register(
+        app,
+        "blog_db_pool_connections",
+        "gauge",
+        "Database pool connections by state.",
+        lambda: [({"state": key}, value) for key, value in db.pool_stats().items()],
+    )
+    metrics.register(
+        app,
+        "blog_ratelimit_rejections_total",
+        "counter",
+        "Requests refused with 429 by endpoint.",
+        lambda: [({"endpoint": key}, value) for key, value in limiter.stats().items()],
+    )
@@ -0,0 +1,332 @@
+from datetime import datetime
+from functools import wraps
+
+from flask import Blueprint, abort, current_app, g, jsonify, request, url_for
+from werkzeug.exceptions import HTTPException
+
+from blog import bulk, cache, db
+from blog.feed import fan_out
+from blog.forms import CreatePostCommentForm, RegistrationForm, from_json
+from blog.models import Comments, Posts, Users
+from blog.pagination import keyset_paginate
+from blog.purge import purge
+
+bp = Blueprint("api", __name__)
+
+# public reads; the email address is only returned to its owner on sign-up,
+# as the site never shows it either
+USER_COLUMNS = (Users.id, Users.username)
+OWN_USER_COLUMNS = USER_COLUMNS + (Users.email,)
+POST_COLUMNS = (
+    Posts.id,
+    Posts.author_id,
+    Posts.title,
+    Posts.content,
+    Posts.publication_datetime,
+    Posts.comment_count,
+)
+COMMENT_COLUMNS = (
+    Comments.id,
+    Comments.post_id,
+    Comments.author_id,
+    Comments.title,
+    Comments.content,
+    Comments.publication_datetime,
+)
+
+
+def to_dict(row, columns):
+    """Serialize a row tuple (or a model instance) restricted to ``columns``."""
+    data = {}
+    for column in columns:
+        value = getattr(row, column.key)
+        data[column.key] = value.isoformat() if isinstance(value, datetime) else value
+    return data
+
+
+@bp.errorhandler(HTTPException)
+def handle_http_exception(e):
+    if e.response is not None:
+        return e.response
+    response = jsonify(error=e.name, message=e.description)
+    response.status_code = e.code
+    if getattr(e, "retry_after", None) is not None:
+        response.headers["Retry-After"] = str(e.retry_after)
+    if e.code == 401:
+        response.headers["WWW-Authenticate"] = 'Basic realm="api"'
+    return response
+
+
+def auth_required(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        auth = request.authorization
+        user = None
+        if auth is not None and auth.username and auth.password:
+            user = Users.query.filter_by(username=auth.username).first()
+        if user is None or not user.check_password(auth.password):
+            abort(401)
+        if db.session.is_modified(user):
+            db.session.commit()
+        g.current_user = user
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+def validated(form_class, data):
+    form, errors = from_json(form_class, data)
+    if errors:
+        response = jsonify(error="Bad Request", message=errors)
+        response.status_code = 400
+        abort(response)
+    return form
+
+
+def json_body():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(400, "Expected a JSON object")
+    return data
+
+
+def paginated(query, model, columns, endpoint, descending=True, **values):
+    per_page = min(
+        request.args.get("per_page", current_app.config["POSTS_PER_PAGE"], type=int),
+        current_app.config["API_MAX_PER_PAGE"],
+    )
+    page = keyset_paginate(
+        query,
+        (model.publication_datetime, model.id),
+        max(per_page, 1),
+        after=request.args.get("after"),
+        before=request.args.get("before"),
+        descending=descending,
+    )
+    return jsonify(
+        items=[to_dict(row, columns) for row in page],
+        next=(
+            url_for(endpoint, after=page.next_cursor, per_page=per_page, **values)
+            if page.has_next
+            else None
+        ),
+        prev=(
+            url_for(endpoint, before=page.prev_cursor, per_page=per_page, **values)
+            if page.has_prev
+            else None
+        ),
+    )
+
+
+def batch_items():
+    items = json_body().get("items")
+    if not isinstance(items, list) or not items:
+        abort(400, "Expected a non-empty list of items")
+    if len(items) > current_app.config["API_MAX_BATCH_SIZE"]:
+        abort(413, f"At most {current_app.config['API_MAX_BATCH_SIZE']} items per call")
+    return items
+
+
+def batch_response(results):
+    created = sum("id" in result for result in results)
+    response = jsonify(
+        created=created, rejected=len(results) - created, results=results
+    )
+    if created == len(results):
+        response.status_code = 201
+    else:
+        # some items went in and some didn't, see their results
+        response.status_code = 207 if created else 400
+    return response
+
+
+def owned(model, ident):
+    obj = model.query.get_or_404(ident)
+    if (obj if model is Posts else obj.post).is_deleted:
+        abort(404)
+    if obj.author_id != g.current_user.id:
+        abort(403)
+    return obj
+
+
+@bp.route("/users", methods=["POST"])
+def create_user():
+    data = json_body()
+    form = validated(RegistrationForm, dict(data, password2=data.get("password")))
+    user = Users(username=form.username.data, email=form.email.data)
+    user.set_password(form.password.data)
+    db.session.add(user)
+    db.session.commit()
+    return jsonify(to_dict(user, OWN_USER_COLUMNS)), 201
+
+
+@bp.route("/users/<int:user_id>")
+def get_user(user_id):
+    row = db.session.query(*USER_COLUMNS).filter(Users.id == user_id).first()
+    if row is None:
+        abort(404)
+    return jsonify(to_dict(row, USER_COLUMNS))
+
+
+@bp.route("/users/<int:user_id>/posts")
+def list_user_posts(user_id):
+    query = db.session.query(*POST_COLUMNS).filter(
+        Posts.author_id == user_id, Posts.deleted_at.is_(None)
+    )
+    return paginated(query, Posts, POST_COLUMNS, "api.list_user_posts", user_id=user_id)
+
+
+@bp.route("/posts")
+def list_posts():
+    query = db.session.query(*POST_COLUMNS).filter(Posts.deleted_at.is_(None))
+    return paginated(query, Posts, POST_COLUMNS, "api.list_posts")
+
+
+@bp.route("/posts/<int:post_id>")
+def get_post(post_id):
+    row = (
+        db.session.query(*POST_COLUMNS)
+        .filter(Posts.id == post_id, Posts.deleted_at.is_(None))
+        .first()
+    )
+    if row is None:
+        abort(404)
+    return jsonify(to_dict(row, POST_COLUMNS))
+
+
+@bp.route("/posts", methods=["POST"])
+@auth_required
+def create_post():
+    form = validated(CreatePostCommentForm, json_body())
+    post = Posts(
+        title=form.title.data, content=form.content.data, author=g.current_user
+    )
+    db.session.add(post)
+    db.session.commit()
+    cache.invalidate("feed")
+    fan_out.delay(post.id)
+    return jsonify(to_dict(post, POST_COLUMNS)), 201
+
+
+@bp.route("/posts/batch", methods=["POST"])
+@auth_required
+def create_posts():
+    results = bulk.create_posts(g.current_user, batch_items())
+    if any("id" in result for result in results):
+        cache.invalidate("feed")
+    return batch_response(results)
+
+
+@bp.route("/posts/<int:post_id>", methods=["PUT"])
+@auth_required
+def update_post(post_id):
+    post = owned(Posts, post_id)
+    form = validated(CreatePostCommentForm, json_body())
+    post.title = form.title.data
+    post.content = form.content.data
+    post.publication_datetime = datetime.utcnow()
+    db.session.commit()
+    cache.invalidate("feed", f"post:{post.id}")
+    return jsonify(to_dict(post, POST_COLUMNS))
+
+
+@bp.route("/posts/<int:post_id>", methods=["DELETE"])
+@auth_required
+def delete_post(post_id):
+    post = owned(Posts, post_id)
+    post.mark_deleted()
+    db.session.commit()
+    cache.invalidate("feed", f"post:{post_id}")
+    purge.delay()
+    return "", 204
+
+
+@bp.route("/posts/<int:post_id>/comments")
+def list_comments(post_id):
+    if (
+        db.session.query(Posts.id)
+        .filter(Posts.id == post_id, Posts.deleted_at.is_(None))
+        .first()
+        is None
+    ):
+        abort(404)
+    query = db.session.query(*COMMENT_COLUMNS).filter(Comments.post_id == post_id)
+    return paginated(
+        query,
+        Comments,
+        COMMENT_COLUMNS,
+        "api.list_comments",
+        descending=False,
+        post_id=post_id,
+    )
+
+
+@bp.route("/posts/<int:post_id>/comments", methods=["POST"])
+@auth_required
+def create_comment(post_id):
+    post = Posts.query.filter_by(id=post_id, deleted_at=None).first_or_404()
+    form = validated(CreatePostCommentForm, json_body())
+    comment = Comments(
+        title=form.title.data,
+        content=form.content.data,
+        author=g.current_user,
+        post=post,
+    )
+    db.session.add(comment)
+    post.comment_added(comment)
+    db.session.commit()
+    cache.invalidate("feed", f"post:{post.id}")
+    return jsonify(to_dict(comment, COMMENT_COLUMNS)), 201
+
+
+@bp.route("/comments/batch", methods=["POST"])
+@auth_required
+def create_comments():
+    items = batch_items()
+    results = bulk.create_comments(g.current_user, items)
+    post_ids = {
+        item["post_id"] for item, result in zip(items, results) if "id" in result
+    }
+    if post_ids:
+        cache.invalidate("feed", *(f"post:{post_id}" for post_id in post_ids))
+    return batch_response(results)
+
+
+@bp.route("/comments/<int:comment_id>")
+def get_comment(comment_id):
+    row = (
+        db.session.query(*COMMENT_COLUMNS)
+        .join(Posts, Posts.id == Comments.post_id)
+        .filter(Comments.id == comment_id, Posts.deleted_at.is_(None))
+        .first()
+    )
+    if row is None:
+        abort(404)
+    return jsonify(to_dict(row, COMMENT_COLUMNS))
+
+
+@bp.route("/comments/<int:comment_id>", methods=["PUT"])
+@auth_required
+def update_comment(comment_id):
+    comment = owned(Comments, comment_id)
+    form = validated(CreatePostCommentForm, json_body())
+    comment.title = form.title.data
+    comment.content = form.content.data
+    comment.publication_datetime = datetime.utcnow()
+    comment.post.last_comment_at = comment.publication_datetime
+    db.session.commit()
+    cache.invalidate("feed", f"post:{comment.post_id}")
+    return jsonify(to_dict(comment, COMMENT_COLUMNS))
+
+
+@bp.route("/comments/<int:comment_id>", methods=["DELETE"])
+@auth_required
+def delete_comment(comment_id):
+    comment = owned(Comments, comment_id)
+    post = comment.post
+    db.session.delete(comment)
+    db.session.flush()
+    post.comment_removed()
+    db.session.commit()
+    cache.invalidate("feed", f"post:{post.id}")
+    return "", 204
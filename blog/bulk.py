@@ -0,0 +1,155 @@
+"""Many posts or comments per call, written in one transaction.
+
+Every item is checked with the rules of ``CreatePostCommentForm``, like a
+single create; the valid ones are inserted with one executemany (on PostgreSQL
+and SQLite) and committed once, so a batch pays one commit (and one fsync)
+instead of one per item. Invalid items are skipped and reported: the results
+come back in the order of the items, ``{"id": ...}`` for a created row and
+``{"errors": {...}}`` for a rejected one. Feed delivery and, on SQLite, search
+indexing run as one background job per batch.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import func, inspect, select
+
+from blog import db, search
+from blog.feed import fan_out_all
+from blog.forms import CreatePostCommentForm, from_json
+from blog.models import Comments, Posts, make_excerpt
+
+
+def _validate(item):
+    """Return ``(form, errors)`` for one item, as the create endpoints would."""
+    if not isinstance(item, dict):
+        return None, {"item": ["Expected a JSON object."]}
+    return from_json(CreatePostCommentForm, item)
+
+
+def _insert(model, author, results, rows):
+    """Insert ``rows`` (pairs of result index and mapping) and fill in their ids.
+
+    PostgreSQL and SQLite get one executemany; other databases one INSERT per
+    row, which reports its own id.
+    """
+    table = model.__table__
+    mappings = [mapping for _, mapping in rows]
+    dialect = db.session.get_bind(mapper=inspect(model)).dialect.name
+    if dialect == "postgresql":
+        # take the ids from the sequence first, concurrent inserts may interleave
+        ids = [
+            ident
+            for ident, in db.session.execute(
+                select(
+                    [func.nextval(func.pg_get_serial_sequence(table.name, "id"))]
+                ).select_from(func.generate_series(1, len(mappings)))
+            )
+        ]
+        for mapping, ident in zip(mappings, ids):
+            mapping["id"] = ident
+        db.session.execute(table.insert(), mappings)
+    elif dialect == "sqlite":
+        db.session.execute(table.insert(), mappings)
+        # the transaction holds the database's only write lock since the
+        # INSERT and rowids are handed out in ascending order, so the
+        # author's newest rows are the ones just inserted
+        ids = [
+            ident
+            for ident, in db.session.execute(
+                select([table.c.id])
+                .where(table.c.author_id == author.id)
+                .order_by(table.c.id.desc())
+                .limit(len(mappings))
+            )
+        ][::-1]
+    else:
+        ids = [
+            db.session.execute(table.insert(), mapping).inserted_primary_key[0]
+            for mapping in mappings
+        ]
+    for (index, _), ident in zip(rows, ids):
+        results[index] = {"id": ident}
+    return ids
+
+
+def create_posts(author, items):
+    """Create the valid ``items`` as posts of ``author``; returns the results."""
+    results, rows = [], []
+    for index, item in enumerate(items):
+        form, errors = _validate(item)
+        results.append({"errors": errors})
+        if form is not None:
+            rows.append(
+                (
+                    index,
+                    {
+                        "author_id": author.id,
+                        "title": form.title.data,
+                        "content": form.content.data,
+                        "excerpt": make_excerpt(form.content.data),
+                        "publication_datetime": datetime.utcnow(),
+                    },
+                )
+            )
+    if rows:
+        ids = _insert(Posts, author, results, rows)
+        db.session.commit()
+        fan_out_all.delay(ids)
+        search.refresh(ids, [])
+    return results
+
+
+def create_comments(author, items):
+    """Create the valid ``items`` as comments of ``author`` on the posts named by
+    their ``post_id``; returns the results."""
+    results, rows = [], []
+    for index, item in enumerate(items):
+        form, errors = _validate(item)
+        results.append({"errors": errors})
+        post_id = item.get("post_id") if isinstance(item, dict) else None
+        if not isinstance(post_id, int) or isinstance(post_id, bool):
+            errors = dict(errors or {}, post_id=["Expected the id of a post."])
+            results[index] = {"errors": errors}
+        elif form is not None:
+            rows.append(
+                (
+                    index,
+                    {
+                        "post_id": post_id,
+                        "author_id": author.id,
+                        "title": form.title.data,
+                        "content": form.content.data,
+                        "publication_datetime": datetime.utcnow(),
+                    },
+                )
+            )
+    if rows:
+        live = {
+            ident
+            for ident, in db.session.query(Posts.id).filter(
+                Posts.id.in_({mapping["post_id"] for _, mapping in rows}),
+                Posts.deleted_at.is_(None),
+            )
+        }
+        for index, mapping in rows:
+            if mapping["post_id"] not in live:
+                results[index] = {"errors": {"post_id": ["No such post."]}}
+        rows = [row for row in rows if row[1]["post_id"] in live]
+    if rows:
+        ids = _insert(Comments, author, results, rows)
+        added = {}
+        for _, mapping in rows:
+            count = added.get(mapping["post_id"], (0,))[0]
+            added[mapping["post_id"]] = (count + 1, mapping["publication_datetime"])
+        # what Posts.comment_added() does, once per post
+        for post_id, (count, newest) in sorted(added.items()):
+            Posts.query.filter(Posts.id == post_id).update(
+                {
+                    Posts.comment_count: Posts.comment_count + count,
+                    Posts.last_comment_at: newest,
+                },
+                synchronize_session=False,
+            )
+        db.session.commit()
+        search.refresh([], ids)
+    return results
@@ -0,0 +1,244 @@
+import math
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, request, session
+from flask_login import current_user
+
+from blog.database import replica_lag
+
+
+class MemoryBackend(object):
+    """In-process store with per-entry TTL and LRU eviction.
+
+    Generation counters live apart from the entries so that evicting a page
+    can never roll back an invalidation.
+    """
+
+    def __init__(self, threshold=500, default_timeout=300):
+        self.threshold = threshold
+        self.default_timeout = default_timeout
+        self._entries = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, timeout=None):
+        expires = time.monotonic() + (timeout or self.default_timeout)
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.threshold:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def get_counter(self, key):
+        return self._counters.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._counters.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+class RedisBackend(object):
+    """Store shared by every worker, backed by a redis-compatible client."""
+
+    def __init__(self, client, default_timeout=300, prefix="blog:"):
+        self.client = client
+        self.default_timeout = default_timeout
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        import redis
+
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else pickle.loads(value)
+
+    def set(self, key, value, timeout=None):
+        self.client.set(
+            self.prefix + key, pickle.dumps(value), ex=timeout or self.default_timeout
+        )
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def get_counter(self, key):
+        return int(self.client.get(self.prefix + key) or 0)
+
+    def incr(self, key):
+        return self.client.incr(self.prefix + key)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(self.prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+
+class _CacheState(object):
+    """What a ``Cache`` keeps per application."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+
+class Cache(object):
+    """Response cache for anonymous GET pages.
+
+    Pages are grouped into namespaces (``"feed"``, ``"post:<id>"``) and every
+    namespace carries a generation counter; invalidating a namespace bumps its
+    generation, which orphans all of its pages at once whatever their query
+    string. Orphans then age out through TTL/LRU. The backend and the counts
+    belong to the application (``app.extensions["cache"]``).
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("CACHE_TYPE", "simple")
+        app.config.setdefault("CACHE_DEFAULT_TIMEOUT", 300)
+        app.config.setdefault("CACHE_THRESHOLD", 500)
+        app.config.setdefault("CACHE_REDIS_URL", None)
+        cache_type = app.config["CACHE_TYPE"]
+        timeout = app.config["CACHE_DEFAULT_TIMEOUT"]
+        if cache_type == "simple":
+            backend = MemoryBackend(app.config["CACHE_THRESHOLD"], timeout)
+        elif cache_type == "redis":
+            backend = RedisBackend.from_url(
+                app.config["CACHE_REDIS_URL"], default_timeout=timeout
+            )
+        elif cache_type == "null":
+            backend = None
+        else:
+            raise ValueError(f"Unknown CACHE_TYPE {cache_type!r}")
+        app.extensions["cache"] = _CacheState(backend)
+
+    @staticmethod
+    def _state():
+        return current_app.extensions["cache"]
+
+    @property
+    def backend(self):
+        return self._state().backend
+
+    def stats(self):
+        state = self._state()
+        return {"hits": state.hits, "misses": state.misses}
+
+    def invalidate(self, *namespaces):
+        if self.backend is None:
+            return
+        lag = replica_lag(current_app)
+        for namespace in namespaces:
+            self.backend.incr(f"gen:{namespace}")
+            if lag:
+                # a replica may serve the old rows for a while yet, so pages
+                # rendered meanwhile must not become the new cached version
+                self.backend.set(f"held:{namespace}", True, math.ceil(lag))
+
+    def invalidate_all(self):
+        self.invalidate("*")
+
+    def clear(self):
+        state = self._state()
+        state.hits = state.misses = 0
+        if state.backend is not None:
+            state.backend.clear()
+
+    def _key(self, namespace):
+        return "page:{}:{}:{}:{}".format(
+            self.backend.get_counter("gen:*"),
+            namespace,
+            self.backend.get_counter(f"gen:{namespace}"),
+            request.full_path,
+        )
+
+    def _cacheable(self):
+        return (
+            self.backend is not None
+            and request.method == "GET"
+            and "_flashes" not in session
+            and current_user.is_anonymous
+        )
+
+    def _held(self, namespace):
+        if not replica_lag(current_app):
+            return False
+        return any(
+            self.backend.get(f"held:{name}") is not None for name in (namespace, "*")
+        )
+
+    def cached(self, namespace, timeout=None):
+        """Cache the view for anonymous visitors under ``namespace``.
+
+        ``namespace`` may be a callable receiving the view arguments.
+        """
+
+        def decorator(view):
+            @wraps(view)
+            def wrapper(**kwargs):
+                if not self._cacheable():
+                    return view(**kwargs)
+                name = namespace(**kwargs) if callable(namespace) else namespace
+                key = self._key(name)
+                entry = self.backend.get(key)
+                if entry is not None:
+                    self._state().hits += 1
+                    body, headers = entry
+                    response = current_app.response_class(body, headers=headers)
+                    response.headers["X-Cache"] = "HIT"
+                    return response.make_conditional(request)
+                self._state().misses += 1
+                response = current_app.make_response(view(**kwargs))
+                if (
+                    response.status_code == 200
+                    and not response.is_streamed
+                    and not session.modified
+                    and not self._held(name)
+                ):
+                    self.backend.set(
+                        key, (response.get_data(), list(response.headers)), timeout
+                    )
+                response.headers["X-Cache"] = "MISS"
+                return response
+
+            return wrapper
+
+        return decorator
@@ -0,0 +1,115 @@
+import json
+
+import click
+from flask import Blueprint
+from sqlalchemy.exc import IntegrityError
+
+from blog import bulk, db, search, transfer
+from blog.models import Posts, Users
+from blog.purge import purge
+
+bp = Blueprint("cli", __name__, cli_group=None)
+
+
+@bp.cli.command("reconcile-counters")
+def reconcile_counters():
+    """Backfill comment_count and last_comment_at on every post."""
+    updated = Posts.reconcile_comment_stats()
+    db.session.commit()
+    click.echo(f"Reconciled comment counters of {updated} posts.")
+
+
+@bp.cli.command("search-rebuild")
+def search_rebuild():
+    """Rebuild the full-text search index from scratch."""
+    indexed = search.rebuild()
+    db.session.commit()
+    click.echo(f"Indexed {indexed} posts and comments.")
+
+
+@bp.cli.command("purge")
+def purge_deleted():
+    """Remove deleted posts that are still waiting for their purge job."""
+    click.echo(f"Purged {purge()} deleted posts.")
+
+
+def _report(message):
+    click.echo(message, err=True)
+
+
+@bp.cli.command("export")
+@click.argument("table", type=click.Choice(sorted(transfer.TABLES)))
+@click.argument("output", type=click.File("w"), default="-")
+@click.option("--format", "fmt", type=click.Choice(transfer.FORMATS), default="ndjson")
+@click.option("--chunk-size", type=click.IntRange(min=1), default=1000)
+def export(table, output, fmt, chunk_size):
+    """Stream every row of TABLE to OUTPUT as NDJSON or CSV."""
+    progress = transfer.export_rows(table, output, fmt, chunk_size, _report)
+    _report(f"Exported {progress.rows} {table} ({progress.rate:.0f} rows/s).")
+
+
+@bp.cli.command("import")
+@click.argument("table", type=click.Choice(sorted(transfer.TABLES)))
+@click.argument("source", type=click.File("r"), default="-")
+@click.option("--format", "fmt", type=click.Choice(transfer.FORMATS), default="ndjson")
+@click.option("--chunk-size", type=click.IntRange(min=1), default=1000)
+def import_(table, source, fmt, chunk_size):
+    """Bulk insert the rows of an export of TABLE, keeping their ids.
+
+    Import users first, then posts, then comments.
+    """
+    try:
+        progress = transfer.import_rows(table, source, fmt, chunk_size, _report)
+    except (ValueError, IntegrityError) as e:
+        raise click.ClickException(str(e).splitlines()[0])
+    if table != "users":
+        search.rebuild()
+        db.session.commit()
+    _report(f"Imported {progress.rows} {table} ({progress.rate:.0f} rows/s).")
+
+
+def _batches(source, size):
+    batch = []
+    for line in source:
+        if not line.strip():
+            continue
+        try:
+            batch.append(json.loads(line))
+        except ValueError:
+            batch.append(None)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+@bp.cli.command("bulk-create")
+@click.argument("kind", type=click.Choice(["posts", "comments"]))
+@click.argument("username")
+@click.argument("source", type=click.File("r"), default="-")
+@click.option("--batch-size", type=click.IntRange(min=1), default=500)
+def bulk_create(kind, username, source, batch_size):
+    """Create the posts or comments of USERNAME read from NDJSON, one
+    transaction per batch.
+
+    Lines hold a title and content, and for comments a post_id; lines that
+    fail validation are reported and skipped.
+    """
+    author = Users.query.filter_by(username=username).first()
+    if author is None:
+        raise click.ClickException(f"No user {username!r}")
+    create = bulk.create_posts if kind == "posts" else bulk.create_comments
+    progress = transfer.Progress(kind, _report)
+    items = rejected = 0
+    for batch in _batches(source, batch_size):
+        results = create(author, batch)
+        for number, result in enumerate(results, items + 1):
+            if "errors" in result:
+                rejected += 1
+                _report(f"item {number}: {json.dumps(result['errors'])}")
+        items += len(results)
+        progress.add(sum("id" in result for result in results))
+    _report(f"Created {progress.rows} {kind} ({progress.rate:.0f} rows/s).")
+    if rejected:
+        raise click.ClickException(f"{rejected} {kind} were rejected")
@@ -0,0 +1,43 @@
+import hashlib
+import time
+
+from flask import current_app, request, session
+from flask_login import current_user
+from werkzeug.http import is_resource_modified
+
+
+def viewer_state():
+    """Part of the validators that depends on who is looking at the page.
+
+    Signed-in pages embed a CSRF token that expires after
+    ``WTF_CSRF_TIME_LIMIT``, so their validators roll over with it.
+    """
+    if current_user.is_anonymous:
+        return "anonymous"
+    time_limit = current_app.config.get("WTF_CSRF_TIME_LIMIT", 3600)
+    window = int(time.time() // time_limit) if time_limit else 0
+    return f"user:{current_user.get_id()}:{window}"
+
+
+def make_etag(*parts):
+    data = "|".join(str(part) for part in parts + (viewer_state(),))
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+def set_validators(response, etag):
+    # no Last-Modified: deletions and renames can move the newest timestamp
+    # on a page backwards, and a client sending only If-Modified-Since would
+    # then keep a stale copy
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    response.vary.add("Cookie")
+    return response
+
+
+def not_modified(etag):
+    """Return a 304 response when the client's copy is still fresh, else None."""
+    if request.method not in ("GET", "HEAD") or "_flashes" in session:
+        return None
+    if is_resource_modified(request.environ, etag=etag):
+        return None
+    return set_validators(current_app.response_class(status=304), etag)
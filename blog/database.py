@@ -0,0 +1,142 @@
+import time
+
+from flask import has_request_context, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import event, orm
+from sqlalchemy.pool import QueuePool
+
+# Flask session key holding the time until which a visitor reads from the
+# primary because they wrote something
+PRIMARY_UNTIL = "_primary_until"
+
+
+def _is_memory(sa_url):
+    return sa_url.database in (None, "", ":memory:")
+
+
+def replica_lag(app):
+    """Seconds the replica may lag behind, or 0 when there's no replica."""
+    if "replica" not in (app.config["SQLALCHEMY_BINDS"] or ()):
+        return 0
+    return app.config["REPLICA_LAG_SECONDS"]
+
+
+class RoutingSession(SignallingSession):
+    """Session that reads from the ``replica`` bind while serving GET requests.
+
+    Everything else goes to the primary: other methods, work outside of a
+    request (CLI commands, background jobs), the rest of a transaction that
+    has flushed, and every request of a visitor who committed a write less
+    than ``REPLICA_LAG_SECONDS`` ago, so that they see their own changes.
+    """
+
+    def __init__(self, db, **options):
+        self._db = db
+        super(RoutingSession, self).__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._reads_from_replica():
+            return self._db.get_engine(self.app, bind="replica")
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+    def _reads_from_replica(self):
+        return (
+            not self._flushing
+            and not self.info.get("wrote")
+            and replica_lag(self.app) > 0
+            and has_request_context()
+            and request.method in ("GET", "HEAD")
+            and session.get(PRIMARY_UNTIL, 0) < time.time()
+        )
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def _wrote(db_session, flush_context):
+    db_session.info["wrote"] = True
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _stick_to_primary(db_session):
+    if not db_session.info.pop("wrote", False) or not has_request_context():
+        return
+    lag = replica_lag(db_session.app)
+    if lag:
+        session[PRIMARY_UNTIL] = time.time() + lag
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def _discard_writes(db_session):
+    db_session.info.pop("wrote", None)
+
+
+class Database(SQLAlchemy):
+    """``SQLAlchemy`` with pool and driver settings taken from the config.
+
+    Sessions are ``RoutingSession``s, which send GET requests' reads to the
+    ``replica`` bind when ``SQLALCHEMY_BINDS`` has one. Server databases get
+    a ``QueuePool`` sized by ``DATABASE_POOL_*`` and an optional statement
+    timeout. SQLite files get a pool of long-lived connections too (instead
+    of Flask-SQLAlchemy's ``NullPool``) so that the ``SQLITE_PRAGMAS`` run
+    once per connection rather than once per request.
+    """
+
+    def init_app(self, app):
+        app.config.setdefault("DATABASE_POOL_SIZE", 5)
+        app.config.setdefault("DATABASE_MAX_OVERFLOW", 10)
+        app.config.setdefault("DATABASE_POOL_TIMEOUT", 30)
+        app.config.setdefault("DATABASE_POOL_RECYCLE", 1800)
+        app.config.setdefault("DATABASE_POOL_PRE_PING", True)
+        app.config.setdefault("DATABASE_STATEMENT_TIMEOUT_MS", 0)
+        app.config.setdefault("SQLITE_PRAGMAS", {})
+        app.config.setdefault("REPLICA_LAG_SECONDS", 5)
+        super(Database, self).init_app(app)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        super(Database, self).apply_driver_hacks(app, sa_url, options)
+        config = app.config
+        if sa_url.drivername.startswith("sqlite"):
+            if _is_memory(sa_url) or not config["DATABASE_POOL_SIZE"]:
+                return
+            options["poolclass"] = QueuePool
+            # the pool hands a connection to one thread at a time
+            options.setdefault("connect_args", {})["check_same_thread"] = False
+        else:
+            options["pool_pre_ping"] = config["DATABASE_POOL_PRE_PING"]
+            options["pool_recycle"] = config["DATABASE_POOL_RECYCLE"]
+        options["pool_size"] = config["DATABASE_POOL_SIZE"]
+        options["max_overflow"] = config["DATABASE_MAX_OVERFLOW"]
+        options["pool_timeout"] = config["DATABASE_POOL_TIMEOUT"]
+        timeout = config["DATABASE_STATEMENT_TIMEOUT_MS"]
+        if timeout and sa_url.drivername.startswith("postgresql"):
+            connect_args = options.setdefault("connect_args", {})
+            connect_args["options"] = f"-c statement_timeout={int(timeout)}"
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super(Database, self).create_engine(sa_url, engine_opts)
+        pragmas = self.get_app().config["SQLITE_PRAGMAS"]
+        if sa_url.drivername.startswith("sqlite") and pragmas:
+
+            @event.listens_for(engine, "connect")
+            def _set_pragmas(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                for name, value in pragmas.items():
+                    cursor.execute(f"PRAGMA {name} = {value}")
+                cursor.close()
+
+        return engine
+
+    def pool_stats(self):
+        """Connections of the default engine's pool by state; empty for pools
+        that don't keep connections (in-memory SQLite, ``NullPool``)."""
+        pool = self.engine.pool
+        if not isinstance(pool, QueuePool):
+            return {}
+        return {
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "checked_in": pool.checkedin(),
+            "overflow": max(pool.overflow(), 0),
+        }
@@ -0,0 +1,158 @@
+"""Personal feeds: the reader's own posts and those of the authors they follow.
+
+A new post is copied into ``feed_entries`` for its author and every follower
+by a background job, and each of those feeds is trimmed to ``FEED_LENGTH``
+entries, so reading a page is one range scan of
+``ix_feed_entries_user_id_publication_datetime``. Authors with more than
+``FEED_FANOUT_LIMIT`` followers aren't fanned out; their posts are merged into
+their followers' feeds when a page is read instead.
+"""
+
+from flask import current_app
+from sqlalchemy import and_, exists, literal, or_, select, union
+from sqlalchemy.orm import aliased, joinedload
+
+from blog import db, tasks
+from blog.models import LIST_COLUMNS, FeedEntry, Posts, Users, followers
+
+ENTRY_COLUMNS = ("user_id", "post_id", "publication_datetime")
+
+
+def _fans_out(author):
+    return author.follower_count <= current_app.config["FEED_FANOUT_LIMIT"]
+
+
+def _not_delivered(user_id, post_id):
+    return ~exists().where(
+        and_(FeedEntry.user_id == user_id, FeedEntry.post_id == post_id)
+    )
+
+
+def _trim(readers):
+    """Drop everything past the newest ``FEED_LENGTH`` entries of ``readers``."""
+    newest = aliased(FeedEntry)
+    cutoff = (
+        db.session.query(newest.publication_datetime)
+        .filter(newest.user_id == FeedEntry.user_id)
+        .order_by(newest.publication_datetime.desc())
+        .offset(current_app.config["FEED_LENGTH"])
+        .limit(1)
+        .as_scalar()
+    )
+    FeedEntry.query.filter(readers, FeedEntry.publication_datetime <= cutoff).delete(
+        synchronize_session=False
+    )
+
+
+def _deliver(post):
+    readers = select([literal(post.author_id).label("user_id")])
+    if _fans_out(post.author):
+        readers = readers.union(
+            select([followers.c.follower_id]).where(
+                followers.c.followed_id == post.author_id
+            )
+        )
+    readers = readers.alias("readers")
+    deliveries = select(
+        [
+            readers.c.user_id,
+            literal(post.id),
+            literal(post.publication_datetime, db.DateTime),
+        ]
+    ).where(_not_delivered(readers.c.user_id, post.id))
+    db.session.execute(
+        FeedEntry.__table__.insert().from_select(ENTRY_COLUMNS, deliveries)
+    )
+
+
+def _audience(author_id):
+    return or_(
+        FeedEntry.user_id == author_id,
+        FeedEntry.user_id.in_(
+            select([followers.c.follower_id]).where(
+                followers.c.followed_id == author_id
+            )
+        ),
+    )
+
+
+@tasks.task
+def fan_out(post_id):
+    fan_out_all([post_id])
+
+
+@tasks.task
+def fan_out_all(post_ids):
+    """Deliver several new posts in one transaction."""
+    posts = Posts.query.filter(Posts.id.in_(post_ids), Posts.deleted_at.is_(None))
+    authors = set()
+    for post in posts.order_by(Posts.id).all():
+        _deliver(post)
+        authors.add(post.author_id)
+    for author_id in sorted(authors):
+        _trim(_audience(author_id))
+    db.session.commit()
+
+
+@tasks.task
+def backfill(follower_id, followed_id):
+    """Deliver the recent posts of a newly followed author."""
+    author = Users.query.get(followed_id)
+    if author is None or not _fans_out(author):
+        return
+    recent = (
+        select([literal(follower_id), Posts.id, Posts.publication_datetime])
+        .where(Posts.author_id == followed_id)
+        .where(Posts.deleted_at.is_(None))
+        .where(_not_delivered(follower_id, Posts.id))
+        .order_by(Posts.publication_datetime.desc())
+        .limit(current_app.config["FEED_LENGTH"])
+    )
+    db.session.execute(FeedEntry.__table__.insert().from_select(ENTRY_COLUMNS, recent))
+    _trim(FeedEntry.user_id == follower_id)
+    db.session.commit()
+
+
+@tasks.task
+def withdraw(follower_id, followed_id):
+    """Remove an unfollowed author's posts from the follower's feed."""
+    FeedEntry.query.filter(
+        FeedEntry.user_id == follower_id,
+        FeedEntry.post_id.in_(select([Posts.id]).where(Posts.author_id == followed_id)),
+    ).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def feed_query(user):
+    """Return ``(query, keyset columns)`` over the feed entries of ``user``."""
+    celebrities = [
+        ident
+        for ident, in db.session.query(followers.c.followed_id)
+        .join(Users, Users.id == followers.c.followed_id)
+        .filter(
+            followers.c.follower_id == user.id,
+            Users.follower_count > current_app.config["FEED_FANOUT_LIMIT"],
+        )
+    ]
+    entry = FeedEntry
+    if celebrities:
+        delivered = select([getattr(FeedEntry, c) for c in ENTRY_COLUMNS]).where(
+            FeedEntry.user_id == user.id
+        )
+        pulled = select(
+            [literal(user.id).label("user_id"), Posts.id, Posts.publication_datetime]
+        ).where(Posts.author_id.in_(celebrities))
+        entry = aliased(FeedEntry, union(delivered, pulled).alias("feed"))
+    query = (
+        db.session.query(entry)
+        .filter(entry.user_id == user.id)
+        # deleted posts wait for the purge to leave the feeds
+        .filter(
+            entry.post_id.notin_(select([Posts.id]).where(Posts.deleted_at.isnot(None)))
+        )
+        .options(
+            joinedload(entry.post).load_only(*LIST_COLUMNS),
+            joinedload(entry.post).joinedload(Posts.author).load_only("username"),
+        )
+    )
+    return query, (entry.publication_datetime, entry.post_id)
@@ -1,4 +1,5 @@
 from flask_wtf import FlaskForm
+from werkzeug.datastructures import MultiDict
 from wtforms import BooleanField, PasswordField, StringField, SubmitField, TextAreaField
 from wtforms.validators import DataRequired, Email, EqualTo, Length, ValidationError
 
@@ -61,3 +62,28 @@ class CreatePostCommentForm(FlaskForm):
 
 class EditPostCommentForm(CreatePostCommentForm):
     delete = SubmitField("Delete")
+
+
+class EmptyForm(FlaskForm):
+    submit = SubmitField("Submit")
+
+
+def from_json(form_class, data):
+    """Validate the JSON object ``data`` with ``form_class``; returns
+    ``(form, errors)``, one of them None.
+
+    Fields have to be strings: the validators expect them, and a list would
+    quietly lose everything but its first item.
+    """
+    strings = {key: value for key, value in data.items() if isinstance(value, str)}
+    form = form_class(formdata=MultiDict(strings), meta={"csrf": False})
+    errors = {
+        field.name: ["Expected a string."]
+        for field in form
+        if field.name in data and field.name not in strings
+    }
+    if errors:
+        return None, errors
+    if not form.validate():
+        return None, form.errors
+    return form, None
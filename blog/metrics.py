@@ -0,0 +1,241 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from flask import abort, current_app, g, has_request_context, request
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger("blog.sql")
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RequestTimer(object):
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.db = 0.0
+        self.render = 0.0
+        self.statements = 0
+
+
+def _current_timer():
+    return g.get("_request_timer") if has_request_context() else None
+
+
+class TimedTemplate(Template):
+    """Template that charges its render time (minus SQL) to the current request."""
+
+    def render(self, *args, **kwargs):
+        timer = _current_timer()
+        if timer is None:
+            return super(TimedTemplate, self).render(*args, **kwargs)
+        start, db = time.perf_counter(), timer.db
+        try:
+            return super(TimedTemplate, self).render(*args, **kwargs)
+        finally:
+            timer.render += time.perf_counter() - start - (timer.db - db)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current_timer() is not None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timer = _current_timer()
+    if timer is None or not conn.info.get("query_start"):
+        return
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    timer.db += elapsed
+    timer.statements += 1
+    if elapsed * 1000 >= g.slow_query_threshold:
+        g.metrics.observe_slow_query()
+        logger.warning("Slow query (%.1f ms): %s", elapsed * 1000, statement)
+
+
+class _MetricsState(object):
+    """The series and collectors of one application."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.collectors = []
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = defaultdict(int)
+            self.durations = defaultdict(lambda: [0] * (len(DURATION_BUCKETS) + 1))
+            self.duration_sums = defaultdict(float)
+            self.phases = defaultdict(float)
+            self.statements = defaultdict(int)
+            self.slow_queries = 0
+
+    def observe_slow_query(self):
+        with self.lock:
+            self.slow_queries += 1
+
+
+class Metrics(object):
+    """Per-request timing and SQL instrumentation exposed in Prometheus format.
+
+    Everything is gated on ``METRICS_ENABLED`` at request time; while it is
+    off a request costs one config lookup and SQL/template hooks bail out on
+    a missing timer. Engine listeners are only installed the first time a
+    request is measured. Series and collectors belong to the application
+    (``app.extensions["metrics"]``).
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._listening = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("METRICS_ENABLED", False)
+        app.config.setdefault("SERVER_TIMING_HEADER", False)
+        app.config.setdefault("SLOW_QUERY_THRESHOLD_MS", 100)
+        app.jinja_env.template_class = TimedTemplate
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.add_url_rule("/metrics", "metrics", self.view)
+        app.extensions["metrics"] = _MetricsState()
+
+    @staticmethod
+    def _state():
+        return current_app.extensions["metrics"]
+
+    def reset(self):
+        self._state().reset()
+
+    def register(self, app, name, kind, description, collect):
+        """Expose ``collect()`` -> ``[(labels, value), ...]`` as metric ``name``
+        of ``app``, replacing an earlier collector of the same name."""
+        state = app.extensions["metrics"]
+        state.collectors = [c for c in state.collectors if c[0] != name]
+        state.collectors.append((name, kind, description, collect))
+
+    def _listen(self):
+        with self._lock:
+            if not self._listening:
+                event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+                event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+                self._listening = True
+
+    def _before_request(self):
+        if not current_app.config["METRICS_ENABLED"]:
+            return
+        if not self._listening:
+            self._listen()
+        g.metrics = self._state()
+        g.slow_query_threshold = current_app.config["SLOW_QUERY_THRESHOLD_MS"]
+        g._request_timer = RequestTimer()
+
+    def _after_request(self, response):
+        timer = g.pop("_request_timer", None)
+        if timer is None:
+            return response
+        total = time.perf_counter() - timer.start
+        python = max(total - timer.db - timer.render, 0.0)
+        endpoint = request.endpoint or "none"
+        state = self._state()
+        with state.lock:
+            state.requests[(endpoint, request.method, response.status_code)] += 1
+            buckets = state.durations[endpoint]
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if total <= bound:
+                    buckets[i] += 1
+            buckets[-1] += 1
+            state.duration_sums[endpoint] += total
+            state.phases[(endpoint, "db")] += timer.db
+            state.phases[(endpoint, "render")] += timer.render
+            state.phases[(endpoint, "python")] += python
+            state.statements[endpoint] += timer.statements
+        if current_app.config["SERVER_TIMING_HEADER"]:
+            response.headers["Server-Timing"] = (
+                f'db;dur={timer.db * 1000:.2f};desc="{timer.statements} queries", '
+                f"render;dur={timer.render * 1000:.2f}, "
+                f"app;dur={python * 1000:.2f}, "
+                f"total;dur={total * 1000:.2f}"
+            )
+        return response
+
+    def view(self):
+        if not current_app.config["METRICS_ENABLED"]:
+            abort(404)
+        return self.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+    def render(self):
+        state = self._state()
+        lines = []
+
+        def header(name, kind, description):
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def samples(name, values):
+            for labels, value in values:
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(
+                    f"{name}{{{label_text}}} {value}" if labels else f"{name} {value}"
+                )
+
+        with state.lock:
+            header("blog_requests_total", "counter", "Requests served.")
+            samples(
+                "blog_requests_total",
+                (
+                    ({"endpoint": e, "method": m, "status": s}, n)
+                    for (e, m, s), n in sorted(state.requests.items())
+                ),
+            )
+            header("blog_request_duration_seconds", "histogram", "Request latency.")
+            for endpoint, buckets in sorted(state.durations.items()):
+                bounds = DURATION_BUCKETS + ("+Inf",)
+                samples(
+                    "blog_request_duration_seconds_bucket",
+                    (
+                        ({"endpoint": endpoint, "le": bound}, count)
+                        for bound, count in zip(bounds, buckets)
+                    ),
+                )
+                labels = {"endpoint": endpoint}
+                samples(
+                    "blog_request_duration_seconds_sum",
+                    [(labels, state.duration_sums[endpoint])],
+                )
+                samples("blog_request_duration_seconds_count", [(labels, buckets[-1])])
+            header(
+                "blog_request_phase_seconds_total",
+                "counter",
+                "Time spent per request phase (db, render, python).",
+            )
+            samples(
+                "blog_request_phase_seconds_total",
+                (
+                    ({"endpoint": e, "phase": p}, v)
+                    for (e, p), v in sorted(state.phases.items())
+                ),
+            )
+            header(
+                "blog_sql_statements_total",
+                "counter",
+                "SQL statements executed while serving requests.",
+            )
+            samples(
+                "blog_sql_statements_total",
+                (({"endpoint": e}, n) for e, n in sorted(state.statements.items())),
+            )
+            header(
+                "blog_sql_slow_queries_total",
+                "counter",
+                "Statements slower than SLOW_QUERY_THRESHOLD_MS.",
+            )
+            samples("blog_sql_slow_queries_total", [({}, state.slow_queries)])
+        for name, kind, description, collect in state.collectors:
+            header(name, kind, description)
+            samples(name, collect())
+        return "\n".join(lines) + "\n"
@@ -1,14 +1,83 @@
+import hashlib
+import hmac
+import os
 from datetime import datetime
 
+from flask import current_app
 from flask_login import UserMixin
+from sqlalchemy import func
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
 from werkzeug.security import check_password_hash, generate_password_hash
 
 from blog import db, login
+from blog.cache import MemoryBackend
+
+# Digests of recently verified (user, password) pairs, so that Basic Auth
+# clients don't pay for a full PBKDF2 run on every request. The key never
+# leaves the process, and the digests cover the username and the stored hash,
+# so a changed username or password can't match a stale entry.
+_verified_credentials = MemoryBackend()
+_credential_key = os.urandom(32)
+
+EXCERPT_LENGTH = 200
+
+# Column values of recently loaded users, keyed by id, so that a request with
+# a session cookie doesn't need a SELECT to rebuild current_user.
+identity_cache = MemoryBackend()
+
+
+def init_app(app):
+    """Size the credential and identity caches from the config of ``app``."""
+    _verified_credentials.threshold = app.config["CREDENTIAL_CACHE_SIZE"]
+    _verified_credentials.default_timeout = app.config["CREDENTIAL_CACHE_TTL"]
+    identity_cache.threshold = app.config["USER_CACHE_SIZE"]
+    identity_cache.default_timeout = app.config["USER_CACHE_TTL"]
 
 
 @login.user_loader
 def load_user(id):
-    return Users.query.get(int(id))
+    state = identity_cache.get(id)
+    if state is None:
+        user = Users.query.get(int(id))
+        if user is not None:
+            identity_cache.set(
+                id, {c.key: getattr(user, c.key) for c in Users.__table__.columns}
+            )
+        return user
+    user = Users.__mapper__.class_manager.new_instance()
+    for key, value in state.items():
+        set_committed_value(user, key, value)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+def make_excerpt(content, length=EXCERPT_LENGTH):
+    """Return the start of ``content`` on one line, cut at a word boundary."""
+    if content is None:
+        return None
+    text = " ".join(content.split())
+    if len(text) <= length:
+        return text
+    cut = text[: length - 1]
+    if text[length - 1] != " " and " " in cut:
+        cut = cut.rsplit(" ", 1)[0]
+    return cut.rstrip() + "\u2026"
+
+
+def identity_cache_stats():
+    stats = identity_cache.stats()
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    return stats
+
+
+followers = db.Table(
+    "followers",
+    db.Column("follower_id", db.Integer, db.ForeignKey("users.id"), primary_key=True),
+    db.Column("followed_id", db.Integer, db.ForeignKey("users.id"), primary_key=True),
+    db.Index("ix_followers_followed_id", "followed_id"),
+)
 
 
 class Users(UserMixin, db.Model):
@@ -16,29 +85,123 @@ class Users(UserMixin, db.Model):
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
     password_hash = db.Column(db.String(128))
+    follower_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default="0"
+    )
+    # when the username last changed; pages showing other users' names carry
+    # the newest of these in their ETag
+    profile_updated_at = db.Column(db.DateTime, index=True)
     posts = db.relationship(
         "Posts", backref="author", lazy="dynamic", cascade="all,delete"
     )
     comments = db.relationship(
         "Comments", backref="author", lazy="dynamic", cascade="all,delete"
     )
+    followed = db.relationship(
+        "Users",
+        secondary=followers,
+        primaryjoin=(followers.c.follower_id == id),
+        secondaryjoin=(followers.c.followed_id == id),
+        backref=db.backref("followers", lazy="dynamic"),
+        lazy="dynamic",
+    )
 
     def __repr__(self):
         return f"<User {self.username}>"
 
+    def rename(self, username):
+        self.username = username
+        self.profile_updated_at = datetime.utcnow()
+
+    def is_following(self, user):
+        return (
+            db.session.query(followers.c.followed_id)
+            .filter(
+                followers.c.follower_id == self.id, followers.c.followed_id == user.id
+            )
+            .first()
+            is not None
+        )
+
+    def follow(self, user):
+        """Start following ``user``; returns False if there's nothing to do."""
+        if user.id == self.id or self.is_following(user):
+            return False
+        self.followed.append(user)
+        user.follower_count = Users.follower_count + 1
+        return True
+
+    def unfollow(self, user):
+        if not self.is_following(user):
+            return False
+        self.followed.remove(user)
+        user.follower_count = Users.follower_count - 1
+        return True
+
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = generate_password_hash(
+            password,
+            method=current_app.config["PASSWORD_HASH_METHOD"],
+            salt_length=current_app.config["PASSWORD_SALT_LENGTH"],
+        )
+        self.forget_credentials()
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        """Verify ``password``, upgrading the stored hash if its parameters are stale.
+
+        The caller is responsible for committing the session after an upgrade.
+        """
+        if self.id is not None:
+            digest = self._credential_digest(password)
+            cached = _verified_credentials.get(str(self.id))
+            if cached is not None and hmac.compare_digest(cached, digest):
+                return True
+        if not check_password_hash(self.password_hash, password):
+            return False
+        if self.password_needs_rehash():
+            self.set_password(password)
+        if self.id is not None:
+            _verified_credentials.set(str(self.id), self._credential_digest(password))
+        return True
+
+    def password_needs_rehash(self):
+        method, salt, _ = self.password_hash.split("$", 2)
+        return (
+            method != current_app.config["PASSWORD_HASH_METHOD"]
+            or len(salt) != current_app.config["PASSWORD_SALT_LENGTH"]
+        )
+
+    def forget_credentials(self):
+        if self.id is not None:
+            _verified_credentials.delete(str(self.id))
+
+    def _credential_digest(self, password):
+        message = "\0".join((str(self.id), self.username, self.password_hash, password))
+        return hmac.new(_credential_key, message.encode(), hashlib.sha256).digest()
 
 
 class Posts(db.Model):
+    __table_args__ = (
+        db.Index("ix_posts_publication_datetime_id", "publication_datetime", "id"),
+        db.Index(
+            "ix_posts_author_id_publication_datetime",
+            "author_id",
+            "publication_datetime",
+            "id",
+        ),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     author_id = db.Column(db.Integer, db.ForeignKey("users.id"))
     title = db.Column(db.String(64))
-    content = db.Column(db.Text())
+    # bodies are only loaded where they're shown, lists print the excerpt
+    content = db.deferred(db.Column(db.Text()))
+    excerpt = db.Column(db.String(EXCERPT_LENGTH))
     publication_datetime = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    last_comment_at = db.Column(db.DateTime)
+    # set by mark_deleted(), the row itself goes with purge()
+    deleted_at = db.Column(db.DateTime, index=True)
     comments = db.relationship(
         "Comments", backref="post", lazy="dynamic", cascade="all,delete"
     )
@@ -46,8 +209,56 @@ class Posts(db.Model):
     def __repr__(self):
         return f"<Post {self.title}>"
 
+    @property
+    def is_deleted(self):
+        return self.deleted_at is not None
+
+    def mark_deleted(self):
+        """Hide the post at once; its rows are removed by a background purge."""
+        self.deleted_at = datetime.utcnow()
+
+    @property
+    def last_activity(self):
+        if self.last_comment_at is None:
+            return self.publication_datetime
+        return max(self.publication_datetime, self.last_comment_at)
+
+    def comment_added(self, comment):
+        if comment.publication_datetime is None:
+            comment.publication_datetime = datetime.utcnow()
+        self.comment_count = Posts.comment_count + 1
+        self.last_comment_at = comment.publication_datetime
+
+    def comment_removed(self):
+        # the comment has to be flushed away already for the MAX() to skip it
+        self.comment_count = Posts.comment_count - 1
+        self.last_comment_at = _last_comment_at()
+
+    @classmethod
+    def reconcile_comment_stats(cls):
+        """Recompute the denormalized comment columns of every post in one UPDATE."""
+        count = (
+            db.select([func.count(Comments.id)])
+            .where(Comments.post_id == cls.id)
+            .as_scalar()
+        )
+        return cls.query.update(
+            {cls.comment_count: count, cls.last_comment_at: _last_comment_at()},
+            synchronize_session=False,
+        )
+
 
 class Comments(db.Model):
+    __table_args__ = (
+        db.Index(
+            "ix_comments_post_id_publication_datetime",
+            "post_id",
+            "publication_datetime",
+            "id",
+        ),
+        db.Index("ix_comments_author_id", "author_id"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     post_id = db.Column(db.Integer, db.ForeignKey("posts.id"))
     author_id = db.Column(db.Integer, db.ForeignKey("users.id"))
@@ -57,3 +268,71 @@ class Comments(db.Model):
 
     def __repr__(self):
         return f"<Comment {self.title}>"
+
+
+class FeedEntry(db.Model):
+    """A post delivered to one reader's feed by fan-out on write."""
+
+    __tablename__ = "feed_entries"
+    __table_args__ = (
+        db.Index(
+            "ix_feed_entries_user_id_publication_datetime",
+            "user_id",
+            "publication_datetime",
+            "post_id",
+        ),
+        db.Index("ix_feed_entries_post_id", "post_id"),
+    )
+
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey("posts.id"), primary_key=True)
+    publication_datetime = db.Column(db.DateTime, nullable=False)
+    post = db.relationship("Posts")
+
+
+# what a row of a post list shows, see _fragments.post_row
+LIST_COLUMNS = (
+    "title",
+    "excerpt",
+    "author_id",
+    "publication_datetime",
+    "comment_count",
+    "last_comment_at",
+)
+
+
+def profiles_updated_at():
+    """The newest ``Users.profile_updated_at``, as a scalar subquery."""
+    return db.select([func.max(Users.profile_updated_at)]).as_scalar()
+
+
+def _last_comment_at():
+    return (
+        db.select([func.max(Comments.publication_datetime)])
+        .where(Comments.post_id == Posts.id)
+        .as_scalar()
+    )
+
+
+@db.event.listens_for(Posts.content, "set")
+def _content_changed(target, value, oldvalue, initiator):
+    target.excerpt = make_excerpt(value)
+
+
+@db.event.listens_for(Users.username, "set")
+def _username_changed(target, value, oldvalue, initiator):
+    if value != oldvalue:
+        target.forget_credentials()
+
+
+@db.event.listens_for(Users, "after_update")
+@db.event.listens_for(Users, "after_delete")
+def _user_changed(mapper, connection, target):
+    identity_cache.delete(str(target.id))
+
+
+@db.event.listens_for(Posts, "before_delete")
+def _post_deleted(mapper, connection, target):
+    connection.execute(
+        FeedEntry.__table__.delete().where(FeedEntry.post_id == target.id)
+    )
@@ -0,0 +1,129 @@
+from datetime import datetime
+
+from flask import abort
+from sqlalchemy import and_, or_
+
+# cursor for ``before`` that starts from the very end of the sort order
+LAST = "last"
+
+
+class KeysetPage(object):
+    """One page of a keyset (cursor) paginated query.
+
+    ``next_cursor`` continues in the sort order after the last item,
+    ``prev_cursor`` goes back before the first one. The query runs on first
+    access, so a lazy page handed to a streamed template is only fetched once
+    rendering reaches it.
+    """
+
+    def __init__(self, query, columns, per_page, backwards=False, continued=False):
+        self.query = query
+        self.columns = columns
+        self.per_page = per_page
+        self.backwards = backwards
+        self.continued = continued
+        self._items = None
+
+    def _load(self):
+        if self._items is not None:
+            return
+        rows = self.query.all()
+        more = len(rows) > self.per_page
+        items = rows[: self.per_page]
+        if self.backwards:
+            items.reverse()
+            has_next, has_prev = self.continued, more
+        else:
+            has_next, has_prev = more, self.continued
+        self._next_cursor = self._prev_cursor = None
+        if items and has_next:
+            self._next_cursor = encode_cursor(items[-1], self.columns)
+        if items and has_prev:
+            self._prev_cursor = encode_cursor(items[0], self.columns)
+        self._items = items
+
+    @property
+    def items(self):
+        self._load()
+        return self._items
+
+    @property
+    def next_cursor(self):
+        self._load()
+        return self._next_cursor
+
+    @property
+    def prev_cursor(self):
+        self._load()
+        return self._prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __bool__(self):
+        return bool(self.items)
+
+
+def encode_cursor(item, columns):
+    timestamp, ident = (getattr(item, column.key) for column in columns)
+    return f"{timestamp.isoformat()}_{ident}"
+
+
+def decode_cursor(cursor):
+    try:
+        timestamp, ident = cursor.rsplit("_", 1)
+        return datetime.fromisoformat(timestamp), int(ident)
+    except (AttributeError, ValueError):
+        abort(400)
+
+
+def _beyond(columns, values, descending):
+    (timestamp_col, id_col), (timestamp, ident) = columns, values
+    if descending:
+        return or_(
+            timestamp_col < timestamp, and_(timestamp_col == timestamp, id_col < ident)
+        )
+    return or_(
+        timestamp_col > timestamp, and_(timestamp_col == timestamp, id_col > ident)
+    )
+
+
+def keyset_paginate(
+    query, columns, per_page, after=None, before=None, descending=True, lazy=False
+):
+    """Paginate ``query`` over a ``(timestamp, id)`` pair of columns.
+
+    Only ``per_page + 1`` rows are fetched whatever the size of the table,
+    provided there is an index covering ``columns``.
+    """
+    backwards = before is not None
+    cursor = before if backwards else after
+    if cursor is not None and cursor != LAST:
+        query = query.filter(
+            _beyond(columns, decode_cursor(cursor), descending != backwards)
+        )
+    if descending != backwards:
+        order = [column.desc() for column in columns]
+    else:
+        order = [column.asc() for column in columns]
+    page = KeysetPage(
+        query.order_by(*order).limit(per_page + 1),
+        columns,
+        per_page,
+        backwards=backwards,
+        continued=before != LAST if backwards else after is not None,
+    )
+    if not lazy:
+        page.items
+    return page
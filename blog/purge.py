@@ -0,0 +1,59 @@
+"""Background removal of deleted posts.
+
+Deleting a post only sets ``deleted_at`` (``Posts.mark_deleted()``), a
+one-row UPDATE however long its thread is; lists, pages, the API and search
+hide it from then on. ``purge`` removes the rows afterwards: the comments and
+feed entries of a few posts at a time, then the posts themselves, each step a
+set-based DELETE of at most ``PURGE_BATCH_SIZE`` rows in its own transaction,
+so neither the job's memory nor the locks it holds grow with a thread.
+"""
+
+from flask import current_app
+
+from blog import db, search, tasks
+from blog.models import Comments, FeedEntry, Posts
+
+
+def _delete_in_chunks(column, criterion, size):
+    """DELETE the rows matching ``criterion`` by ``size`` values of ``column``;
+    returns the ids removed."""
+    removed = []
+    while True:
+        ids = [
+            ident
+            for ident, in db.session.query(column).filter(criterion).limit(size).all()
+        ]
+        if not ids:
+            return removed
+        db.session.query(column.class_).filter(criterion, column.in_(ids)).delete(
+            synchronize_session=False
+        )
+        db.session.commit()
+        removed.extend(ids)
+
+
+@tasks.task
+def purge():
+    """Remove every deleted post with its comments and feed entries."""
+    size = current_app.config["PURGE_BATCH_SIZE"]
+    purged = 0
+    while True:
+        post_ids = [
+            ident
+            for ident, in db.session.query(Posts.id)
+            .filter(Posts.deleted_at.isnot(None))
+            .order_by(Posts.id)
+            .limit(size)
+        ]
+        if not post_ids:
+            return purged
+        for post_id in post_ids:
+            comment_ids = _delete_in_chunks(
+                Comments.id, Comments.post_id == post_id, size
+            )
+            search.refresh([], comment_ids)
+            _delete_in_chunks(FeedEntry.user_id, FeedEntry.post_id == post_id, size)
+        Posts.query.filter(Posts.id.in_(post_ids)).delete(synchronize_session=False)
+        db.session.commit()
+        search.refresh(post_ids, [])
+        purged += len(post_ids)
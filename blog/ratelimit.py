@@ -0,0 +1,190 @@
+import math
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, request
+from flask_login import current_user
+from werkzeug.exceptions import TooManyRequests
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+UNSAFE_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+# endpoints also counted per value of a form field, whoever sends it
+FORM_KEYS = {"main.login": "username"}
+
+
+def parse_limit(limit):
+    """Turn ``"10/minute"`` into ``(capacity, tokens per second)``."""
+    match = re.fullmatch(r"\s*(\d+)\s*/\s*(second|minute|hour|day)\s*", limit)
+    if match is None:
+        raise ValueError(f"Invalid rate limit {limit!r}")
+    count = int(match.group(1))
+    return count, count / PERIODS[match.group(2)]
+
+
+class MemoryBucketStore(object):
+    """Token buckets of one process, dropping the least recently used ones
+    past ``threshold`` (a dropped bucket comes back full)."""
+
+    def __init__(self, threshold=10000):
+        self.threshold = threshold
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, rate):
+        """Take a token; returns 0 or the seconds until one is available."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.threshold:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+# KEYS[1] bucket; ARGV capacity, tokens per second. The server's clock is used
+# so that workers with skewed clocks agree, and idle buckets expire once full.
+TAKE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + (now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RedisBucketStore(object):
+    """Token buckets shared by every worker, updated atomically by a script."""
+
+    def __init__(self, client, prefix="blog:ratelimit:"):
+        self.client = client
+        self.prefix = prefix
+        self._take = client.register_script(TAKE_SCRIPT)
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        import redis
+
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def take(self, key, capacity, rate):
+        return float(self._take(keys=[self.prefix + key], args=[capacity, rate]))
+
+    def clear(self):
+        keys = list(self.client.scan_iter(self.prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+
+class _LimiterState(object):
+    """What a ``RateLimiter`` keeps per application."""
+
+    def __init__(self, store, limits):
+        self.store = store
+        self.limits = limits
+        self.rejected = {}
+
+
+class RateLimiter(object):
+    """Token-bucket limits on the endpoints listed in ``RATELIMITS``.
+
+    Only requests that change something are counted, per endpoint and per
+    signed-in user or client address. Over the limit a request is answered
+    with 429 and a ``Retry-After`` header before its view runs. Behind
+    ``RATELIMIT_TRUSTED_PROXIES`` proxies the client address is taken from
+    ``X-Forwarded-For``; logins are also counted per submitted username. The store and
+    the limits belong to the application (``app.extensions["ratelimit"]``).
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("RATELIMIT_ENABLED", None)
+        app.config.setdefault("RATELIMIT_STORAGE", "memory")
+        app.config.setdefault("RATELIMIT_REDIS_URL", None)
+        app.config.setdefault("RATELIMITS", {})
+        app.config.setdefault("RATELIMIT_TRUSTED_PROXIES", 0)
+        storage = app.config["RATELIMIT_STORAGE"]
+        if storage == "memory":
+            store = MemoryBucketStore()
+        elif storage == "redis":
+            store = RedisBucketStore.from_url(app.config["RATELIMIT_REDIS_URL"])
+        else:
+            raise ValueError(f"Unknown RATELIMIT_STORAGE {storage!r}")
+        limits = {
+            endpoint: parse_limit(limit)
+            for endpoint, limit in app.config["RATELIMITS"].items()
+        }
+        app.extensions["ratelimit"] = _LimiterState(store, limits)
+        proxies = app.config["RATELIMIT_TRUSTED_PROXIES"]
+        if proxies:
+            app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies, x_proto=proxies)
+        app.before_request(self.check)
+
+    @staticmethod
+    def _state():
+        return current_app.extensions["ratelimit"]
+
+    @property
+    def enabled(self):
+        enabled = current_app.config["RATELIMIT_ENABLED"]
+        return not current_app.config["TESTING"] if enabled is None else enabled
+
+    def _identities(self):
+        if current_user.is_authenticated:
+            yield f"user:{current_user.id}"
+        else:
+            yield f"ip:{request.remote_addr}"
+        field = FORM_KEYS.get(request.endpoint)
+        if field is not None and request.form.get(field):
+            yield f"{field}:{request.form[field].strip()}"
+
+    def check(self):
+        if request.method not in UNSAFE_METHODS or not self.enabled:
+            return
+        state = self._state()
+        limit = state.limits.get(request.endpoint)
+        if limit is None:
+            return
+        wait = max(
+            state.store.take(f"{request.endpoint}:{identity}", *limit)
+            for identity in self._identities()
+        )
+        if wait:
+            state.rejected[request.endpoint] = (
+                state.rejected.get(request.endpoint, 0) + 1
+            )
+            raise TooManyRequests(retry_after=math.ceil(wait))
+
+    def stats(self):
+        return dict(self._state().rejected)
+
+    def clear(self):
+        state = self._state()
+        state.rejected.clear()
+        state.store.clear()
@@ -1,31 +1,109 @@
 from datetime import datetime
 
-from flask import flash, redirect, render_template, request, url_for
+from flask import (
+    Blueprint,
+    abort,
+    current_app,
+    flash,
+    make_response,
+    redirect,
+    render_template,
+    request,
+    stream_with_context,
+    url_for,
+)
 from flask_login import current_user, login_required, login_user, logout_user
+from sqlalchemy.orm import joinedload, load_only, undefer
 from werkzeug.urls import url_parse
 
-from blog import app, db
+from blog import cache, db
+from blog.conditional import make_etag, not_modified, set_validators
+from blog.feed import backfill, fan_out, feed_query, withdraw
 from blog.forms import (
     CreatePostCommentForm,
     EditPostCommentForm,
     EditProfileForm,
+    EmptyForm,
     LoginForm,
     RegistrationForm,
 )
-from blog.models import Comments, Posts, Users
+from blog.models import LIST_COLUMNS, Comments, Posts, Users, profiles_updated_at
+from blog.pagination import LAST, keyset_paginate
+from blog.purge import purge
+from blog.search import find
+
+bp = Blueprint("main", __name__)
+
+
+def stream_template(template_name, **context):
+    """Render a template as a generator of chunks, like ``render_template``."""
+    current_app.update_template_context(context)
+    template = current_app.jinja_env.get_or_select_template(template_name)
+    return template.generate(context)
 
 
-@app.route("/")
-@app.route("/index")
+@bp.route("/")
+@bp.route("/index")
+@cache.cached("feed")
 def index():
-    posts = Posts.query.order_by(Posts.publication_datetime.desc()).all()
-    return render_template("index.html", title="Home", posts=posts)
+    posts = keyset_paginate(
+        Posts.query.options(
+            load_only(*LIST_COLUMNS), joinedload(Posts.author).load_only("username")
+        ).filter(Posts.deleted_at.is_(None)),
+        (Posts.publication_datetime, Posts.id),
+        current_app.config["POSTS_PER_PAGE"],
+        after=request.args.get("after"),
+        before=request.args.get("before"),
+    )
+    etag = make_etag(
+        "feed",
+        posts.prev_cursor,
+        posts.next_cursor,
+        *(
+            (p.id, p.title, p.author.username, p.comment_count, p.last_activity)
+            for p in posts
+        ),
+    )
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    response = make_response(render_template("index.html", title="Home", posts=posts))
+    return set_validators(response, etag)
 
 
-@app.route("/register", methods=["GET", "POST"])
+@bp.route("/feed")
+@login_required
+def feed():
+    query, columns = feed_query(current_user)
+    entries = keyset_paginate(
+        query,
+        columns,
+        current_app.config["POSTS_PER_PAGE"],
+        after=request.args.get("after"),
+        before=request.args.get("before"),
+    )
+    return render_template("feed.html", title="Feed", entries=entries)
+
+
+@bp.route("/search")
+def search():
+    query = request.args.get("q", "")
+    page = max(request.args.get("page", 1, type=int), 1)
+    hits, has_next = find(query, page, current_app.config["POSTS_PER_PAGE"])
+    return render_template(
+        "search.html",
+        title="Search",
+        query=query,
+        hits=hits,
+        page=page,
+        has_next=has_next,
+    )
+
+
+@bp.route("/register", methods=["GET", "POST"])
 def register():
     if current_user.is_authenticated:
-        return redirect(url_for("index"))
+        return redirect(url_for("main.index"))
     form = RegistrationForm()
     if form.validate_on_submit():
         user = Users(username=form.username.data, email=form.email.data)
@@ -33,100 +111,200 @@ def register():
         db.session.add(user)
         db.session.commit()
         flash("Congratulations, you`ve successfully registered!")
-        return redirect(url_for("login"))
+        return redirect(url_for("main.login"))
     return render_template("register.html", title="Register", form=form)
 
 
-@app.route("/login", methods=["GET", "POST"])
+@bp.route("/login", methods=["GET", "POST"])
 def login():
     if current_user.is_authenticated:
-        return redirect(url_for("index"))
+        return redirect(url_for("main.index"))
     form = LoginForm()
     if form.validate_on_submit():
         user = Users.query.filter_by(username=form.username.data).first()
         if user is None or not user.check_password(form.password.data):
             flash("Invalid username or password")
-            return redirect(url_for("login"))
+            return redirect(url_for("main.login"))
+        if db.session.is_modified(user):
+            db.session.commit()
         login_user(user, remember=form.remember_me.data)
         next_page = request.args.get("next")
         if not next_page or url_parse(next_page).netloc != "":
-            next_page = url_for("user", username=user.username)
+            next_page = url_for("main.user", username=user.username)
         return redirect(next_page)
     return render_template("login.html", title="Sign In", form=form)
 
 
-@app.route("/logout")
+@bp.route("/logout")
 def logout():
     logout_user()
-    return redirect(url_for("index"))
+    return redirect(url_for("main.index"))
 
 
-@app.route("/user/<username>", methods=["GET", "POST"])
+@bp.route("/user/<username>", methods=["GET", "POST"])
 @login_required
 def user(username):
     form = CreatePostCommentForm()
     user = Users.query.filter_by(username=username).first_or_404()
-    posts = Posts.query.filter_by(author=user).all()
+    posts = keyset_paginate(
+        Posts.query.options(load_only("title", "publication_datetime")).filter(
+            Posts.author_id == user.id, Posts.deleted_at.is_(None)
+        ),
+        (Posts.publication_datetime, Posts.id),
+        current_app.config["POSTS_PER_PAGE"],
+        after=request.args.get("after"),
+        before=request.args.get("before"),
+    )
     if form.validate_on_submit():
         post = Posts(title=form.title.data, content=form.content.data, author=user)
         db.session.add(post)
         db.session.commit()
+        cache.invalidate("feed")
+        fan_out.delay(post.id)
         flash("Congratulations, you`ve successfully created new post!")
-        return redirect(url_for("user", username=username))
-    return render_template("user.html", user=user, posts=posts, form=form)
+        return redirect(url_for("main.user", username=username))
+    following = user != current_user and current_user.is_following(user)
+    return render_template(
+        "user.html",
+        user=user,
+        posts=posts,
+        form=form,
+        follow_form=EmptyForm(),
+        following=following,
+    )
+
+
+@bp.route("/follow/<username>", methods=["POST"])
+@login_required
+def follow(username):
+    form = EmptyForm()
+    if form.validate_on_submit():
+        user = Users.query.filter_by(username=username).first_or_404()
+        if current_user.follow(user):
+            db.session.commit()
+            backfill.delay(current_user.id, user.id)
+            flash(f"You are following {username}!")
+        return redirect(url_for("main.user", username=username))
+    return redirect(url_for("main.index"))
 
 
-@app.route("/post/<post_id>", methods=["GET", "POST"])
+@bp.route("/unfollow/<username>", methods=["POST"])
+@login_required
+def unfollow(username):
+    form = EmptyForm()
+    if form.validate_on_submit():
+        user = Users.query.filter_by(username=username).first_or_404()
+        if current_user.unfollow(user):
+            db.session.commit()
+            withdraw.delay(current_user.id, user.id)
+            flash(f"You are not following {username}.")
+        return redirect(url_for("main.user", username=username))
+    return redirect(url_for("main.index"))
+
+
+@bp.route("/post/<post_id>", methods=["GET", "POST"])
+@cache.cached(lambda post_id: f"post:{post_id}")
 def post(post_id):
     form = CreatePostCommentForm()
-    post = Posts.query.filter_by(id=post_id).first()
+    post, profiles_updated = (
+        Posts.query.options(joinedload(Posts.author), undefer(Posts.content))
+        .add_columns(profiles_updated_at())
+        .filter_by(id=post_id, deleted_at=None)
+        .first_or_404()
+    )
+    # validated before the comments are queried or anything is rendered; the
+    # commenters' names are shown too, and a rename touches no post column
+    etag = make_etag(
+        "post",
+        post.id,
+        post.publication_datetime,
+        post.author.username,
+        post.comment_count,
+        post.last_comment_at,
+        profiles_updated,
+    )
+    response = not_modified(etag)
+    if response is not None:
+        return response
     author = current_user
-    comments = Comments.query.filter_by(post_id=post.id)
     if form.validate_on_submit():
         if current_user.is_anonymous:
             flash("Please log in or register for leaving comments")
-            return redirect(url_for("login"))
+            return redirect(url_for("main.login"))
         comment = Comments(
             title=form.title.data, content=form.content.data, author=author, post=post
         )
         db.session.add(comment)
+        post.comment_added(comment)
         db.session.commit()
-        return redirect(url_for("post", post_id=post.id))
-    return render_template("post.html", post=post, comments=comments, form=form)
+        cache.invalidate("feed", f"post:{post.id}")
+        return redirect(
+            url_for(
+                "main.post",
+                post_id=post.id,
+                before=LAST,
+                _anchor=f"comment-{comment.id}",
+            )
+        )
+    streaming = current_app.config["STREAM_POST_PAGES"]
+    comments = keyset_paginate(
+        Comments.query.options(joinedload(Comments.author)).filter_by(post_id=post.id),
+        (Comments.publication_datetime, Comments.id),
+        current_app.config["COMMENTS_PER_PAGE"],
+        after=request.args.get("after"),
+        before=request.args.get("before"),
+        descending=False,
+        lazy=streaming,
+    )
+    context = dict(post=post, comments=comments, form=form)
+    if streaming:
+        body = stream_with_context(stream_template("post.html", **context))
+        response = current_app.response_class(body)
+    else:
+        response = make_response(render_template("post.html", **context))
+    return set_validators(response, etag)
 
 
-@app.route("/edit_profile", methods=["GET", "POST"])
+@bp.route("/edit_profile", methods=["GET", "POST"])
 @login_required
 def edit_profile():
     form = EditProfileForm(current_user.username)
     if form.validate_on_submit():
-        current_user.username = form.username.data
+        current_user.rename(form.username.data)
         db.session.commit()
+        cache.invalidate_all()
         flash("Your changes have been saved.")
-        return redirect(url_for("user", username=form.username.data))
+        return redirect(url_for("main.user", username=form.username.data))
     elif request.method == "GET":
         form.username.data = current_user.username
     return render_template("edit_profile.html", title="Edit Profile", form=form)
 
 
-@app.route("/edit_post/<post_id>", methods=["GET", "POST"])
+@bp.route("/edit_post/<post_id>", methods=["GET", "POST"])
 @login_required
 def edit_post(post_id):
     form = EditPostCommentForm()
-    post = Posts.query.filter_by(id=post_id).first()
+    post = (
+        Posts.query.options(undefer(Posts.content))
+        .filter_by(id=post_id, deleted_at=None)
+        .first_or_404()
+    )
     author = post.author
     if form.delete.data:
-        db.session.delete(post)
+        post.mark_deleted()
         db.session.commit()
+        cache.invalidate("feed", f"post:{post_id}")
+        purge.delay()
         flash("Your post is successfully deleted")
-        return redirect(url_for("user", username=author.username))
+        return redirect(url_for("main.user", username=author.username))
     if form.validate_on_submit():
         post.title = form.title.data
         post.content = form.content.data
         post.publication_datetime = datetime.utcnow()
         db.session.commit()
+        cache.invalidate("feed", f"post:{post.id}")
         flash("Your changes have been saved.")
-        return redirect(url_for("post", post_id=post.id))
+        return redirect(url_for("main.post", post_id=post.id))
     elif request.method == "GET":
         form.title.data = post.title
         form.content.data = post.content
@@ -135,24 +313,31 @@ def edit_post(post_id):
     )
 
 
-@app.route("/edit_comment/<comment_id>", methods=["GET", "POST"])
+@bp.route("/edit_comment/<comment_id>", methods=["GET", "POST"])
 @login_required
 def edit_comment(comment_id):
     form = EditPostCommentForm()
-    comment = Comments.query.filter_by(id=comment_id).first()
+    comment = Comments.query.filter_by(id=comment_id).first_or_404()
     post = comment.post
+    if post.is_deleted:
+        abort(404)
     if form.delete.data:
         db.session.delete(comment)
+        db.session.flush()
+        post.comment_removed()
         db.session.commit()
+        cache.invalidate("feed", f"post:{post.id}")
         flash("Your comment is successfully deleted")
-        return redirect(url_for("post", post_id=post.id))
+        return redirect(url_for("main.post", post_id=post.id))
     if form.validate_on_submit():
         comment.title = form.title.data
         comment.content = form.content.data
         comment.publication_datetime = datetime.utcnow()
+        post.last_comment_at = comment.publication_datetime
         db.session.commit()
+        cache.invalidate("feed", f"post:{post.id}")
         flash("Your changes have been saved.")
-        return redirect(url_for("post", post_id=post.id))
+        return redirect(url_for("main.post", post_id=post.id))
     elif request.method == "GET":
         form.title.data = comment.title
         form.content.data = comment.content
@@ -0,0 +1,184 @@
+"""Full-text search over posts and comments.
+
+On SQLite the documents live in an FTS5 table; the session's flushes note
+which posts and comments changed and a background job re-indexes them once
+the transaction has committed. Posts use even rowids (``id * 2``) and
+comments odd ones (``id * 2 + 1``) so that a single document is always
+reachable by rowid.
+On PostgreSQL ``to_tsvector`` expression indexes are maintained by the
+database itself and nothing has to happen on write.
+"""
+
+import re
+
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import bindparam, inspect, text
+
+from blog import db, tasks
+from blog.models import Comments, Posts
+
+SQLITE_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+    "title, content, post_id UNINDEXED, tokenize = 'unicode61 remove_diacritics 2')"
+)
+POSTGRES_DOCUMENT = (
+    "to_tsvector('english', coalesce(title, '') || ' ' || coalesce(content, ''))"
+)
+POSTGRES_DDL = (
+    "CREATE INDEX IF NOT EXISTS ix_posts_search ON posts "
+    f"USING gin ({POSTGRES_DOCUMENT})",
+    "CREATE INDEX IF NOT EXISTS ix_comments_search ON comments "
+    f"USING gin ({POSTGRES_DOCUMENT})",
+)
+
+DELETED_POSTS = "SELECT id FROM posts WHERE deleted_at IS NOT NULL"
+
+SQLITE_SEARCH = text(
+    "SELECT CASE rowid % 2 WHEN 0 THEN 'post' ELSE 'comment' END AS kind, "
+    "rowid / 2 AS ref_id, post_id, title, "
+    "snippet(search_index, 1, '', '', '...', 16) AS snippet "
+    "FROM search_index WHERE search_index MATCH :query "
+    f"AND post_id NOT IN ({DELETED_POSTS}) "
+    "ORDER BY bm25(search_index, 2.0, 1.0) LIMIT :limit OFFSET :offset"
+)
+REINDEX_POSTS = text(
+    "INSERT INTO search_index (rowid, title, content, post_id) "
+    "SELECT id * 2, title, content, id FROM posts WHERE id IN :ids"
+).bindparams(bindparam("ids", expanding=True))
+REINDEX_COMMENTS = text(
+    "INSERT INTO search_index (rowid, title, content, post_id) "
+    "SELECT id * 2 + 1, title, content, post_id FROM comments WHERE id IN :ids"
+).bindparams(bindparam("ids", expanding=True))
+POSTGRES_SEARCH = text(
+    "SELECT * FROM ("
+    "SELECT 'post' AS kind, id AS ref_id, id AS post_id, title, "
+    "left(content, 160) AS snippet, "
+    f"ts_rank({POSTGRES_DOCUMENT}, plainto_tsquery('english', :query)) AS rank "
+    f"FROM posts WHERE {POSTGRES_DOCUMENT} @@ plainto_tsquery('english', :query) "
+    "AND deleted_at IS NULL "
+    "UNION ALL "
+    "SELECT 'comment', id, post_id, title, left(content, 160), "
+    f"ts_rank({POSTGRES_DOCUMENT}, plainto_tsquery('english', :query)) "
+    f"FROM comments WHERE {POSTGRES_DOCUMENT} @@ plainto_tsquery('english', :query) "
+    f"AND post_id NOT IN ({DELETED_POSTS})"
+    ") AS hits ORDER BY rank DESC LIMIT :limit OFFSET :offset"
+)
+
+
+def _text_changed(obj):
+    state = inspect(obj)
+    return any(state.attrs[key].history.has_changes() for key in ("title", "content"))
+
+
+def _match_expression(query):
+    # quote every word so that user input can't use (or break) FTS5 syntax
+    return " ".join(f'"{word}"*' for word in re.findall(r"\w+", query))
+
+
+@db.event.listens_for(SignallingSession, "after_flush")
+def _collect_changes(session, flush_context):
+    if session.get_bind(mapper=inspect(Posts)).dialect.name != "sqlite":
+        return
+    changed = [
+        obj
+        for obj in session.new | session.deleted
+        if isinstance(obj, (Posts, Comments))
+    ]
+    changed.extend(
+        obj
+        for obj in session.dirty
+        if isinstance(obj, (Posts, Comments)) and _text_changed(obj)
+    )
+    if changed:
+        posts, comments = session.info.setdefault("search_changes", (set(), set()))
+        for obj in changed:
+            (posts if isinstance(obj, Posts) else comments).add(obj.id)
+
+
+@db.event.listens_for(SignallingSession, "after_commit")
+def _schedule_reindex(session):
+    changes = session.info.pop("search_changes", None)
+    if changes is not None:
+        reindex.delay(*(sorted(ids) for ids in changes))
+
+
+@db.event.listens_for(SignallingSession, "after_rollback")
+def _discard_changes(session):
+    session.info.pop("search_changes", None)
+
+
+@tasks.task
+def reindex(post_ids, comment_ids):
+    """Bring the documents of the given posts and comments up to date.
+
+    Runs after the writing transaction has committed, in its own one, and is
+    idempotent: every document is deleted and re-read from its current row,
+    so rows deleted in the meantime simply drop out of the index.
+    """
+    rowids = [{"rowid": i * 2} for i in post_ids]
+    rowids += [{"rowid": i * 2 + 1} for i in comment_ids]
+    with db.engine.begin() as connection:
+        connection.execute(
+            text("DELETE FROM search_index WHERE rowid = :rowid"), rowids
+        )
+        if post_ids:
+            connection.execute(REINDEX_POSTS, ids=post_ids)
+        if comment_ids:
+            connection.execute(REINDEX_COMMENTS, ids=comment_ids)
+
+
+def refresh(post_ids, comment_ids):
+    """Queue a re-index of rows written or deleted with bulk statements, which
+    the session's hooks don't see."""
+    if db.engine.dialect.name == "sqlite" and (post_ids or comment_ids):
+        reindex.delay(post_ids, comment_ids)
+
+
+@db.event.listens_for(db.metadata, "after_create")
+def _create_index(target, connection, **kw):
+    if connection.dialect.name == "sqlite":
+        connection.execute(SQLITE_DDL)
+    elif connection.dialect.name == "postgresql":
+        for statement in POSTGRES_DDL:
+            connection.execute(statement)
+
+
+@db.event.listens_for(db.metadata, "before_drop")
+def _drop_index(target, connection, **kw):
+    if connection.dialect.name == "sqlite":
+        connection.execute("DROP TABLE IF EXISTS search_index")
+
+
+def find(query, page=1, per_page=10):
+    """Return ``(hits, has_next)`` for one page of ranked results."""
+    if db.engine.dialect.name == "sqlite":
+        statement, query = SQLITE_SEARCH, _match_expression(query)
+    else:
+        statement = POSTGRES_SEARCH
+    if not query.strip():
+        return [], False
+    hits = db.session.execute(
+        statement,
+        {"query": query, "limit": per_page + 1, "offset": (page - 1) * per_page},
+    ).fetchall()
+    return hits[:per_page], len(hits) > per_page
+
+
+def rebuild():
+    """Re-index every post and comment; returns the number of documents."""
+    connection = db.session.connection(mapper=inspect(Posts))
+    if connection.dialect.name != "sqlite":
+        for index in ("ix_posts_search", "ix_comments_search"):
+            connection.execute(f"REINDEX INDEX {index}")
+        return Posts.query.count() + Comments.query.count()
+    connection.execute(SQLITE_DDL)
+    connection.execute("DELETE FROM search_index")
+    connection.execute(
+        "INSERT INTO search_index (rowid, title, content, post_id) "
+        "SELECT id * 2, title, content, id FROM posts"
+    )
+    connection.execute(
+        "INSERT INTO search_index (rowid, title, content, post_id) "
+        "SELECT id * 2 + 1, title, content, post_id FROM comments"
+    )
+    return connection.execute("SELECT count(*) FROM search_index").scalar()
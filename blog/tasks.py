@@ -0,0 +1,300 @@
+"""Background jobs for side effects that don't have to finish before the response.
+
+Functions decorated with ``tasks.task`` get a ``delay(*args)`` that queues a
+job; a bounded pool of worker threads runs the jobs inside an app context and
+retries failures with exponential backoff. Arguments must be JSON
+serializable. With ``TASK_EAGER`` (on by default while ``TESTING``) jobs run
+inline instead.
+"""
+
+import heapq
+import itertools
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from flask import current_app
+
+logger = logging.getLogger("blog.tasks")
+
+Job = namedtuple("Job", "id name args attempts")
+
+
+class MemoryQueue(object):
+    """Jobs kept in process memory, ordered by due time; lost on exit."""
+
+    def __init__(self):
+        self._heap = []
+        self._ids = itertools.count(1)
+        self._ready = threading.Condition()
+
+    def put(self, name, args, attempts=0, eta=0.0):
+        with self._ready:
+            heapq.heappush(self._heap, (eta, next(self._ids), name, args, attempts))
+            self._ready.notify()
+
+    def get(self, timeout):
+        deadline = time.monotonic() + timeout
+        with self._ready:
+            while True:
+                now = time.time()
+                if self._heap and self._heap[0][0] <= now:
+                    _, ident, name, args, attempts = heapq.heappop(self._heap)
+                    return Job(ident, name, args, attempts)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                if self._heap:
+                    remaining = min(remaining, self._heap[0][0] - now)
+                self._ready.wait(remaining)
+
+    def ack(self, job):
+        pass
+
+    def retry(self, job, eta):
+        self.put(job.name, job.args, job.attempts + 1, eta)
+
+    def __len__(self):
+        return len(self._heap)
+
+
+class SQLiteQueue(object):
+    """Jobs stored in a SQLite file, so they survive a restart.
+
+    A job is leased, not removed, while it runs; if its worker dies the job
+    becomes visible again once ``lease`` seconds have passed.
+    """
+
+    def __init__(self, path, lease=300, poll_interval=0.2):
+        self.path = path
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        # not kept: a preloading server builds the app before forking workers
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            "id INTEGER PRIMARY KEY, name TEXT NOT NULL, args TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, eta REAL NOT NULL, "
+            "leased_until REAL NOT NULL DEFAULT 0)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS ix_tasks_eta ON tasks (eta)")
+        connection.close()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def put(self, name, args, attempts=0, eta=0.0):
+        self._connection().execute(
+            "INSERT INTO tasks (name, args, attempts, eta) VALUES (?, ?, ?, ?)",
+            (name, json.dumps(args), attempts, eta),
+        )
+        self._wakeup.set()
+
+    def _claim(self):
+        connection, now = self._connection(), time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT id, name, args, attempts FROM tasks "
+                "WHERE eta <= ? AND leased_until <= ? ORDER BY eta LIMIT 1",
+                (now, now),
+            ).fetchone()
+            if row is not None:
+                connection.execute(
+                    "UPDATE tasks SET leased_until = ? WHERE id = ?",
+                    (now + self.lease, row[0]),
+                )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        if row is not None:
+            return Job(row[0], row[1], json.loads(row[2]), row[3])
+
+    def get(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self._claim()
+            remaining = deadline - time.monotonic()
+            if job is not None or remaining <= 0:
+                return job
+            self._wakeup.wait(min(remaining, self.poll_interval))
+            self._wakeup.clear()
+
+    def ack(self, job):
+        self._connection().execute("DELETE FROM tasks WHERE id = ?", (job.id,))
+
+    def retry(self, job, eta):
+        self._connection().execute(
+            "UPDATE tasks SET attempts = attempts + 1, eta = ?, leased_until = 0 "
+            "WHERE id = ?",
+            (eta, job.id),
+        )
+        self._wakeup.set()
+
+    def __len__(self):
+        return self._connection().execute("SELECT count(*) FROM tasks").fetchone()[0]
+
+
+class _QueueState(object):
+    """What a ``TaskQueue`` keeps per application."""
+
+    def __init__(self, app, backend):
+        self.app = app
+        self.backend = backend
+        self.workers = []
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.succeeded = self.retried = self.failed = 0
+
+
+class TaskQueue(object):
+    """Registry of task functions plus the worker threads that run them.
+
+    ``TASK_QUEUE_URL`` is ``"memory"`` or ``"sqlite:///<path>"``. Workers are
+    started on the first queued job, so CLI commands and migrations that
+    never queue anything don't spawn threads. The queue and its workers
+    belong to the application (``app.extensions["tasks"]``); the registry is
+    shared.
+    """
+
+    def __init__(self, app=None):
+        self._registry = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("TASK_QUEUE_URL", "memory")
+        app.config.setdefault("TASK_WORKERS", 2)
+        app.config.setdefault("TASK_MAX_RETRIES", 3)
+        app.config.setdefault("TASK_RETRY_BACKOFF", 1.0)
+        app.config.setdefault("TASK_EAGER", None)
+        url = app.config["TASK_QUEUE_URL"]
+        if url == "memory":
+            backend = MemoryQueue()
+        elif url.startswith("sqlite:///"):
+            backend = SQLiteQueue(url[len("sqlite:///") :])
+        else:
+            raise ValueError(f"Unknown TASK_QUEUE_URL {url!r}")
+        app.extensions["tasks"] = _QueueState(app, backend)
+
+    @staticmethod
+    def _state():
+        return current_app.extensions["tasks"]
+
+    @property
+    def backend(self):
+        return self._state().backend
+
+    def task(self, func):
+        name = f"{func.__module__}.{func.__name__}"
+        self._registry[name] = func
+        func.delay = lambda *args: self.enqueue(name, *args)
+        return func
+
+    @property
+    def eager(self):
+        eager = current_app.config["TASK_EAGER"]
+        return current_app.testing if eager is None else eager
+
+    def enqueue(self, name, *args):
+        if self.eager:
+            self._registry[name](*args)
+            return
+        state = self._state()
+        with state.lock:
+            state.pending += 1
+        state.backend.put(name, list(args))
+        alive = sum(w.is_alive() for w in state.workers)
+        if alive < state.app.config["TASK_WORKERS"]:
+            self._start_workers(state)
+
+    def _start_workers(self, state):
+        with state.lock:
+            state.workers = [w for w in state.workers if w.is_alive()]
+            while len(state.workers) < state.app.config["TASK_WORKERS"]:
+                worker = threading.Thread(
+                    target=self._work,
+                    args=(state,),
+                    name=f"blog-task-{len(state.workers)}",
+                    daemon=True,
+                )
+                worker.start()
+                state.workers.append(worker)
+
+    def _work(self, state):
+        while True:
+            try:
+                job = state.backend.get(timeout=1.0)
+                if job is not None:
+                    with state.app.app_context():
+                        self.run(job)
+            except Exception:
+                # e.g. a locked SQLite queue; a leased job comes back later
+                logger.exception("Task worker error")
+                time.sleep(1.0)
+
+    def _done(self, state, job):
+        state.backend.ack(job)
+        with state.lock:
+            state.pending = max(state.pending - 1, 0)
+
+    def run(self, job):
+        """Run ``job`` inside the app context of its queue."""
+        state = self._state()
+        func = self._registry.get(job.name)
+        if func is None:
+            logger.error("Dropping job %s: unknown task %s", job.id, job.name)
+            self._done(state, job)
+            return
+        try:
+            func(*job.args)
+        except Exception:
+            if job.attempts >= current_app.config["TASK_MAX_RETRIES"]:
+                logger.exception("Task %s%r failed, giving up", job.name, job.args)
+                self._done(state, job)
+                state.failed += 1
+            else:
+                delay = current_app.config["TASK_RETRY_BACKOFF"] * 2**job.attempts
+                logger.warning(
+                    "Task %s%r failed, retrying in %.1fs",
+                    job.name,
+                    job.args,
+                    delay,
+                    exc_info=True,
+                )
+                state.backend.retry(job, time.time() + delay)
+                state.retried += 1
+            return
+        self._done(state, job)
+        state.succeeded += 1
+
+    def join(self, timeout=10.0):
+        """Wait until every queued job has run; returns False on timeout."""
+        state = self._state()
+        deadline = time.monotonic() + timeout
+        # jobs queued by this process count until they are done; the backend
+        # length covers leased jobs and ones left behind by other processes
+        while state.pending or len(state.backend):
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def stats(self):
+        state = self._state()
+        return {
+            "succeeded": state.succeeded,
+            "retried": state.retried,
+            "failed": state.failed,
+        }
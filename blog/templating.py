@@ -0,0 +1,58 @@
+import os
+from functools import lru_cache
+
+from flask import current_app
+from jinja2 import FileSystemBytecodeCache
+
+from blog.cache import MemoryBackend
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+@lru_cache(maxsize=4096)
+def format_timestamp(value):
+    return value.strftime(TIMESTAMP_FORMAT)
+
+
+class Templates(object):
+    """Template environment tuning: bytecode cache, filters and fragments.
+
+    ``fragment(macro, key, *args)`` calls ``macro(*args)`` only when ``key``
+    hasn't been rendered recently; keys hold the id of the row plus every
+    value the snippet shows that can change (edit time, author name, counts),
+    so list pages only re-render the rows that changed. Each application has
+    its own fragments (``app.extensions["templates"]``).
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("JINJA_BYTECODE_CACHE_DIR", None)
+        app.config.setdefault("FRAGMENT_CACHE_SIZE", 2000)
+        app.config.setdefault("FRAGMENT_CACHE_TIMEOUT", 3600)
+        directory = app.config["JINJA_BYTECODE_CACHE_DIR"]
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+        app.extensions["templates"] = MemoryBackend(
+            app.config["FRAGMENT_CACHE_SIZE"], app.config["FRAGMENT_CACHE_TIMEOUT"]
+        )
+        app.add_template_filter(format_timestamp, "timestamp")
+        app.add_template_global(self.fragment)
+
+    @property
+    def fragments(self):
+        return current_app.extensions["templates"]
+
+    def fragment(self, macro, key, *args):
+        cache_key = f"{macro.name}:{key!r}"
+        html = self.fragments.get(cache_key)
+        if html is None:
+            html = macro(*args)
+            self.fragments.set(cache_key, html)
+        return html
+
+    def clear(self):
+        self.fragments.clear()
@@ -0,0 +1,144 @@
+"""Streaming export and bulk import of users, posts and comments.
+
+Rows are read through a server-side cursor (``stream_results``) in chunks and
+written out one line at a time, so exports run in constant memory. Imports
+insert ``chunk_size`` rows per ``executemany`` inside one transaction, keeping
+the ids of the source; import users before posts and posts before comments.
+"""
+
+import csv
+import json
+import time
+from datetime import datetime
+
+from sqlalchemy import DateTime, Integer, String, func, select
+
+from blog import db
+from blog.models import Comments, Posts, Users, make_excerpt
+
+TABLES = {
+    "users": Users.__table__,
+    "posts": Posts.__table__,
+    "comments": Comments.__table__,
+}
+FORMATS = ("ndjson", "csv")
+
+
+class Progress(object):
+    """Counts transferred rows and reports them with the rate so far."""
+
+    def __init__(self, name, report):
+        self.name = name
+        self.report = report
+        self.rows = 0
+        self.started = time.perf_counter()
+
+    @property
+    def rate(self):
+        elapsed = time.perf_counter() - self.started
+        return self.rows / elapsed if elapsed else 0.0
+
+    def add(self, rows):
+        self.rows += rows
+        self.report(f"{self.name}: {self.rows} rows, {self.rate:.0f} rows/s")
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def _decoder(column, fmt):
+    """Turn a serialized value back into what the column expects.
+
+    CSV has no null, so an empty field is NULL unless the column holds text.
+    """
+    if isinstance(column.type, DateTime):
+        parse = datetime.fromisoformat
+    elif fmt == "csv" and isinstance(column.type, Integer):
+        parse = int
+    else:
+        parse = None
+    text = isinstance(column.type, String)
+
+    def decode(value):
+        if value is None or (fmt == "csv" and value == "" and not text):
+            return None
+        return parse(value) if parse else value
+
+    return decode
+
+
+def export_rows(name, out, fmt="ndjson", chunk_size=1000, report=None):
+    """Write every row of table ``name`` to ``out``; returns a ``Progress``."""
+    table = TABLES[name]
+    columns = [column.key for column in table.columns]
+    progress = Progress(name, report or (lambda message: None))
+    if fmt == "csv":
+        writer = csv.writer(out)
+        writer.writerow(columns)
+    with db.engine.connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(
+            select([table]).order_by(*table.primary_key.columns)
+        )
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                values = [_encode(value) for value in row]
+                if fmt == "csv":
+                    writer.writerow(values)
+                else:
+                    out.write(json.dumps(dict(zip(columns, values))) + "\n")
+            progress.add(len(rows))
+    return progress
+
+
+def _records(source, fmt):
+    if fmt == "csv":
+        return csv.DictReader(source)
+    return (json.loads(line) for line in source if line.strip())
+
+
+def import_rows(name, source, fmt="ndjson", chunk_size=1000, report=None):
+    """Insert the rows read from ``source`` into table ``name``; returns a
+    ``Progress``. Nothing is inserted unless every chunk goes in."""
+    table = TABLES[name]
+    decoders = {column.key: _decoder(column, fmt) for column in table.columns}
+    progress = Progress(name, report or (lambda message: None))
+    insert = table.insert()
+    with db.engine.begin() as connection:
+        chunk = []
+        for record in _records(source, fmt):
+            unknown = record.keys() - decoders.keys()
+            if unknown:
+                raise ValueError(
+                    f"Unknown {name} columns: {', '.join(sorted(unknown))}"
+                )
+            row = {key: decoders[key](value) for key, value in record.items()}
+            if table is Posts.__table__ and "excerpt" not in row:
+                # exports made before the column existed
+                row["excerpt"] = make_excerpt(row.get("content"))
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                connection.execute(insert, chunk)
+                progress.add(len(chunk))
+                chunk = []
+        if chunk:
+            connection.execute(insert, chunk)
+            progress.add(len(chunk))
+        if connection.dialect.name == "postgresql" and progress.rows:
+            # ids were given explicitly, so the sequence hasn't moved
+            connection.execute(
+                select(
+                    [
+                        func.setval(
+                            func.pg_get_serial_sequence(table.name, "id"),
+                            select([func.max(table.c.id)]).as_scalar(),
+                        )
+                    ]
+                )
+            )
+    return progress
@@ -1,6 +1,8 @@
-from blog import app, db
+from blog import create_app, db
 from blog.models import Comments, Posts, Users
 
+app = create_app()
+
 
 @app.shell_context_processor
 def make_shell_context():
@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
@@ -9,3 +10,96 @@ class Config(object):
         "DATABASE_URL"
     ) or "sqlite:///" + os.path.join(basedir, "blog.db")
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # GET requests read from the replica when one is configured
+    SQLALCHEMY_BINDS = (
+        {"replica": os.environ["REPLICA_DATABASE_URL"]}
+        if os.environ.get("REPLICA_DATABASE_URL")
+        else None
+    )
+    # visitors who wrote read from the primary for this long, and pages
+    # invalidated by a write aren't cached again until it has passed
+    REPLICA_LAG_SECONDS = 5
+    # per process: size gunicorn workers so that workers * (size + overflow)
+    # stays below the server's max_connections
+    DATABASE_POOL_SIZE = int(os.environ.get("DATABASE_POOL_SIZE") or 5)
+    DATABASE_MAX_OVERFLOW = int(os.environ.get("DATABASE_MAX_OVERFLOW") or 10)
+    DATABASE_POOL_TIMEOUT = 30
+    DATABASE_POOL_RECYCLE = 1800
+    DATABASE_POOL_PRE_PING = True
+    # PostgreSQL only, 0 disables it
+    DATABASE_STATEMENT_TIMEOUT_MS = int(
+        os.environ.get("DATABASE_STATEMENT_TIMEOUT_MS") or 0
+    )
+    SQLITE_PRAGMAS = {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,
+    }
+    POSTS_PER_PAGE = 10
+    API_MAX_PER_PAGE = 100
+    # items per call of the batch create endpoints
+    API_MAX_BATCH_SIZE = 500
+    COMMENTS_PER_PAGE = 20
+    # send post pages as a streamed response, rendering comments as they load
+    STREAM_POST_PAGES = False
+    CACHE_TYPE = os.environ.get("CACHE_TYPE") or "simple"
+    CACHE_REDIS_URL = os.environ.get("CACHE_REDIS_URL")
+    CACHE_DEFAULT_TIMEOUT = 300
+    CACHE_THRESHOLD = 500
+    # the iteration count is part of the method; stored hashes made with other
+    # parameters are upgraded on the next successful login
+    PASSWORD_HASH_METHOD = "pbkdf2:sha256:150000"
+    PASSWORD_SALT_LENGTH = 16
+    CREDENTIAL_CACHE_TTL = 60
+    CREDENTIAL_CACHE_SIZE = 1024
+    USER_CACHE_TTL = 60
+    USER_CACHE_SIZE = 1024
+    # None follows TESTING; "0" turns the limits off, e.g. for benchmarks
+    RATELIMIT_ENABLED = (
+        os.environ["RATELIMIT_ENABLED"] == "1"
+        if os.environ.get("RATELIMIT_ENABLED")
+        else None
+    )
+    # "memory" counts per process, "redis" is shared by every worker
+    RATELIMIT_STORAGE = os.environ.get("RATELIMIT_STORAGE") or "memory"
+    RATELIMIT_REDIS_URL = os.environ.get("RATELIMIT_REDIS_URL") or CACHE_REDIS_URL
+    # proxies in front of the app whose X-Forwarded-For is trusted for the
+    # client address, 1 behind the Heroku router; 0 uses the peer address
+    RATELIMIT_TRUSTED_PROXIES = int(os.environ.get("RATELIMIT_TRUSTED_PROXIES") or 0)
+    # "<count>/<second|minute|hour|day>" per endpoint, counted per signed-in
+    # user or client address on POST/PUT/PATCH/DELETE only
+    RATELIMITS = {
+        "main.login": "10/minute",
+        "main.register": "5/hour",
+        "main.user": "10/minute",
+        "main.post": "10/minute",
+        "api.create_user": "5/hour",
+        "api.create_post": "10/minute",
+        "api.create_comment": "10/minute",
+        "api.create_posts": "10/minute",
+        "api.create_comments": "10/minute",
+    }
+    METRICS_ENABLED = os.environ.get("METRICS_ENABLED") == "1"
+    SERVER_TIMING_HEADER = False
+    SLOW_QUERY_THRESHOLD_MS = 100
+    # "memory" or "sqlite:///<path>" for jobs that survive a restart
+    TASK_QUEUE_URL = os.environ.get("TASK_QUEUE_URL") or "memory"
+    TASK_WORKERS = 2
+    TASK_MAX_RETRIES = 3
+    TASK_RETRY_BACKOFF = 1.0
+    # run jobs inline; None follows TESTING
+    TASK_EAGER = None
+    # compiled templates are shared by every worker started on the machine
+    JINJA_BYTECODE_CACHE_DIR = os.environ.get(
+        "JINJA_BYTECODE_CACHE_DIR"
+    ) or os.path.join(tempfile.gettempdir(), "blog-jinja-cache")
+    FRAGMENT_CACHE_SIZE = 2000
+    FRAGMENT_CACHE_TIMEOUT = 3600
+    # entries kept per personal feed, and the follower count above which an
+    # author's posts are merged in on read instead of copied to every feed
+    FEED_LENGTH = 500
+    FEED_FANOUT_LIMIT = 1000
+    # rows removed per DELETE (and per commit) when purging deleted posts
+    PURGE_BATCH_SIZE = 500
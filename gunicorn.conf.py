@@ -0,0 +1,33 @@
+"""gunicorn settings, read from the working directory.
+
+``WEB_WORKER_CLASS=sync`` (the default) gives every worker one request at a
+time. ``WEB_WORKER_CLASS=gevent`` runs each request in a greenlet, so that a
+worker keeps serving up to ``WEB_WORKER_CONNECTIONS`` clients while some of
+them wait on the network or the database. Sockets, locks and sleeps are
+patched before the app is imported, and psycopg2 is made cooperative with
+psycogreen, so the same models and sessions (one per greenlet) serve either
+mode. SQLite calls still block their worker, so the gevent mode pays off
+with PostgreSQL; size ``DATABASE_POOL_SIZE`` + ``DATABASE_MAX_OVERFLOW`` for
+the number of requests that should hit the database at once.
+"""
+
+import multiprocessing
+import os
+
+worker_class = os.environ.get("WEB_WORKER_CLASS") or "sync"
+workers = int(os.environ.get("WEB_CONCURRENCY") or multiprocessing.cpu_count() + 1)
+worker_connections = int(os.environ.get("WEB_WORKER_CONNECTIONS") or 1000)
+bind = os.environ.get("WEB_BIND") or f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+backlog = 2048
+# the app is built once in the master; create_app() doesn't connect anywhere
+preload_app = True
+
+if worker_class == "gevent":
+    from gevent import monkey
+
+    monkey.patch_all()
+
+    if (os.environ.get("DATABASE_URL") or "").startswith("postgres"):
+        from psycogreen.gevent import patch_psycopg
+
+        patch_psycopg()
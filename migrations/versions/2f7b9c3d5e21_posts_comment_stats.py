@@ -0,0 +1,36 @@
+"""denormalized comment count and last activity on posts
+
+Revision ID: 2f7b9c3d5e21
+Revises: 8c1d2e4f6a10
+Create Date: 2026-10-18 11:14:09.530417
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "2f7b9c3d5e21"
+down_revision = "8c1d2e4f6a10"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "posts",
+        sa.Column("comment_count", sa.Integer(), nullable=False, server_default="0"),
+    )
+    op.add_column("posts", sa.Column("last_comment_at", sa.DateTime(), nullable=True))
+    op.execute(
+        "UPDATE posts SET "
+        "comment_count = (SELECT count(*) FROM comments "
+        "WHERE comments.post_id = posts.id), "
+        "last_comment_at = (SELECT max(publication_datetime) FROM comments "
+        "WHERE comments.post_id = posts.id)"
+    )
+
+
+def downgrade():
+    with op.batch_alter_table("posts") as batch_op:
+        batch_op.drop_column("last_comment_at")
+        batch_op.drop_column("comment_count")
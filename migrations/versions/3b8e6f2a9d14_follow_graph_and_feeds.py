@@ -0,0 +1,63 @@
+"""follow graph and precomputed feeds
+
+Revision ID: 3b8e6f2a9d14
+Revises: e1f3a5b7c9d2
+Create Date: 2026-10-18 17:12:44.318205
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "3b8e6f2a9d14"
+down_revision = "e1f3a5b7c9d2"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "users",
+        sa.Column("follower_count", sa.Integer(), server_default="0", nullable=False),
+    )
+    op.create_table(
+        "followers",
+        sa.Column("follower_id", sa.Integer(), nullable=False),
+        sa.Column("followed_id", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(["followed_id"], ["users.id"]),
+        sa.ForeignKeyConstraint(["follower_id"], ["users.id"]),
+        sa.PrimaryKeyConstraint("follower_id", "followed_id"),
+    )
+    op.create_index(
+        "ix_followers_followed_id", "followers", ["followed_id"], unique=False
+    )
+    op.create_table(
+        "feed_entries",
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("post_id", sa.Integer(), nullable=False),
+        sa.Column("publication_datetime", sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(["post_id"], ["posts.id"]),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"]),
+        sa.PrimaryKeyConstraint("user_id", "post_id"),
+    )
+    op.create_index(
+        "ix_feed_entries_user_id_publication_datetime",
+        "feed_entries",
+        ["user_id", "publication_datetime", "post_id"],
+        unique=False,
+    )
+    op.create_index(
+        "ix_feed_entries_post_id", "feed_entries", ["post_id"], unique=False
+    )
+
+
+def downgrade():
+    op.drop_index("ix_feed_entries_post_id", table_name="feed_entries")
+    op.drop_index(
+        "ix_feed_entries_user_id_publication_datetime", table_name="feed_entries"
+    )
+    op.drop_table("feed_entries")
+    op.drop_index("ix_followers_followed_id", table_name="followers")
+    op.drop_table("followers")
+    with op.batch_alter_table("users") as batch_op:
+        batch_op.drop_column("follower_count")
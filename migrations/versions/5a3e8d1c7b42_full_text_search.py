@@ -0,0 +1,43 @@
+"""full-text search index over posts and comments
+
+Revision ID: 5a3e8d1c7b42
+Revises: 2f7b9c3d5e21
+Create Date: 2026-10-18 13:40:22.861950
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "5a3e8d1c7b42"
+down_revision = "2f7b9c3d5e21"
+branch_labels = None
+depends_on = None
+
+DOCUMENT = "to_tsvector('english', coalesce(title, '') || ' ' || coalesce(content, ''))"
+
+
+def upgrade():
+    if op.get_bind().dialect.name == "postgresql":
+        op.execute(f"CREATE INDEX ix_posts_search ON posts USING gin ({DOCUMENT})")
+        op.execute(f"CREATE INDEX ix_comments_search ON comments USING gin ({DOCUMENT})")
+        return
+    op.execute(
+        "CREATE VIRTUAL TABLE search_index USING fts5(title, content, "
+        "post_id UNINDEXED, tokenize = 'unicode61 remove_diacritics 2')"
+    )
+    op.execute(
+        "INSERT INTO search_index (rowid, title, content, post_id) "
+        "SELECT id * 2, title, content, id FROM posts"
+    )
+    op.execute(
+        "INSERT INTO search_index (rowid, title, content, post_id) "
+        "SELECT id * 2 + 1, title, content, post_id FROM comments"
+    )
+
+
+def downgrade():
+    if op.get_bind().dialect.name == "postgresql":
+        op.execute("DROP INDEX ix_comments_search")
+        op.execute("DROP INDEX ix_posts_search")
+        return
+    op.execute("DROP TABLE search_index")
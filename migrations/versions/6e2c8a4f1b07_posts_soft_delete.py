@@ -0,0 +1,33 @@
+"""soft deletion of posts
+
+Revision ID: 6e2c8a4f1b07
+Revises: 9d4a7c1e5f38
+Create Date: 2026-10-18 20:37:15.082346
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "6e2c8a4f1b07"
+down_revision = "9d4a7c1e5f38"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("posts", sa.Column("deleted_at", sa.DateTime(), nullable=True))
+    op.create_index(
+        op.f("ix_posts_deleted_at"), "posts", ["deleted_at"], unique=False
+    )
+
+
+def downgrade():
+    # posts waiting for the purge would come back without the column
+    deleted = "SELECT id FROM posts WHERE deleted_at IS NOT NULL"
+    op.execute(f"DELETE FROM comments WHERE post_id IN ({deleted})")
+    op.execute(f"DELETE FROM feed_entries WHERE post_id IN ({deleted})")
+    op.execute("DELETE FROM posts WHERE deleted_at IS NOT NULL")
+    op.drop_index(op.f("ix_posts_deleted_at"), table_name="posts")
+    with op.batch_alter_table("posts") as batch_op:
+        batch_op.drop_column("deleted_at")
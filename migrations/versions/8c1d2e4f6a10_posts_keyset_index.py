@@ -0,0 +1,27 @@
+"""composite index for keyset pagination of posts
+
+Revision ID: 8c1d2e4f6a10
+Revises: 47ef0bd09865
+Create Date: 2026-10-18 10:02:41.118302
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "8c1d2e4f6a10"
+down_revision = "47ef0bd09865"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "ix_posts_publication_datetime_id",
+        "posts",
+        ["publication_datetime", "id"],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index("ix_posts_publication_datetime_id", table_name="posts")
@@ -0,0 +1,70 @@
+"""stored excerpt of posts
+
+Revision ID: 9d4a7c1e5f38
+Revises: 3b8e6f2a9d14
+Create Date: 2026-10-18 19:02:51.604113
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "9d4a7c1e5f38"
+down_revision = "3b8e6f2a9d14"
+branch_labels = None
+depends_on = None
+
+# as of this revision; the app's copy (blog.models) may change later
+EXCERPT_LENGTH = 200
+
+
+def make_excerpt(content, length=EXCERPT_LENGTH):
+    if content is None:
+        return None
+    text = " ".join(content.split())
+    if len(text) <= length:
+        return text
+    cut = text[: length - 1]
+    if text[length - 1] != " " and " " in cut:
+        cut = cut.rsplit(" ", 1)[0]
+    return cut.rstrip() + "\u2026"
+
+
+posts = sa.table(
+    "posts",
+    sa.column("id", sa.Integer),
+    sa.column("content", sa.Text),
+    sa.column("excerpt", sa.String),
+)
+
+
+def upgrade():
+    op.add_column(
+        "posts", sa.Column("excerpt", sa.String(length=EXCERPT_LENGTH), nullable=True)
+    )
+    connection = op.get_bind()
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select([posts.c.id, posts.c.content])
+            .where(posts.c.id > last_id)
+            .order_by(posts.c.id)
+            .limit(1000)
+        ).fetchall()
+        if not rows:
+            break
+        connection.execute(
+            posts.update()
+            .where(posts.c.id == sa.bindparam("post_id"))
+            .values(excerpt=sa.bindparam("new_excerpt")),
+            [
+                {"post_id": id, "new_excerpt": make_excerpt(content)}
+                for id, content in rows
+            ],
+        )
+        last_id = rows[-1].id
+
+
+def downgrade():
+    with op.batch_alter_table("posts") as batch_op:
+        batch_op.drop_column("excerpt")
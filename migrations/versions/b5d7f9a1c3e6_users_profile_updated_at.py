@@ -0,0 +1,33 @@
+"""users profile update time
+
+Revision ID: b5d7f9a1c3e6
+Revises: 6e2c8a4f1b07
+Create Date: 2026-10-18 22:04:51.517203
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "b5d7f9a1c3e6"
+down_revision = "6e2c8a4f1b07"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "users", sa.Column("profile_updated_at", sa.DateTime(), nullable=True)
+    )
+    op.create_index(
+        op.f("ix_users_profile_updated_at"),
+        "users",
+        ["profile_updated_at"],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index(op.f("ix_users_profile_updated_at"), table_name="users")
+    with op.batch_alter_table("users") as batch_op:
+        batch_op.drop_column("profile_updated_at")
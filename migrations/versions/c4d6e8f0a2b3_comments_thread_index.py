@@ -0,0 +1,27 @@
+"""composite index for keyset pagination of comment threads
+
+Revision ID: c4d6e8f0a2b3
+Revises: 5a3e8d1c7b42
+Create Date: 2026-10-18 14:52:37.204419
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "c4d6e8f0a2b3"
+down_revision = "5a3e8d1c7b42"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "ix_comments_post_id_publication_datetime",
+        "comments",
+        ["post_id", "publication_datetime", "id"],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index("ix_comments_post_id_publication_datetime", table_name="comments")
@@ -0,0 +1,29 @@
+"""author indexes on posts and comments
+
+Revision ID: e1f3a5b7c9d2
+Revises: c4d6e8f0a2b3
+Create Date: 2026-10-18 15:31:05.772146
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "e1f3a5b7c9d2"
+down_revision = "c4d6e8f0a2b3"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "ix_posts_author_id_publication_datetime",
+        "posts",
+        ["author_id", "publication_datetime", "id"],
+        unique=False,
+    )
+    op.create_index("ix_comments_author_id", "comments", ["author_id"], unique=False)
+
+
+def downgrade():
+    op.drop_index("ix_comments_author_id", table_name="comments")
+    op.drop_index("ix_posts_author_id_publication_datetime", table_name="posts")
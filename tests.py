@@ -1,18 +1,146 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
+from base64 import b64encode
+from contextlib import contextmanager
+from datetime import datetime
+from io import StringIO
+from unittest import mock
 
-from blog import app, db
-from blog.models import Comments, Posts, Users
+from flask import Flask
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from werkzeug.http import http_date
+from werkzeug.security import check_password_hash
+
+from blog import cache, create_app, db, limiter, metrics, search, templates, transfer
+from blog.cache import RedisBackend
+from blog.cli import (
+    bulk_create,
+    export,
+    import_,
+    purge_deleted,
+    reconcile_counters,
+    search_rebuild,
+)
+from blog.models import (
+    Comments,
+    FeedEntry,
+    Posts,
+    Users,
+    identity_cache,
+    identity_cache_stats,
+    make_excerpt,
+)
+from blog.pagination import keyset_paginate
+from blog.purge import purge
+from blog.ratelimit import MemoryBucketStore, RedisBucketStore, parse_limit
+from blog.tasks import Job, SQLiteQueue, TaskQueue
+from blog.templating import format_timestamp
+from config import Config
+
+
+class TestConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = "sqlite://"
+
+
+class FakeRedis(object):
+    """The part of the redis client the cache uses, kept in a dict."""
+
+    def __init__(self):
+        self.data = {}
+        self.expiry = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+        self.expiry[key] = ex
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1).encode()
+        return int(self.data[key])
+
+    def scan_iter(self, pattern):
+        return [key for key in list(self.data) if key.startswith(pattern[:-1])]
+
+
+@contextmanager
+def count_queries():
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
+
+class AppFactoryTestCase(unittest.TestCase):
+    def test_apps_are_independent(self):
+        first, second = create_app(TestConfig), create_app(TestConfig)
+        first.config["POSTS_PER_PAGE"] = 1
+        self.assertEqual(second.config["POSTS_PER_PAGE"], 10)
+        endpoints = {rule.endpoint for rule in second.url_map.iter_rules()}
+        self.assertTrue({"main.index", "api.list_posts", "metrics"} <= endpoints)
+        self.assertIn("search-rebuild", second.cli.list_commands(None))
+
+    def test_no_connection_at_startup(self):
+        with mock.patch.object(db, "create_engine") as create_engine:
+            create_app(TestConfig)
+        create_engine.assert_not_called()
+
+
+class GreenletTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        db.session.remove()
+        self.app_context.pop()
+
+    def test_sessions_are_per_greenlet(self):
+        greenlet = __import__("greenlet").greenlet
+        sessions = []
+
+        def request():
+            # like a gevent worker: every greenlet has its own context
+            with self.app.app_context():
+                sessions.append(db.session())
+
+        for _ in range(2):
+            greenlet(request).switch()
+        sessions.append(db.session())
+        self.assertEqual(len({id(session) for session in sessions}), 3)
 
 
 class UserModelCase(unittest.TestCase):
     def setUp(self):
-        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
-        app.config["TESTING"] = True
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
         db.create_all()
 
     def tearDown(self):
         db.session.remove()
         db.drop_all()
+        cache.clear()
+        identity_cache.clear()
+        self.app_context.pop()
 
     def test_password_hashing(self):
         u = Users(username="timmy")
@@ -20,18 +148,60 @@ class UserModelCase(unittest.TestCase):
         self.assertFalse(u.check_password("dog"))
         self.assertTrue(u.check_password("cat"))
 
+    def test_password_rehash(self):
+        self.app.config["PASSWORD_HASH_METHOD"] = "pbkdf2:sha256:1000"
+        u = Users(username="timmy")
+        u.set_password("cat")
+        self.assertTrue(u.password_hash.startswith("pbkdf2:sha256:1000$"))
+        self.assertFalse(u.password_needs_rehash())
+
+        self.app.config["PASSWORD_HASH_METHOD"] = "pbkdf2:sha256:2000"
+        self.assertTrue(u.password_needs_rehash())
+        self.assertFalse(u.check_password("dog"))
+        self.assertTrue(u.password_hash.startswith("pbkdf2:sha256:1000$"))
+        self.assertTrue(u.check_password("cat"))
+        self.assertTrue(u.password_hash.startswith("pbkdf2:sha256:2000$"))
+        self.assertTrue(u.check_password("cat"))
+
+    def test_verified_credentials_cache(self):
+        u = Users(username="timmy", email="timmy@tim.ru")
+        u.set_password("cat")
+        db.session.add(u)
+        db.session.commit()
+        with mock.patch(
+            "blog.models.check_password_hash", wraps=check_password_hash
+        ) as checked:
+            self.assertTrue(u.check_password("cat"))
+            self.assertTrue(u.check_password("cat"))
+            self.assertFalse(u.check_password("dog"))
+            self.assertEqual(checked.call_count, 2)
+
+            u.username = "tommy"
+            self.assertTrue(u.check_password("cat"))
+            self.assertEqual(checked.call_count, 3)
+
+            u.set_password("dog")
+            self.assertFalse(u.check_password("cat"))
+            self.assertTrue(u.check_password("dog"))
+            self.assertTrue(u.check_password("dog"))
+            self.assertEqual(checked.call_count, 5)
+
 
 class AuthorizationTestCase(unittest.TestCase):
     def setUp(self):
-        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
-        app.config["TESTING"] = True
-        app.config["WTF_CSRF_ENABLED"] = False
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.app.config["WTF_CSRF_ENABLED"] = False
         db.create_all()
-        self.client = app.test_client()
+        self.client = self.app.test_client()
 
     def tearDown(self):
         db.session.remove()
         db.drop_all()
+        cache.clear()
+        identity_cache.clear()
+        self.app_context.pop()
 
     def test_index(self):
         req = self.client.get("/")
@@ -113,6 +283,33 @@ class AuthorizationTestCase(unittest.TestCase):
             b"You haven't got any posts, create it!", invalid_username.data
         )
 
+    def test_identity_cache(self):
+        self.client.post(
+            "/register",
+            data={
+                "username": "user",
+                "email": "u@u.ru",
+                "password": 123,
+                "password2": 123,
+            },
+            follow_redirects=True,
+        )
+        self.client.post(
+            "/login", data={"username": "user", "password": 123}, follow_redirects=True
+        )
+        identity_cache.clear()
+
+        self.client.get("/")
+        with count_queries() as statements:
+            response = self.client.get("/")
+        self.assertIn(b"Hello, user!", response.data)
+        self.assertFalse(any("FROM users" in s for s in statements))
+        self.assertEqual(identity_cache_stats()["hits"], 1)
+        self.assertEqual(identity_cache_stats()["hit_rate"], 0.5)
+
+        self.client.post("/edit_profile", data={"username": "New name"})
+        self.assertIn(b"Hello, New name!", self.client.get("/").data)
+
     def test_changing_username(self):
         self.client.post(
             "/register",
@@ -159,11 +356,12 @@ class AuthorizationTestCase(unittest.TestCase):
 
 class PostsTestCase(unittest.TestCase):
     def setUp(self):
-        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
-        app.config["TESTING"] = True
-        app.config["WTF_CSRF_ENABLED"] = False
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.app.config["WTF_CSRF_ENABLED"] = False
         db.create_all()
-        self.client = app.test_client()
+        self.client = self.app.test_client()
         self.client.post(
             "/register",
             data={
@@ -182,6 +380,9 @@ class PostsTestCase(unittest.TestCase):
     def tearDown(self):
         db.session.remove()
         db.drop_all()
+        cache.clear()
+        identity_cache.clear()
+        self.app_context.pop()
 
     def test_creation_post(self):
         self.assertEqual(self.client.get("user/Tim").status_code, 200)
@@ -219,6 +420,25 @@ class PostsTestCase(unittest.TestCase):
         self.assertEqual(Posts.query.first().title, "Another post!")
         self.assertEqual(Posts.query.first().content, "Good night!")
 
+    def test_excerpt_follows_content(self):
+        content = "Roses are red,\n\nviolets are blue. " * 20
+        self.client.post("user/Tim", data={"title": "Poem", "content": content})
+        excerpt = Posts.query.first().excerpt
+        self.assertEqual(excerpt, make_excerpt(content))
+        self.assertLessEqual(len(excerpt), 200)
+        self.assertTrue(excerpt.startswith("Roses are red, violets"))
+        self.assertTrue(excerpt.endswith("\u2026"))
+        self.assertIn(excerpt.encode(), self.client.get("/").data)
+
+        self.client.post("edit_post/1", data={"title": "Poem", "content": "Short"})
+        self.assertEqual(Posts.query.first().excerpt, "Short")
+
+    def test_make_excerpt(self):
+        self.assertIsNone(make_excerpt(None))
+        self.assertEqual(make_excerpt("  two\twords "), "two words")
+        self.assertEqual(make_excerpt("abc def", 5), "abc\u2026")
+        self.assertEqual(make_excerpt("abcdefgh", 5), "abcd\u2026")
+
     def test_deleting_post(self):
         self.client.post(
             "user/Tim",
@@ -237,14 +457,57 @@ class PostsTestCase(unittest.TestCase):
         self.assertIn(b"Your post is successfully deleted", response.data)
         self.assertEqual(Posts.query.all(), [])
 
+    def test_user_page_pagination(self):
+        self.app.config["POSTS_PER_PAGE"] = 2
+        for title in ("First post!", "Second post!", "Third post!"):
+            self.client.post("user/Tim", data={"title": title, "content": "Hello"})
+        response = self.client.get("user/Tim")
+        self.assertIn(b"Third post!", response.data)
+        self.assertNotIn(b"First post!", response.data)
+        self.assertIn(b"Older posts", response.data)
+
+    def test_index_pagination(self):
+        self.app.config["POSTS_PER_PAGE"] = 2
+        for title in ("First post!", "Second post!", "Third post!"):
+            self.client.post(
+                "user/Tim",
+                data={"title": title, "content": "Hello world!"},
+                follow_redirects=True,
+            )
+
+        first_page = self.client.get("/")
+        self.assertIn(b"Third post!", first_page.data)
+        self.assertIn(b"Second post!", first_page.data)
+        self.assertNotIn(b"First post!", first_page.data)
+        self.assertIn(b"Older posts", first_page.data)
+        self.assertNotIn(b"Newer posts", first_page.data)
+
+        second = Posts.query.filter_by(title="Second post!").first()
+        cursor = f"{second.publication_datetime.isoformat()}_{second.id}"
+        second_page = self.client.get("/", query_string={"after": cursor})
+        self.assertIn(b"First post!", second_page.data)
+        self.assertNotIn(b"Second post!", second_page.data)
+        self.assertIn(b"Newer posts", second_page.data)
+        self.assertNotIn(b"Older posts", second_page.data)
+
+        first = Posts.query.filter_by(title="First post!").first()
+        cursor = f"{first.publication_datetime.isoformat()}_{first.id}"
+        back_page = self.client.get("/", query_string={"before": cursor})
+        self.assertIn(b"Third post!", back_page.data)
+        self.assertIn(b"Second post!", back_page.data)
+        self.assertNotIn(b"Newer posts", back_page.data)
+
+        self.assertEqual(self.client.get("/?after=garbage").status_code, 400)
+
 
 class CommentsTestCase(unittest.TestCase):
     def setUp(self):
-        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
-        app.config["TESTING"] = True
-        app.config["WTF_CSRF_ENABLED"] = False
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.app.config["WTF_CSRF_ENABLED"] = False
         db.create_all()
-        self.client = app.test_client()
+        self.client = self.app.test_client()
         self.client.post(
             "/register",
             data={
@@ -269,6 +532,9 @@ class CommentsTestCase(unittest.TestCase):
     def tearDown(self):
         db.session.remove()
         db.drop_all()
+        cache.clear()
+        identity_cache.clear()
+        self.app_context.pop()
 
     def test_create_comment(self):
         self.assertEqual(self.client.get("post/1").status_code, 200)
@@ -336,6 +602,1631 @@ class CommentsTestCase(unittest.TestCase):
         self.assertIn(b"Your comment is successfully deleted", response.data)
         self.assertEqual(Comments.query.all(), [])
 
+    def test_comments_pagination(self):
+        self.app.config["COMMENTS_PER_PAGE"] = 2
+        for title in ("First comment", "Second comment"):
+            self.client.post("post/1", data={"title": title, "content": "Hi"})
+        response = self.client.post(
+            "post/1",
+            data={"title": "Third comment", "content": "Hi"},
+            follow_redirects=True,
+        )
+        self.assertIn(b"Third comment", response.data)
+        self.assertIn(b"Second comment", response.data)
+        self.assertNotIn(b"First comment", response.data)
+        self.assertIn(b"Earlier comments", response.data)
+        self.assertNotIn(b"Later comments", response.data)
+
+        response = self.client.get("post/1")
+        self.assertIn(b"First comment", response.data)
+        self.assertIn(b"Second comment", response.data)
+        self.assertNotIn(b"Third comment", response.data)
+        self.assertIn(b"Later comments", response.data)
+        self.assertNotIn(b"Earlier comments", response.data)
+
+    def test_streamed_post_page(self):
+        self.app.config["STREAM_POST_PAGES"] = True
+        self.client.post(
+            "post/1", data={"title": "First comment", "content": "Thanks everyone!"}
+        )
+        response = self.client.get("post/1")
+        self.assertTrue(response.is_streamed)
+        self.assertIn(b"Thanks everyone!", response.data)
+        self.assertIn("ETag", response.headers)
+
+        self.client.get("/logout")
+        self.client.get("post/1")
+        self.assertEqual(self.client.get("post/1").headers["X-Cache"], "MISS")
+
+    def test_comment_stats(self):
+        for title in ("First comment", "Second comment"):
+            self.client.post(
+                "post/1",
+                data={"title": title, "content": "Thanks everyone!"},
+                follow_redirects=True,
+            )
+        post = Posts.query.get(1)
+        first, second = Comments.query.order_by(Comments.id).all()
+        self.assertEqual(post.comment_count, 2)
+        self.assertEqual(post.last_comment_at, second.publication_datetime)
+        self.assertIn(b"(2 comments)", self.client.get("/").data)
+
+        self.client.post("edit_comment/2", data={"delete": "Delete"})
+        post = Posts.query.get(1)
+        self.assertEqual(post.comment_count, 1)
+        self.assertEqual(post.last_comment_at, first.publication_datetime)
+
+        Posts.query.update({Posts.comment_count: 42, Posts.last_comment_at: None})
+        db.session.commit()
+        # the command's app context removes the session when it ends
+        first_published = first.publication_datetime
+        result = self.app.test_cli_runner().invoke(reconcile_counters)
+        self.assertIn("Reconciled comment counters of 1 posts.", result.output)
+        post = Posts.query.get(1)
+        self.assertEqual(post.comment_count, 1)
+        self.assertEqual(post.last_comment_at, first_published)
+
+
+class QueryCountTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.app.config["WTF_CSRF_ENABLED"] = False
+        db.create_all()
+        self.client = self.app.test_client()
+        for name in ("Tim", "Tom", "Ann"):
+            author = Users(username=name, email=f"{name}@tim.ru")
+            author.set_password("123")
+            db.session.add(author)
+        db.session.commit()
+        authors = Users.query.all()
+        for i in range(6):
+            post = Posts(title=f"Post {i}", content="Hello", author=authors[i % 3])
+            db.session.add(post)
+            for j in range(3):
+                db.session.add(
+                    Comments(
+                        title=f"Comment {j}",
+                        content="Hi",
+                        author=authors[j],
+                        post=post,
+                    )
+                )
+        db.session.commit()
+        # the pages read the denormalized counters, so they must match the rows
+        Posts.reconcile_comment_stats()
+        db.session.commit()
+        self.client.post(
+            "/login", data={"username": "Tim", "password": 123}, follow_redirects=True
+        )
+        db.session.remove()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        cache.clear()
+        identity_cache.clear()
+        self.app_context.pop()
+
+    def assertQueriesAtMost(self, limit, url):
+        with count_queries() as statements:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(len(statements), limit, "\n".join(statements))
+        return response
+
+    def test_index_queries(self):
+        response = self.assertQueriesAtMost(1, "/")
+        self.assertIn(b"by Ann", response.data)
+
+    def test_post_queries(self):
+        self.assertEqual(Posts.query.get(1).comment_count, 3)
+        db.session.remove()
+        response = self.assertQueriesAtMost(2, "/post/1")
+        self.assertIn(b"Ann:", response.data)
+
+    def test_user_queries(self):
+        self.assertQueriesAtMost(2, "/user/Tim")
+
+    def test_lists_skip_post_bodies(self):
+        for url in ("/", "/user/Tim"):
+            with count_queries() as statements:
+                self.client.get(url)
+            self.assertFalse(any("posts.content" in s for s in statements), url)
+        with count_queries() as statements:
+            self.client.get("/post/1")
+        self.assertTrue(any("posts.content" in s for s in statements))
+
+
+class PageCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.app.config["WTF_CSRF_ENABLED"] = False
+        db.create_all()
+        self.anonymous = self.app.test_client()
+        self.client = self.app.test_client()
+        self.client.post(
+            "/register",
+            data={
+                "username": "Tim",
+                "email": "tim@tim.ru",
+                "password": 123,
+                "password2": 123,
+            },
+            follow_redirects=True,
+        )
+        self.client.post(
+            "/login", data={"username": "Tim", "password": 123}, follow_redirects=True
+        )
+        self.client.post(
+            "user/Tim",
+            data={"title": "First post!", "content": "Hello world!"},
+            follow_redirects=True,
+        )
+        cache.clear()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        cache.clear()
+        identity_cache.clear()
+        self.app_context.pop()
+
+    def test_anonymous_pages_are_cached(self):
+        self.assertEqual(self.anonymous.get("/").headers["X-Cache"], "MISS")
+        response = self.anonymous.get("/")
+        self.assertEqual(response.headers["X-Cache"], "HIT")
+        self.assertIn(b"First post!", response.data)
+        self.assertEqual(self.anonymous.get("/post/1").headers["X-Cache"], "MISS")
+        self.assertEqual(self.anonymous.get("/post/1").headers["X-Cache"], "HIT")
+        self.assertEqual(cache.stats(), {"hits": 2, "misses": 2})
+
+    def test_authenticated_pages_are_not_cached(self):
+        self.client.get("/")
+        self.assertNotIn("X-Cache", self.client.get("/").headers)
+        self.assertEqual(cache.stats(), {"hits": 0, "misses": 0})
+
+    def test_writes_invalidate(self):
+        self.anonymous.get("/")
+        self.anonymous.get("/post/1")
+        self.client.post(
+            "post/1",
+            data={"title": "First comment", "content": "Thanks everyone!"},
+            follow_redirects=True,
+        )
+        response = self.anonymous.get("/post/1")
+        self.assertEqual(response.headers["X-Cache"], "MISS")
+        self.assertIn(b"Thanks everyone!", response.data)
+        self.assertIn(b"(1 comments)", self.anonymous.get("/").data)
+
+        self.client.post(
+            "edit_post/1",
+            data={"title": "Another post!", "content": "Good night!"},
+            follow_redirects=True,
+        )
+        self.assertIn(b"Another post!", self.anonymous.get("/").data)
+        self.assertIn(b"Good night!", self.anonymous.get("/post/1").data)
+
+        self.client.post(
+            "/edit_profile", data={"username": "Tom"}, follow_redirects=True
+        )
+        self.assertIn(b"by Tom", self.anonymous.get("/").data)
+
+    def test_redis_backend(self):
+        client = FakeRedis()
+        client.set("other:key", b"kept")
+        backend = RedisBackend(client, default_timeout=60)
+        self.assertIsNone(backend.get("page"))
+        backend.set("page", {"body": "Hello"})
+        self.assertEqual(backend.get("page"), {"body": "Hello"})
+        self.assertEqual(client.expiry["blog:page"], 60)
+        backend.set("page", "Bye", timeout=5)
+        self.assertEqual(client.expiry["blog:page"], 5)
+        self.assertEqual(backend.get_counter("gen:feed"), 0)
+        self.assertEqual(backend.incr("gen:feed"), 1)
+        self.assertEqual(backend.get_counter("gen:feed"), 1)
+        backend.delete("page")
+        self.assertIsNone(backend.get("page"))
+        backend.clear()
+        self.assertEqual(client.data, {"other:key": b"kept"})
+
+    def test_shared_backend_serves_pages(self):
+        client = FakeRedis()
+        with mock.patch.object(
+            RedisBackend, "from_url", return_value=RedisBackend(client)
+        ) as from_url:
+            app = create_app(
+                type("RedisConfig", (TestConfig,), {"CACHE_TYPE": "redis"})
+            )
+        from_url.assert_called_once()
+        anonymous = app.test_client()
+        with app.app_context():
+            db.create_all()
+            self.assertEqual(anonymous.get("/").headers["X-Cache"], "MISS")
+            response = anonymous.get("/")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers["X-Cache"], "HIT")
+            self.assertTrue(any(key.startswith("blog:page:") for key in client.data))
+
+    def test_null_cache_type(self):
+        app = create_app(type("NullConfig", (TestConfig,), {"CACHE_TYPE": "null"}))
+        with app.app_context():
+            db.create_all()
+            self.assertIsNone(cache.backend)
+            self.assertNotIn("X-Cache", app.test_client().get("/").headers)
+        # the app built first keeps its own cache
+        self.assertIsNotNone(cache.backend)
+        self.assertEqual(self.anonymous.get("/").headers["X-Cache"], "MISS")
+        self.assertEqual(self.anonymous.get("/").headers["X-Cache"], "HIT")
+
+
+class ConditionalGetTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.app.config["WTF_CSRF_ENABLED"] = False
+        db.create_all()
+        self.client = self.app.test_client()
+        self.client.post(
+            "/register",
+            data={
+                "username": "Tim",
+                "email": "tim@tim.ru",
+                "password": 123,
+                "password2": 123,
+            },
+            follow_redirects=True,
+        )
+        self.client.post(
+            "/login", data={"username": "Tim", "password": 123}, follow_redirects=True
+        )
+        self.client.post(
+            "user/Tim",
+            data={"title": "First post!", "content": "Hello world!"},
+            follow_redirects=True,
+        )
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        cache.clear()
+        identity_cache.clear()
+        self.app_context.pop()
+
+    def test_post_not_modified(self):
+        self.client.post(
+            "post/1",
+            data={"title": "First comment", "content": "Thanks everyone!"},
+            follow_redirects=True,
+        )
+        response = self.client.get("/post/1")
+        etag = response.headers["ETag"]
+        self.assertIsNone(response.last_modified)
+
+        with count_queries() as statements:
+            response = self.client.get("/post/1", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b"")
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn("FROM comments", statements[0])
+
+        self.client.post(
+            "post/1",
+            data={"title": "Second comment", "content": "Thanks again!"},
+            follow_redirects=True,
+        )
+        response = self.client.get("/post/1", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_etag_depends_on_viewer(self):
+        etag = self.client.get("/post/1").headers["ETag"]
+        anonymous = self.app.test_client()
+        response = anonymous.get("/post/1", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        response = anonymous.get(
+            "/post/1", headers={"If-None-Match": response.headers["ETag"]}
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def test_feed_not_modified(self):
+        etag = self.client.get("/").headers["ETag"]
+        response = self.client.get("/", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+
+        self.client.post(
+            "edit_post/1",
+            data={"title": "Another post!", "content": "Good night!"},
+            follow_redirects=True,
+        )
+        response = self.client.get("/", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"Another post!", response.data)
+
+    def auth(self):
+        return {"Authorization": "Basic " + b64encode(b"Tim:123").decode()}
+
+    def test_feed_modified_after_delete(self):
+        self.client.post(
+            "user/Tim",
+            data={"title": "Second post!", "content": "Hello again!"},
+            follow_redirects=True,
+        )
+        etag = self.client.get("/").headers["ETag"]
+        response = self.client.delete("/api/v1/posts/2", headers=self.auth())
+        self.assertEqual(response.status_code, 204)
+        response = self.client.get(
+            "/",
+            headers={
+                "If-None-Match": etag,
+                "If-Modified-Since": http_date(datetime.utcnow()),
+            },
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(b"Second post!", response.data)
+
+    def test_post_modified_after_comment_delete(self):
+        for title in ("First comment", "Second comment"):
+            self.client.post(
+                "post/1",
+                data={"title": title, "content": "Thanks everyone!"},
+                follow_redirects=True,
+            )
+        etag = self.client.get("/post/1").headers["ETag"]
+        response = self.client.delete("/api/v1/comments/2", headers=self.auth())
+        self.assertEqual(response.status_code, 204)
+        response = self.client.get("/post/1", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(b"Second comment", response.data)
+
+    def test_post_modified_after_commenter_rename(self):
+        other = self.app.test_client()
+        other.post(
+            "/register",
+            data={
+                "username": "Tom",
+                "email": "tom@tom.ru",
+                "password": 123,
+                "password2": 123,
+            },
+            follow_redirects=True,
+        )
+        other.post(
+            "/login", data={"username": "Tom", "password": 123}, follow_redirects=True
+        )
+        other.post(
+            "post/1",
+            data={"title": "First comment", "content": "Thanks everyone!"},
+            follow_redirects=True,
+        )
+        etag = self.client.get("/post/1").headers["ETag"]
+        other.post("/edit_profile", data={"username": "Tommy"}, follow_redirects=True)
+        response = self.client.get("/post/1", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"Tommy", response.data)
+
+
+class APITestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+        for name in ("Tim", "Tom"):
+            response = self.client.post(
+                "/api/v1/users",
+                json={"username": name, "email": f"{name}@tim.ru", "password": "123"},
+            )
+            self.assertEqual(response.status_code, 201)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        cache.clear()
+        identity_cache.clear()
+        self.app_context.pop()
+
+    def auth(self, username, password="123"):
+        token = b64encode(f"{username}:{password}".encode()).decode()
+        return {"Authorization": f"Basic {token}"}
+
+    def test_register_validation(self):
+        response = self.client.post(
+            "/api/v1/users",
+            json={"username": "Tim", "email": "new@tim.ru", "password": "123"},
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("username", response.get_json()["message"])
+
+    def test_email_is_not_public(self):
+        response = self.client.post(
+            "/api/v1/users",
+            json={"username": "Ann", "email": "ann@tim.ru", "password": "123"},
+        )
+        self.assertEqual(response.get_json()["email"], "ann@tim.ru")
+        response = self.client.get("/api/v1/users/1")
+        self.assertEqual(response.get_json(), {"id": 1, "username": "Tim"})
+
+    def test_fields_must_be_strings(self):
+        for content in (5, ["Hello", "world"], None):
+            response = self.client.post(
+                "/api/v1/posts",
+                json={"title": "First post!", "content": content},
+                headers=self.auth("Tim"),
+            )
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(
+                response.get_json()["message"], {"content": ["Expected a string."]}
+            )
+        response = self.client.post(
+            "/api/v1/users", json={"username": 7, "email": "x@x.ru", "password": "1"}
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("username", response.get_json()["message"])
+        self.assertEqual(Posts.query.count(), 0)
+
+    def test_posts_crud(self):
+        response = self.client.post(
+            "/api/v1/posts", json={"title": "First post!", "content": "Hello world!"}
+        )
+        self.assertEqual(response.status_code, 401)
+        self.assertIn("Basic", response.headers["WWW-Authenticate"])
+        response = self.client.post(
+            "/api/v1/posts",
+            json={"title": "First post!", "content": "Hello world!"},
+            headers=self.auth("Tim", "wrong"),
+        )
+        self.assertEqual(response.status_code, 401)
+
+        response = self.client.post(
+            "/api/v1/posts",
+            json={"title": "First post!", "content": "Hello world!"},
+            headers=self.auth("Tim"),
+        )
+        self.assertEqual(response.status_code, 201)
+        post = response.get_json()
+        self.assertEqual(post["title"], "First post!")
+        self.assertEqual(post["author_id"], 1)
+
+        response = self.client.put(
+            f"/api/v1/posts/{post['id']}",
+            json={"title": "Stolen", "content": "Mine now"},
+            headers=self.auth("Tom"),
+        )
+        self.assertEqual(response.status_code, 403)
+        response = self.client.put(
+            f"/api/v1/posts/{post['id']}",
+            json={"title": "Another post!", "content": ""},
+            headers=self.auth("Tim"),
+        )
+        self.assertEqual(response.status_code, 400)
+        response = self.client.put(
+            f"/api/v1/posts/{post['id']}",
+            json={"title": "Another post!", "content": "Good night!"},
+            headers=self.auth("Tim"),
+        )
+        self.assertEqual(response.get_json()["title"], "Another post!")
+        self.assertEqual(
+            self.client.get(f"/api/v1/posts/{post['id']}").get_json()["content"],
+            "Good night!",
+        )
+
+        response = self.client.delete(
+            f"/api/v1/posts/{post['id']}", headers=self.auth("Tim")
+        )
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(
+            self.client.get(f"/api/v1/posts/{post['id']}").status_code, 404
+        )
+
+    def test_posts_pagination(self):
+        for i in range(5):
+            self.client.post(
+                "/api/v1/posts",
+                json={"title": f"Post {i}", "content": "Hello"},
+                headers=self.auth("Tim"),
+            )
+        response = self.client.get("/api/v1/posts?per_page=3")
+        page = response.get_json()
+        self.assertEqual(
+            [item["title"] for item in page["items"]], ["Post 4", "Post 3", "Post 2"]
+        )
+        self.assertIsNone(page["prev"])
+        page = self.client.get(page["next"]).get_json()
+        self.assertEqual(
+            [item["title"] for item in page["items"]], ["Post 1", "Post 0"]
+        )
+        self.assertIsNone(page["next"])
+        self.assertEqual(len(self.client.get("/api/v1/users/1/posts").json["items"]), 5)
+        self.assertEqual(self.client.get("/api/v1/users/2/posts").json["items"], [])
+
+    def test_comments_crud(self):
+        post = self.client.post(
+            "/api/v1/posts",
+            json={"title": "First post!", "content": "Hello world!"},
+            headers=self.auth("Tim"),
+        ).get_json()
+        url = f"/api/v1/posts/{post['id']}/comments"
+        response = self.client.post(
+            url,
+            json={"title": "First comment", "content": "Thanks everyone!"},
+            headers=self.auth("Tom"),
+        )
+        self.assertEqual(response.status_code, 201)
+        comment = response.get_json()
+        self.assertEqual(comment["author_id"], 2)
+        self.assertEqual(self.client.get(url).get_json()["items"], [comment])
+        self.assertEqual(
+            self.client.get(f"/api/v1/posts/{post['id']}").get_json()["comment_count"],
+            1,
+        )
+
+        response = self.client.put(
+            f"/api/v1/comments/{comment['id']}",
+            json={"title": "Edited", "content": "By post author"},
+            headers=self.auth("Tim"),
+        )
+        self.assertEqual(response.status_code, 403)
+        response = self.client.delete(
+            f"/api/v1/comments/{comment['id']}", headers=self.auth("Tom")
+        )
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.client.get(url).get_json()["items"], [])
+        self.assertEqual(self.client.get("/api/v1/posts/42/comments").status_code, 404)
+
+
+class SearchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.app.config["WTF_CSRF_ENABLED"] = False
+        db.create_all()
+        self.client = self.app.test_client()
+        self.client.post(
+            "/register",
+            data={
+                "username": "Tim",
+                "email": "tim@tim.ru",
+                "password": 123,
+                "password2": 123,
+            },
+            follow_redirects=True,
+        )
+        self.client.post(
+            "/login", data={"username": "Tim", "password": 123}, follow_redirects=True
+        )
+        self.client.post(
+            "user/Tim",
+            data={"title": "Gardening", "content": "Tomatoes need sunshine"},
+        )
+        self.client.post(
+            "user/Tim",
+            data={"title": "Sunshine", "content": "A sunny afternoon"},
+        )
+        self.client.post(
+            "post/1", data={"title": "Agreed", "content": "Mine love the sunshine"}
+        )
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        cache.clear()
+        identity_cache.clear()
+        self.app_context.pop()
+
+    def titles(self, query):
+        response = self.client.get("/search", query_string={"q": query})
+        self.assertEqual(response.status_code, 200)
+        return [
+            title
+            for title in ("Gardening", "Sunshine", "Agreed", "Again")
+            if f">{title}</a>".encode() in response.data
+        ]
+
+    def test_search_ranks_posts_and_comments(self):
+        response = self.client.get("/search", query_string={"q": "sunshine"})
+        self.assertIn(b"(comment)", response.data)
+        self.assertLess(
+            response.data.index(b">Sunshine<"), response.data.index(b">Gardening<")
+        )
+        self.assertEqual(self.titles("tomato"), ["Gardening"])
+        self.assertEqual(self.titles('" OR ( NEAR'), [])
+        self.assertIn(b"Nothing found", self.client.get("/search?q=cucumber").data)
+
+    def test_index_follows_writes(self):
+        self.client.post(
+            "edit_post/1", data={"title": "Gardening", "content": "Cucumbers instead"}
+        )
+        self.assertEqual(self.titles("tomatoes"), [])
+        self.assertEqual(self.titles("cucumbers"), ["Gardening"])
+
+        self.client.post("edit_comment/1", data={"delete": "Delete"})
+        self.assertEqual(self.titles("mine"), [])
+
+        self.client.post("post/1", data={"title": "Again", "content": "Mine too"})
+        self.assertEqual(self.titles("mine"), ["Again"])
+        self.client.post("edit_post/1", data={"delete": "Delete"})
+        self.assertEqual(self.titles("cucumbers"), [])
+        self.assertEqual(self.titles("mine"), [])
+        self.assertEqual(self.titles("sunny"), ["Sunshine"])
+
+    def test_reindex_is_queued_on_commit(self):
+        with mock.patch.object(search.reindex, "delay") as delay:
+            post = Posts.query.get(2)
+            post.content = "Rainy afternoon"
+            db.session.flush()
+            db.session.rollback()
+            delay.assert_not_called()
+            post.content = "Cloudy afternoon"
+            db.session.commit()
+        delay.assert_called_once_with([2], [])
+        self.assertEqual(self.titles("cloudy"), [])
+
+    def test_rebuild(self):
+        db.session.execute("DELETE FROM search_index")
+        db.session.commit()
+        self.assertEqual(self.titles("sunshine"), [])
+        result = self.app.test_cli_runner().invoke(search_rebuild)
+        self.assertIn("Indexed 3 posts and comments.", result.output)
+        self.assertEqual(self.titles("sunshine"), ["Gardening", "Sunshine", "Agreed"])
+
+
+class QueryPlanTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def plan(self, query):
+        statement = query.statement.compile(
+            db.engine, compile_kwargs={"literal_binds": True}
+        )
+        rows = db.session.execute(f"EXPLAIN QUERY PLAN {statement}").fetchall()
+        return " ".join(row[-1] for row in rows)
+
+    def test_author_posts_use_index(self):
+        page = keyset_paginate(
+            Posts.query.filter_by(author_id=1),
+            (Posts.publication_datetime, Posts.id),
+            10,
+            after="2021-02-22T18:26:17_42",
+            lazy=True,
+        )
+        plan = self.plan(page.query)
+        self.assertIn("ix_posts_author_id_publication_datetime", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_comment_thread_uses_index(self):
+        page = keyset_paginate(
+            Comments.query.filter_by(post_id=1),
+            (Comments.publication_datetime, Comments.id),
+            10,
+            descending=False,
+            lazy=True,
+        )
+        plan = self.plan(page.query)
+        self.assertIn("ix_comments_post_id_publication_datetime", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_author_comments_use_index(self):
+        self.assertIn(
+            "ix_comments_author_id", self.plan(Comments.query.filter_by(author_id=1))
+        )
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.app.config["METRICS_ENABLED"] = True
+        self.app.config["SERVER_TIMING_HEADER"] = True
+        db.create_all()
+        metrics.reset()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        cache.clear()
+        identity_cache.clear()
+        self.app_context.pop()
+
+    def test_metrics_endpoint(self):
+        response = self.client.get("/")
+        self.assertRegex(
+            response.headers["Server-Timing"],
+            r'db;dur=[\d.]+;desc="1 queries", render;dur=[\d.]+, app;dur=[\d.]+',
+        )
+        self.client.get("/")
+        text = self.client.get("/metrics").get_data(as_text=True)
+        self.assertIn(
+            'blog_requests_total{endpoint="main.index",method="GET",status="200"} 2',
+            text,
+        )
+        self.assertIn('blog_sql_statements_total{endpoint="main.index"} 1', text)
+        self.assertIn(
+            'blog_request_duration_seconds_count{endpoint="main.index"} 2', text
+        )
+        self.assertIn(
+            'blog_request_phase_seconds_total{endpoint="main.index",phase="render"}',
+            text,
+        )
+        self.assertIn('blog_page_cache_lookups_total{result="hits"} 1', text)
+        self.assertIn("blog_sql_slow_queries_total 0", text)
+
+    def test_slow_query_log(self):
+        self.app.config["SLOW_QUERY_THRESHOLD_MS"] = 0
+        with self.assertLogs("blog.sql", "WARNING") as logs:
+            self.client.get("/")
+        self.assertIn("FROM posts", logs.output[0])
+        text = self.client.get("/metrics").get_data(as_text=True)
+        self.assertIn("blog_sql_slow_queries_total 1", text)
+
+    def test_disabled(self):
+        self.app.config["METRICS_ENABLED"] = False
+        self.assertNotIn("Server-Timing", self.client.get("/").headers)
+        self.assertEqual(self.client.get("/metrics").status_code, 404)
+
+    def test_apps_keep_their_own_config(self):
+        app = create_app(TestConfig)
+        self.assertFalse(app.config["METRICS_ENABLED"])
+        self.assertEqual(app.test_client().get("/metrics").status_code, 404)
+        self.assertEqual(self.client.get("/metrics").status_code, 200)
+        self.assertIn("Server-Timing", self.client.get("/").headers)
+
+    def test_apps_keep_their_own_series(self):
+        app = create_app(TestConfig)
+        app.config["METRICS_ENABLED"] = True
+        client = app.test_client()
+        with app.app_context():
+            db.create_all()
+            client.get("/")
+            client.get("/")
+            text = client.get("/metrics").get_data(as_text=True)
+        self.assertIn(
+            'blog_requests_total{endpoint="main.index",method="GET",status="200"} 2',
+            text,
+        )
+        self.assertEqual(text.count("# HELP blog_tasks_total "), 1)
+        self.client.get("/")
+        text = self.client.get("/metrics").get_data(as_text=True)
+        self.assertIn(
+            'blog_requests_total{endpoint="main.index",method="GET",status="200"} 1',
+            text,
+        )
+        self.assertNotIn('endpoint="metrics"', text)
+
+
+class DatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        path = os.path.join(tempfile.mkdtemp(), "blog.db")
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + path
+        self.app.config["METRICS_ENABLED"] = True
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        db.engine.dispose()
+        self.app_context.pop()
+
+    def test_sqlite_pragmas(self):
+        self.assertEqual(db.session.execute("PRAGMA journal_mode").scalar(), "wal")
+        self.assertEqual(db.session.execute("PRAGMA synchronous").scalar(), 1)
+        self.assertEqual(db.session.execute("PRAGMA busy_timeout").scalar(), 5000)
+
+    def test_pool_gauges(self):
+        db.session.execute("SELECT 1")
+        self.assertEqual(
+            db.pool_stats(),
+            {"size": 5, "checked_out": 1, "checked_in": 0, "overflow": 0},
+        )
+        db.session.remove()
+        self.assertEqual(db.pool_stats()["checked_in"], 1)
+        text = self.app.test_client().get("/metrics").get_data(as_text=True)
+        self.assertIn('blog_db_pool_connections{state="size"} 5', text)
+
+    def test_server_options(self):
+        self.app.config["DATABASE_STATEMENT_TIMEOUT_MS"] = 5000
+        options = {}
+        db.apply_driver_hacks(self.app, make_url("postgresql://blog@db/blog"), options)
+        self.assertEqual(options["pool_size"], 5)
+        self.assertEqual(options["max_overflow"], 10)
+        self.assertTrue(options["pool_pre_ping"])
+        self.assertEqual(
+            options["connect_args"], {"options": "-c statement_timeout=5000"}
+        )
+
+
+class ReplicaTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        directory = tempfile.mkdtemp()
+        self.primary = os.path.join(directory, "primary.db")
+        self.replica = os.path.join(directory, "replica.db")
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + self.primary
+        self.app.config["SQLALCHEMY_BINDS"] = {"replica": "sqlite:///" + self.replica}
+        self.app.config["REPLICA_LAG_SECONDS"] = 0.5
+        self.app.config["WTF_CSRF_ENABLED"] = False
+        db.create_all()
+        db.metadata.create_all(db.get_engine(self.app, "replica"))
+        self.client = self.app.test_client()
+        self.client.post(
+            "/register",
+            data={
+                "username": "Tim",
+                "email": "tim@tim.ru",
+                "password": 123,
+                "password2": 123,
+            },
+        )
+        self.client.post("/login", data={"username": "Tim", "password": 123})
+        self.replicate()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        db.engine.dispose()
+        db.get_engine(self.app, "replica").dispose()
+        cache.clear()
+        identity_cache.clear()
+        self.app_context.pop()
+
+    def replicate(self):
+        source, target = sqlite3.connect(self.primary), sqlite3.connect(self.replica)
+        source.backup(target)
+        source.close()
+        target.close()
+
+    def test_reads_from_replica_after_the_lag(self):
+        self.client.post("user/Tim", data={"title": "Fresh", "content": "Hot"})
+        anonymous = self.app.test_client()
+        # the writer reads their own post from the primary, others don't see it
+        self.assertIn(b"Fresh", self.client.get("user/Tim").data)
+        self.assertNotIn(b"Fresh", anonymous.get("/").data)
+        self.assertEqual(Posts.query.count(), 1)
+
+        time.sleep(0.5)
+        self.assertNotIn(b"Fresh", self.client.get("user/Tim").data)
+        self.replicate()
+        self.assertIn(b"Fresh", self.client.get("user/Tim").data)
+        self.assertIn(b"Fresh", anonymous.get("/").data)
+
+    def test_stale_pages_are_not_cached(self):
+        anonymous = self.app.test_client()
+        anonymous.get("/")
+        self.assertEqual(anonymous.get("/").headers["X-Cache"], "HIT")
+        self.client.post("user/Tim", data={"title": "Fresh", "content": "Hot"})
+        anonymous.get("/")
+        response = anonymous.get("/")
+        self.assertEqual(response.headers["X-Cache"], "MISS")
+        self.assertNotIn(b"Fresh", response.data)
+
+        self.replicate()
+        time.sleep(1)
+        self.assertIn(b"Fresh", anonymous.get("/").data)
+        self.assertEqual(anonymous.get("/").headers["X-Cache"], "HIT")
+
+
+class TemplatesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.app.config["WTF_CSRF_ENABLED"] = False
+        db.create_all()
+        self.client = self.app.test_client()
+        self.client.post(
+            "/register",
+            data={
+                "username": "Tim",
+                "email": "tim@tim.ru",
+                "password": 123,
+                "password2": 123,
+            },
+        )
+        self.client.post("/login", data={"username": "Tim", "password": 123})
+        for title in ("First", "Second"):
+            self.client.post("user/Tim", data={"title": title, "content": "Hello"})
+        templates.clear()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        cache.clear()
+        identity_cache.clear()
+        templates.clear()
+        self.app_context.pop()
+
+    def test_fragments_follow_changes(self):
+        self.client.get("/")
+        self.client.get("/")
+        self.assertEqual(templates.fragments.stats()["hits"], 2)
+
+        self.client.post("edit_post/1", data={"title": "Edited", "content": "Hi"})
+        self.client.post("post/2", data={"title": "Comment", "content": "Nice"})
+        response = self.client.get("/")
+        self.assertIn(b"Edited</a>", response.data)
+        self.assertIn(b"(1 comments)", response.data)
+        self.assertEqual(templates.fragments.stats()["hits"], 2)
+
+        self.client.post("/edit_profile", data={"username": "Tom"})
+        self.assertIn(b"by Tom", self.client.get("/").data)
+        self.assertEqual(templates.fragments.stats()["misses"], 6)
+
+    def test_comment_fragments_per_viewer(self):
+        self.client.post("post/1", data={"title": "Comment", "content": "Nice"})
+        self.assertIn(b"Edit comment", self.client.get("post/1").data)
+        self.client.get("/logout")
+        self.assertNotIn(b"Edit comment", self.client.get("post/1").data)
+
+    def test_bytecode_cache(self):
+        directory = self.app.config["JINJA_BYTECODE_CACHE_DIR"]
+        self.assertIsNotNone(self.app.jinja_env.bytecode_cache)
+        self.client.get("/")
+        self.assertTrue(
+            any(name.startswith("__jinja2_") for name in os.listdir(directory))
+        )
+
+    def test_timestamp_filter(self):
+        self.assertEqual(
+            format_timestamp(datetime(2021, 1, 2, 3, 4, 5)), "2021-01-02 03:04:05"
+        )
+
+
+class TaskQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config["TASK_RETRY_BACKOFF"] = 0.01
+        self.tasks = TaskQueue(self.app)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.calls = []
+
+        @self.tasks.task
+        def flaky(value, failures):
+            self.calls.append(value)
+            if len(self.calls) <= failures:
+                raise RuntimeError("try again")
+
+        self.flaky = flaky
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    def test_eager_while_testing(self):
+        self.app.testing = True
+        self.flaky.delay(1, 0)
+        self.assertEqual(self.calls, [1])
+        self.assertEqual(len(self.tasks.backend), 0)
+        with self.assertRaises(RuntimeError):
+            self.flaky.delay(2, 5)
+
+    def test_retry_with_backoff(self):
+        with self.assertLogs("blog.tasks", "WARNING"):
+            self.flaky.delay(1, 2)
+            self.assertTrue(self.tasks.join())
+        self.assertEqual(self.calls, [1, 1, 1])
+        self.assertEqual(
+            self.tasks.stats(), {"succeeded": 1, "retried": 2, "failed": 0}
+        )
+
+    def test_gives_up(self):
+        self.app.config["TASK_MAX_RETRIES"] = 1
+        with self.assertLogs("blog.tasks", "ERROR") as logs:
+            self.flaky.delay(1, 5)
+            self.assertTrue(self.tasks.join())
+        self.assertEqual(self.calls, [1, 1])
+        self.assertIn("giving up", logs.output[-1])
+        self.assertEqual(self.tasks.stats()["failed"], 1)
+
+    def test_workers_survive_queue_errors(self):
+        get = self.tasks.backend.get
+        errors = [sqlite3.OperationalError("database is locked")]
+
+        def flaky_get(timeout):
+            if errors:
+                raise errors.pop()
+            return get(timeout)
+
+        self.app.config["TASK_WORKERS"] = 1
+        with mock.patch.object(self.tasks.backend, "get", flaky_get):
+            with self.assertLogs("blog.tasks", "ERROR"):
+                self.flaky.delay(1, 0)
+                self.assertTrue(self.tasks.join())
+        self.assertEqual(self.calls, [1])
+
+    def test_dead_workers_are_replaced(self):
+        self.app.config["TASK_WORKERS"] = 1
+        dead = threading.Thread(target=lambda: None)
+        dead.start()
+        dead.join()
+        self.app.extensions["tasks"].workers.append(dead)
+        self.flaky.delay(1, 0)
+        self.assertTrue(self.tasks.join())
+        self.assertEqual(self.calls, [1])
+        self.assertNotIn(dead, self.app.extensions["tasks"].workers)
+
+    def test_sqlite_queue_is_durable(self):
+        path = os.path.join(tempfile.mkdtemp(), "tasks.db")
+        SQLiteQueue(path).put("blog.search.reindex", [[1], []])
+        queue = SQLiteQueue(path, lease=0.05)
+        job = queue.get(timeout=0)
+        self.assertEqual(job, Job(job.id, "blog.search.reindex", [[1], []], 0))
+        # leased to the first worker until it acks or the lease runs out
+        self.assertIsNone(SQLiteQueue(path).get(timeout=0))
+        queue.retry(job, eta=0)
+        job = SQLiteQueue(path).get(timeout=0.5)
+        self.assertEqual(job.attempts, 1)
+        queue.ack(job)
+        self.assertEqual(len(queue), 0)
+
+
+class FeedTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.app.config["WTF_CSRF_ENABLED"] = False
+        db.create_all()
+        self.client = self.app.test_client()
+        for username in ("Tim", "Ann"):
+            self.client.post(
+                "/register",
+                data={
+                    "username": username,
+                    "email": f"{username}@blog.ru",
+                    "password": 123,
+                    "password2": 123,
+                },
+            )
+        self.login("Ann")
+        for title in ("Roses", "Tulips"):
+            self.client.post(
+                "user/Ann", data={"title": title, "content": "In the garden"}
+            )
+        self.login("Tim")
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        cache.clear()
+        identity_cache.clear()
+        templates.clear()
+        self.app_context.pop()
+
+    def login(self, username):
+        self.client.get("/logout")
+        self.client.post("/login", data={"username": username, "password": 123})
+
+    def feed(self, **args):
+        response = self.client.get("/feed", query_string=args)
+        self.assertEqual(response.status_code, 200)
+        return [
+            title
+            for title in ("Roses", "Tulips", "Daisies", "Mine")
+            if f">{title}</a>".encode() in response.data
+        ]
+
+    def entries(self, username):
+        user = Users.query.filter_by(username=username).first()
+        return sorted(
+            entry.post_id for entry in FeedEntry.query.filter_by(user_id=user.id)
+        )
+
+    def test_follow_backfills_and_fans_out(self):
+        self.assertEqual(self.feed(), [])
+        self.client.post("follow/Ann")
+        self.assertEqual(
+            Users.query.filter_by(username="Ann").first().follower_count, 1
+        )
+        self.assertEqual(self.feed(), ["Roses", "Tulips"])
+
+        self.client.post("user/Tim", data={"title": "Mine", "content": "Hello"})
+        self.login("Ann")
+        self.client.post("user/Ann", data={"title": "Daisies", "content": "Too"})
+        self.assertEqual(self.entries("Ann"), [1, 2, 4])
+        self.login("Tim")
+        self.assertEqual(self.entries("Tim"), [1, 2, 3, 4])
+
+        self.client.post("unfollow/Ann")
+        self.assertEqual(
+            Users.query.filter_by(username="Ann").first().follower_count, 0
+        )
+        self.assertEqual(self.feed(), ["Mine"])
+
+    def test_feed_skips_post_bodies(self):
+        self.client.post("follow/Ann")
+        with count_queries() as statements:
+            response = self.client.get("/feed")
+        self.assertIn(b"In the garden", response.data)
+        self.assertFalse(any("posts.content" in s for s in statements))
+
+    def test_feed_is_trimmed(self):
+        self.app.config["FEED_LENGTH"] = 1
+        self.client.post("follow/Ann")
+        self.assertEqual(self.entries("Tim"), [2])
+        self.client.post("user/Tim", data={"title": "Mine", "content": "Hello"})
+        self.assertEqual(self.entries("Tim"), [3])
+
+    def test_followed_authors_above_fanout_limit_are_merged_on_read(self):
+        self.app.config["FEED_FANOUT_LIMIT"] = 0
+        self.client.post("follow/Ann")
+        self.client.post("user/Tim", data={"title": "Mine", "content": "Hello"})
+        self.assertEqual(self.entries("Tim"), [3])
+        self.assertEqual(self.feed(), ["Roses", "Tulips", "Mine"])
+        self.app.config["POSTS_PER_PAGE"] = 2
+        response = self.client.get("/feed")
+        self.assertIn(b"Older posts", response.data)
+
+    def test_deleted_posts_leave_the_feed(self):
+        self.client.post("follow/Ann")
+        self.login("Ann")
+        self.client.post("edit_post/1", data={"delete": "Delete"})
+        self.assertEqual(self.entries("Tim"), [2])
+        self.assertEqual(self.entries("Ann"), [2])
+
+    def test_following_requires_a_post(self):
+        self.assertEqual(self.client.get("follow/Ann").status_code, 405)
+        self.assertIn(b'value="Follow"', self.client.get("user/Ann").data)
+        self.client.post("follow/Ann")
+        self.client.post("follow/Ann")
+        self.assertEqual(
+            Users.query.filter_by(username="Ann").first().follower_count, 1
+        )
+        self.assertIn(b"Unfollow", self.client.get("user/Ann").data)
+
+
+class PurgeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.app.config["WTF_CSRF_ENABLED"] = False
+        self.app.config["PURGE_BATCH_SIZE"] = 2
+        db.create_all()
+        self.client = self.app.test_client()
+        tim = Users(username="Tim", email="tim@tim.ru")
+        tim.set_password("123")
+        ann = Users(username="Ann", email="ann@ann.ru")
+        ann.set_password("123")
+        db.session.add_all([tim, ann])
+        db.session.commit()
+        for title in ("Sunflowers", "Lilies"):
+            post = Posts(title=title, content=f"{title} in bloom", author=tim)
+            db.session.add(post)
+            db.session.commit()
+            for i in range(5):
+                comment = Comments(
+                    title=f"Comment {i}", content="Lovely", author=ann, post=post
+                )
+                db.session.add(comment)
+                post.comment_added(comment)
+            db.session.commit()
+            db.session.add(
+                FeedEntry(
+                    user_id=ann.id,
+                    post_id=post.id,
+                    publication_datetime=post.publication_datetime,
+                )
+            )
+        db.session.commit()
+        self.client.post("/login", data={"username": "Tim", "password": 123})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        cache.clear()
+        identity_cache.clear()
+        templates.clear()
+        self.app_context.pop()
+
+    def test_deleted_post_is_hidden_until_purged(self):
+        with mock.patch.object(purge, "delay") as delay, count_queries() as statements:
+            response = self.client.post("edit_post/1", data={"delete": "Delete"})
+        self.assertEqual(response.status_code, 302)
+        delay.assert_called_once_with()
+        # one UPDATE, whatever the size of the thread
+        self.assertFalse(any("comments" in s for s in statements))
+        self.assertEqual(Posts.query.count(), 2)
+        self.assertEqual(Comments.query.count(), 10)
+
+        self.assertNotIn(b"Sunflowers", self.client.get("/").data)
+        self.assertNotIn(b"Sunflowers", self.client.get("/user/Tim").data)
+        self.assertEqual(self.client.get("/post/1").status_code, 404)
+        self.assertEqual(self.client.get("/edit_post/1").status_code, 404)
+        self.assertEqual(self.client.get("/edit_comment/1").status_code, 404)
+        self.assertEqual(self.client.get("/api/v1/posts/1").status_code, 404)
+        self.assertEqual(self.client.get("/api/v1/comments/1").status_code, 404)
+        self.assertEqual(self.client.get("/api/v1/posts/1/comments").status_code, 404)
+        self.assertEqual(
+            [p["title"] for p in self.client.get("/api/v1/posts").get_json()["items"]],
+            ["Lilies"],
+        )
+        self.assertEqual(search.find("bloom")[0][0].title, "Lilies")
+        self.assertEqual(len(search.find("lovely")[0]), 5)
+        self.client.get("/logout")
+        self.client.post("/login", data={"username": "Ann", "password": 123})
+        feed = self.client.get("/feed").data
+        self.assertIn(b"Lilies", feed)
+        self.assertNotIn(b"Sunflowers", feed)
+
+    def test_purge_deletes_in_chunks(self):
+        Posts.query.get(1).mark_deleted()
+        db.session.commit()
+        with count_queries() as statements:
+            self.assertEqual(purge(), 1)
+        deletes = [s for s in statements if s.startswith("DELETE FROM comments")]
+        self.assertEqual(len(deletes), 3)
+        self.assertEqual(Posts.query.count(), 1)
+        self.assertEqual(Comments.query.filter_by(post_id=1).count(), 0)
+        self.assertEqual(Comments.query.filter_by(post_id=2).count(), 5)
+        self.assertEqual(FeedEntry.query.filter_by(post_id=1).count(), 0)
+        self.assertEqual(FeedEntry.query.filter_by(post_id=2).count(), 1)
+        self.assertEqual(search.find("sunflowers")[0], [])
+        self.assertEqual(len(search.find("lovely")[0]), 5)
+        self.assertEqual(purge(), 0)
+
+    def test_cli(self):
+        Posts.query.get(2).mark_deleted()
+        db.session.commit()
+        result = self.app.test_cli_runner().invoke(purge_deleted)
+        self.assertIn("Purged 1 deleted posts.", result.output)
+
+
+class BulkTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+        tim = Users(username="Tim", email="tim@tim.ru")
+        tim.set_password("123")
+        db.session.add(tim)
+        db.session.commit()
+        token = b64encode(b"Tim:123").decode()
+        self.headers = {"Authorization": f"Basic {token}"}
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        cache.clear()
+        identity_cache.clear()
+        self.app_context.pop()
+
+    def batch(self, url, items):
+        return self.client.post(url, json={"items": items}, headers=self.headers)
+
+    def test_create_posts(self):
+        with count_queries() as statements:
+            response = self.batch(
+                "/api/v1/posts/batch",
+                [
+                    {"title": "Morning", "content": "Coffee first"},
+                    {"title": "", "content": "No title"},
+                    "garbage",
+                    {"title": "Evening", "content": "Tea later"},
+                    {"title": "Noon", "content": 12},
+                ],
+            )
+        inserts = [s for s in statements if s.startswith("INSERT INTO posts")]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(response.status_code, 207)
+        body = response.get_json()
+        self.assertEqual((body["created"], body["rejected"]), (2, 3))
+        results = body["results"]
+        self.assertEqual(results[0], {"id": 1})
+        self.assertIn("title", results[1]["errors"])
+        self.assertIn("item", results[2]["errors"])
+        self.assertEqual(results[3], {"id": 2})
+        self.assertEqual(results[4], {"errors": {"content": ["Expected a string."]}})
+
+        evening = Posts.query.get(2)
+        self.assertEqual((evening.title, evening.excerpt), ("Evening", "Tea later"))
+        self.assertEqual(
+            sorted(e.post_id for e in FeedEntry.query.filter_by(user_id=1)), [1, 2]
+        )
+        self.assertEqual(search.find("coffee")[0][0].title, "Morning")
+        self.assertIn(b"Evening", self.client.get("/").data)
+
+    def test_create_posts_one_by_one_elsewhere(self):
+        items = [{"title": "Morning", "content": "Coffee"}] * 2
+        self.batch("/api/v1/posts/batch", items)
+        dialect = db.get_engine(self.app).dialect
+        with mock.patch.object(dialect, "name", "mysql"):
+            with count_queries() as statements:
+                response = self.batch("/api/v1/posts/batch", items)
+        inserts = [s for s in statements if s.startswith("INSERT INTO posts")]
+        self.assertEqual(len(inserts), 2)
+        self.assertEqual(response.get_json()["results"], [{"id": 3}, {"id": 4}])
+
+    def test_create_comments(self):
+        post = Posts(title="Question", content="Why?", author=Users.query.get(1))
+        db.session.add(post)
+        db.session.commit()
+        items = [
+            {"post_id": 1, "title": f"Answer {i}", "content": "42"} for i in (1, 2)
+        ]
+        items += [{"post_id": 7, "title": "Lost", "content": "Here"}, {"title": "x"}]
+        response = self.batch("/api/v1/comments/batch", items)
+        self.assertEqual(response.status_code, 207)
+        results = response.get_json()["results"]
+        self.assertEqual(results[:2], [{"id": 1}, {"id": 2}])
+        self.assertEqual(results[2]["errors"], {"post_id": ["No such post."]})
+        self.assertEqual(set(results[3]["errors"]), {"content", "post_id"})
+
+        post = Posts.query.get(1)
+        self.assertEqual(post.comment_count, 2)
+        self.assertEqual(
+            post.last_comment_at, Comments.query.get(2).publication_datetime
+        )
+        self.assertEqual(len(search.find("answer")[0]), 2)
+
+    def test_limits(self):
+        self.assertEqual(self.batch("/api/v1/posts/batch", []).status_code, 400)
+        self.app.config["API_MAX_BATCH_SIZE"] = 1
+        items = [{"title": "One", "content": "1"}, {"title": "Two", "content": "2"}]
+        self.assertEqual(self.batch("/api/v1/posts/batch", items).status_code, 413)
+        response = self.batch("/api/v1/posts/batch", items[:1])
+        self.assertEqual(response.status_code, 201)
+        response = self.client.post("/api/v1/posts/batch", json={"items": items[:1]})
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(Posts.query.count(), 1)
+
+    def test_cli(self):
+        runner = self.app.test_cli_runner()
+        source = "".join(
+            f'{{"title": "Post {i}", "content": "Body {i}"}}\n' for i in range(5)
+        )
+        result = runner.invoke(
+            bulk_create, ["posts", "Tim", "-", "--batch-size", "2"], input=source
+        )
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Created 5 posts", result.output)
+        self.assertEqual(Posts.query.count(), 5)
+
+        source = (
+            '{"post_id": 5, "title": "Hi", "content": "There"}\nnot json\n'
+            '{"post_id": 5, "title": "Hi", "content": 5}\n'
+            '{"post_id": 4, "title": "Bye", "content": "Then"}\n'
+        )
+        result = runner.invoke(
+            bulk_create, ["comments", "Tim", "-", "--batch-size", "2"], input=source
+        )
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("item 2:", result.output)
+        self.assertIn('item 3: {"content": ["Expected a string."]}', result.output)
+        self.assertIn("2 comments were rejected", result.output)
+        self.assertEqual(Posts.query.get(5).comment_count, 1)
+        self.assertEqual(Posts.query.get(4).comment_count, 1)
+        result = runner.invoke(bulk_create, ["posts", "Nobody"], input=source)
+        self.assertIn("No user 'Nobody'", result.output)
+
+
+class TransferTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        tim = Users(username="Tim", email="tim@tim.ru")
+        tim.set_password("cat")
+        ann = Users(username="Ann", email="ann@ann.ru")
+        ann.set_password("dog")
+        post = Posts(title="Sunshine", content='A sunny, "quoted"\nday', author=tim)
+        empty = Posts(title="", content=None, author=ann)
+        comment = Comments(title="Agreed", content="Indeed", author=ann, post=post)
+        db.session.add_all([tim, ann, post, empty, comment])
+        db.session.commit()
+        post.comment_added(comment)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        cache.clear()
+        identity_cache.clear()
+        self.app_context.pop()
+
+    def dump(self, fmt):
+        rows = {}
+        for name, table in transfer.TABLES.items():
+            rows[name] = [tuple(row) for row in db.session.execute(table.select())]
+            out = StringIO()
+            progress = transfer.export_rows(name, out, fmt, chunk_size=1)
+            self.assertEqual(progress.rows, len(rows[name]))
+            rows[name + "_export"] = out.getvalue()
+        return rows
+
+    def round_trip(self, fmt):
+        before = self.dump(fmt)
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        for name in ("users", "posts", "comments"):
+            source = StringIO(before[name + "_export"])
+            transfer.import_rows(name, source, fmt, chunk_size=2)
+        for name, table in transfer.TABLES.items():
+            after = [tuple(row) for row in db.session.execute(table.select())]
+            self.assertEqual(after, before[name])
+        self.assertTrue(Users.query.get(2).check_password("dog"))
+        self.assertEqual(Posts.query.get(1).comments.one().title, "Agreed")
+
+    def test_ndjson_round_trip(self):
+        self.round_trip("ndjson")
+        self.assertIsNone(Posts.query.get(2).content)
+
+    def test_csv_round_trip(self):
+        # CSV can't tell a NULL text column from an empty one
+        Posts.query.get(2).content = ""
+        db.session.commit()
+        self.round_trip("csv")
+        self.assertIsNone(Posts.query.get(2).last_comment_at)
+
+    def test_import_fills_missing_excerpts(self):
+        source = StringIO(
+            '{"id": 3, "author_id": 1, "title": "Old", "content": "Dump"}'
+        )
+        transfer.import_rows("posts", source)
+        self.assertEqual(Posts.query.get(3).excerpt, "Dump")
+
+    def test_import_is_all_or_nothing(self):
+        source = StringIO(
+            '{"id": 3, "username": "Bob", "email": "bob@bob.ru"}\n'
+            '{"id": 1, "username": "Tim", "email": "tim@tim.ru"}\n'
+        )
+        with self.assertRaises(Exception):
+            transfer.import_rows("users", source)
+        self.assertEqual(Users.query.count(), 2)
+        with self.assertRaisesRegex(ValueError, "Unknown users columns: nickname"):
+            transfer.import_rows("users", StringIO('{"nickname": "Bob"}'))
+
+    def test_cli(self):
+        runner = self.app.test_cli_runner()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "posts.csv")
+            result = runner.invoke(export, ["posts", path, "--format", "csv"])
+            self.assertIn("Exported 2 posts", result.output)
+            Comments.query.delete()
+            Posts.query.delete()
+            db.session.commit()
+            result = runner.invoke(import_, ["posts", path, "--format", "csv"])
+            self.assertIn("Imported 2 posts", result.output)
+            self.assertEqual(len(search.find("sunny")[0]), 1)
+            result = runner.invoke(import_, ["posts", path, "--format", "csv"])
+            self.assertEqual(result.exit_code, 1)
+            self.assertIn("UNIQUE constraint failed", result.output)
+
+
+class RateLimitTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.app.config["WTF_CSRF_ENABLED"] = False
+        self.app.config["RATELIMIT_ENABLED"] = True
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        cache.clear()
+        identity_cache.clear()
+        limiter.clear()
+        self.app_context.pop()
+
+    def test_login_attempts_are_throttled(self):
+        form = {"username": "Tim", "password": "wrong"}
+        for _ in range(10):
+            self.assertEqual(self.client.post("/login", data=form).status_code, 302)
+        response = self.client.post("/login", data=form)
+        self.assertEqual(response.status_code, 429)
+        self.assertIn(int(response.headers["Retry-After"]), range(1, 7))
+        # viewing the form isn't counted, and other clients have their own bucket
+        self.assertEqual(self.client.get("/login").status_code, 200)
+        with self.app.test_request_context(
+            "/login", method="POST", environ_base={"REMOTE_ADDR": "10.0.0.2"}
+        ):
+            limiter.check()
+        self.assertEqual(limiter.stats(), {"main.login": 1})
+
+    def test_api_answers_with_json(self):
+        data = {"username": "Tim", "email": "tim@tim.ru", "password": "cat"}
+        self.assertEqual(self.client.post("/api/v1/users", json=data).status_code, 201)
+        for _ in range(4):
+            self.client.post("/api/v1/users", json=data)
+        response = self.client.post("/api/v1/users", json=data)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.get_json()["error"], "Too Many Requests")
+        self.assertEqual(response.headers["Retry-After"], "720")
+
+    def proxied_client(self, proxies):
+        config = type("ProxyConfig", (TestConfig,), {})
+        config.WTF_CSRF_ENABLED = False
+        config.RATELIMIT_ENABLED = True
+        config.RATELIMIT_TRUSTED_PROXIES = proxies
+        app = create_app(config)
+        with app.app_context():
+            db.create_all()
+        return app.test_client()
+
+    def login_from(self, client, address, username):
+        return client.post(
+            "/login",
+            data={"username": username, "password": "wrong"},
+            headers={"X-Forwarded-For": address},
+        )
+
+    def test_trusted_proxies(self):
+        for proxies, expected in ((0, 429), (1, 302)):
+            client = self.proxied_client(proxies)
+            for i in range(11):
+                response = self.login_from(client, f"10.0.0.{i}", f"user{i}")
+            # without a trusted proxy the header is ignored and every client
+            # shares the address of the router
+            self.assertEqual(response.status_code, expected, proxies)
+
+    def test_login_counted_per_username(self):
+        client = self.proxied_client(1)
+        for i in range(10):
+            response = self.login_from(client, f"10.0.0.{i}", "Tim")
+            self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.login_from(client, "10.0.1.1", "Tim").status_code, 429)
+        self.assertEqual(self.login_from(client, "10.0.1.1", "Tom").status_code, 302)
+
+    def test_disabled_while_testing(self):
+        self.app.config["RATELIMIT_ENABLED"] = None
+        for _ in range(12):
+            response = self.client.post("/login", data={"username": "Tim"})
+            self.assertEqual(response.status_code, 200)
+
+    def test_bucket_refills(self):
+        store = MemoryBucketStore()
+        with mock.patch("blog.ratelimit.time.monotonic", return_value=100.0) as now:
+            self.assertEqual(store.take("login", 2, 0.5), 0)
+            self.assertEqual(store.take("login", 2, 0.5), 0)
+            self.assertEqual(store.take("login", 2, 0.5), 2.0)
+            now.return_value = 101.0
+            self.assertEqual(store.take("login", 2, 0.5), 1.0)
+            now.return_value = 102.0
+            self.assertEqual(store.take("login", 2, 0.5), 0)
+            self.assertEqual(store.take("other", 2, 0.5), 0)
+
+    def test_parse_limit(self):
+        self.assertEqual(parse_limit("10/minute"), (10, 10 / 60))
+        self.assertEqual(parse_limit(" 5 / hour"), (5, 5 / 3600))
+        with self.assertRaises(ValueError):
+            parse_limit("10 per minute")
+
+    def test_redis_store_runs_the_script(self):
+        client = mock.Mock()
+        client.register_script.return_value.return_value = b"1.5"
+        store = RedisBucketStore(client)
+        self.assertEqual(store.take("login:ip:127.0.0.1", 10, 0.25), 1.5)
+        client.register_script.return_value.assert_called_once_with(
+            keys=["blog:ratelimit:login:ip:127.0.0.1"], args=[10, 0.25]
+        )
+
 
 if __name__ == "__main__":
     unittest.main(verbosity=2)